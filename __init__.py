@@ -5,12 +5,21 @@
 """
 from trytond.pool import Pool
 from party import Address
-from carrier import Carrier, CarrierService, BoxType
+from carrier import Carrier, CarrierService, BoxType, UOM
 from sale import Configuration, Sale
 from configuration import PartyConfiguration
 from stock import (
     ShipmentOut, StockMove, ShippingUps, GenerateShippingLabel, Package
 )
+from worldship import WorldShipImportStart, WorldShipImport
+from label_timing import LabelTiming
+from label_journal import LabelJournal
+from rate_flight import RateFlight
+from rate_history import RateHistory
+from invoice_reconciliation import (
+    InvoiceReconciliation, InvoiceReconciliationLine,
+    InvoiceReconciliationImportStart, InvoiceReconciliationImport
+)
 
 
 def register():
@@ -20,16 +29,27 @@ def register():
         Carrier,
         CarrierService,
         BoxType,
+        UOM,
         Configuration,
         Sale,
         StockMove,
         ShipmentOut,
         ShippingUps,
         Package,
+        WorldShipImportStart,
+        LabelTiming,
+        LabelJournal,
+        RateFlight,
+        RateHistory,
+        InvoiceReconciliation,
+        InvoiceReconciliationLine,
+        InvoiceReconciliationImportStart,
         module='shipping_ups', type_='model'
     )
 
     Pool.register(
         GenerateShippingLabel,
+        WorldShipImport,
+        InvoiceReconciliationImport,
         module='shipping_ups', type_='wizard'
     )
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+    accept_response.py
+
+    Streaming parse of the ShipmentAccept responses, whose size is mostly
+    the base64 label images of the PackageResults. The response is fed in
+    chunks to a pull parser which hands out one PackageResults at a time
+    and frees it once read, instead of building the tree of the whole
+    response.
+
+    The response is streamed from UPS to a temporary file by
+    :func:`send_raw`, it is never held in memory as a whole.
+
+"""
+import urllib2
+import tempfile
+
+from lxml import etree, objectify
+
+from metrics import InstrumentedClient
+from ups_api import ups
+
+__all__ = ['send_raw', 'parse_header', 'iter_package_results']
+
+#: Bytes of the response fed to the parser at once
+CHUNK_SIZE = 64 * 1024
+
+#: Seconds to wait for UPS, as PyUPS does
+TIMEOUT = 10
+
+
+def _get_parser(events, tag):
+    # The elements are built as objectify.fromstring does for PyUPS
+    parser = etree.XMLPullParser(
+        events=events, tag=tag, remove_blank_text=True
+    )
+    parser.set_element_class_lookup(objectify.ObjectifyElementClassLookup())
+    return parser
+
+
+def _iter_chunks(data):
+    if isinstance(data, basestring):
+        for position in xrange(0, len(data), CHUNK_SIZE):
+            yield data[position:position + CHUNK_SIZE]
+        return
+    data.seek(0)
+    for chunk in iter(lambda: data.read(CHUNK_SIZE), ''):
+        yield chunk
+
+
+def parse_header(data):
+    """
+    Return the root of the accept response data (a string or a file)
+    without its PackageResults, only the data before the first one is
+    parsed. The errors of the response are raised as PyUPSException.
+    """
+    parser = _get_parser(('start',), 'PackageResults')
+    root = None
+    for chunk in _iter_chunks(data):
+        parser.feed(chunk)
+        for _, element in parser.read_events():
+            root = element.getroottree().getroot()
+            break
+        if root is not None:
+            break
+    else:
+        root = parser.close()
+
+    shipment_results = root.find('ShipmentResults')
+    if shipment_results is not None:
+        # The chunk may hold the first packages, parsed or not
+        for element in shipment_results.findall('PackageResults'):
+            shipment_results.remove(element)
+    ups.ShipmentAccept.look_for_error(root)
+    return root
+
+
+def iter_package_results(data):
+    """
+    Yield the PackageResults of the accept response data in order. Each
+    one is cleared, with its label, when the next one is requested.
+    """
+    parser = _get_parser(('end',), 'PackageResults')
+    for chunk in _iter_chunks(data):
+        parser.feed(chunk)
+        for _, element in parser.read_events():
+            yield element
+            element.clear()
+            # Drop the cleared packages and the header before them
+            # (objectify indexes the siblings, not the children)
+            parent = element.getparent()
+            previous = element.getprevious()
+            while previous is not None:
+                parent.remove(previous)
+                previous = element.getprevious()
+    parser.close()
+
+
+def send_raw(client, request):
+    """
+    Send the accept request with the PyUPS client as its `request` method
+    does and return a temporary file with the response data unparsed, once
+    checked for errors. The response is copied to the file in chunks.
+    """
+    def send(api):
+        full_request = '\n'.join([
+            '<?xml version="1.0" encoding="UTF-8" ?>',
+            etree.tostring(api.access_request, pretty_print=True),
+            '<?xml version="1.0" encoding="UTF-8" ?>',
+            etree.tostring(request, pretty_print=True),
+        ])
+        response = urllib2.urlopen(urllib2.Request(
+                url=api.url, data=full_request.encode('utf-8')),
+            timeout=TIMEOUT)
+        data = tempfile.TemporaryFile()
+        try:
+            for chunk in iter(lambda: response.read(CHUNK_SIZE), ''):
+                data.write(chunk)
+            if isinstance(client, InstrumentedClient):
+                client.set_sizes(len(full_request), data.tell())
+            parse_header(data)
+        except Exception:
+            data.close()
+            raise
+        finally:
+            response.close()
+        return data
+
+    if isinstance(client, InstrumentedClient):
+        return client.call(send)
+    return send(client)
@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks
+
+    Offline benchmarks of the UPS integration. They run against an SQLite
+    in-memory database and recorded UPS payloads, run them from the root of
+    the repository::
+
+        python -m benchmarks.run --output before.json
+        python -m benchmarks.run --compare before.json
+
+"""
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks/fixtures.py
+
+    Synthetic records and UPS payloads for the benchmarks.
+
+"""
+import os
+import copy
+import zlib
+import base64
+from decimal import Decimal
+
+from lxml import etree
+
+PAYLOADS_DIR = os.path.join(os.path.dirname(__file__), 'payloads')
+
+
+def setup_environ(db_name=':memory:'):
+    """
+    Default the environment to an SQLite database and dummy UPS
+    credentials. Must be called before trytond.tests is imported.
+    """
+    os.environ.setdefault('TRYTOND_DATABASE_URI', 'sqlite://')
+    os.environ.setdefault('DB_NAME', db_name)
+    for name in (
+            'UPS_LICENSE_NO', 'UPS_SHIPPER_NO', 'UPS_USER_ID',
+            'UPS_PASSWORD'):
+        os.environ.setdefault(name, 'offline')
+
+
+def get_test_case():
+    """
+    Install the module and return a :class:`TestUPS` ready to create its
+    default records with :meth:`TestUPS.setup_defaults`. Must be called
+    outside of a transaction.
+    """
+    from trytond.modules.shipping_ups.tests.test_ups import TestUPS
+
+    case = TestUPS('test_0010_generate_ups_labels')
+    case.setUp()
+    return case
+
+
+def create_shipments(case, count, packages=1, worldship=False):
+    """
+    Create count packed-like shipments of the UPS carrier, each with that
+    many packages of one move.
+    """
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+
+    pool = Pool()
+    Date = pool.get('ir.date')
+    Shipment = pool.get('stock.shipment.out')
+    Move = pool.get('stock.move')
+    Package = pool.get('stock.package')
+    PackageType = pool.get('stock.package.type')
+    Uom = pool.get('product.uom')
+
+    carrier = case.ups_worldship_carrier if worldship else case.carrier
+    uom_kg, = Uom.search([('symbol', '=', 'kg')])
+    package_type, = PackageType.search([], limit=1)
+
+    with Transaction().set_context(company=case.company.id):
+        shipments = Shipment.create([{
+            'planned_date': Date.today(),
+            'effective_date': Date.today(),
+            'customer': case.sale_party.id,
+            'carrier': carrier.id,
+            'carrier_service': (
+                None if worldship else case.ups_next_day_air
+            ),
+            'cost_currency': carrier.currency.id,
+            'warehouse': case.warehouse.id,
+            'delivery_address': case.sale_party.addresses[0].id,
+        } for _ in xrange(count)])
+        from_location = shipments[0].warehouse.output_location.id
+        to_location = shipments[0].customer_location.id
+        moves = Move.create([{
+            'shipment': str(shipment),
+            'product': case.product.id,
+            'uom': uom_kg.id,
+            'quantity': 1 + index % 5,
+            'from_location': from_location,
+            'to_location': to_location,
+            'unit_price': Decimal('10'),
+            'currency': case.currency.id,
+        } for shipment in shipments for index in xrange(packages)])
+        Package.create([{
+            'type': package_type.id,
+            'shipment': str(move.shipment),
+            'moves': [('add', [move.id])],
+        } for move in moves])
+    return shipments
+
+
+def create_shipment(case, packages, worldship=False):
+    "Create a shipment of the UPS carrier with that many packages"
+    return create_shipments(case, 1, packages, worldship)[0]
+
+
+def create_sales(case, count, lines=1):
+    "Create count draft UPS sales with that many lines"
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+
+    Sale = Pool().get('sale.sale')
+
+    party = case.sale_party
+    with Transaction().set_context(company=case.company.id):
+        return Sale.create([{
+            'payment_term': case.payment_term,
+            'party': party.id,
+            'invoice_address': party.addresses[0].id,
+            'shipment_address': party.addresses[0].id,
+            'carrier': case.carrier.id,
+            'carrier_service': case.ups_next_day_air,
+            'lines': [('create', [{
+                'type': 'line',
+                'quantity': 1 + index % 5,
+                'product': case.product.id,
+                'unit_price': Decimal('10.00'),
+                'description': 'Line %d' % index,
+                'unit': case.product.template.default_uom.id,
+            } for index in xrange(lines)])],
+        } for _ in xrange(count)])
+
+
+def create_sale(case, lines):
+    "Create a draft UPS sale with that many lines"
+    return create_sales(case, 1, lines)[0]
+
+
+def load_payload(name, packages, tag, label_size=0):
+    """
+    Return the recorded payload `payloads/<name>.xml` with every `tag`
+    element repeated for that many packages.
+
+    :param label_size: Size in bytes of the label images to fill the
+        `GraphicImage` elements with
+    """
+    with open(os.path.join(PAYLOADS_DIR, name + '.xml'), 'rb') as file_obj:
+        root = etree.parse(file_obj).getroot()
+
+    image = base64.encodestring('GIF89a' + '\0' * label_size)
+    for template in list(root.iter(tag)):
+        for index in xrange(packages - 1):
+            template.addnext(copy.deepcopy(template))
+    if label_size:
+        for element in root.iter('GraphicImage'):
+            element.text = image
+    return etree.tostring(root)
+
+
+def process_label(data):
+    """
+    CPU bound stand-in of a label conversion, run in the label processes
+    by the `process.labels` benchmark
+    """
+    for level in xrange(1, 10):
+        compressed = zlib.compress(data, level)
+    return zlib.decompress(compressed)
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks/import_time.py
+
+    Measure the import of the module by a fresh worker: each run imports
+    trytond.modules.shipping_ups in a new interpreter and reports its
+    duration, the peak resident memory of the process and the ups modules
+    loaded.
+
+    Modes:
+
+    * `lazy`: the module alone, the PyUPS APIs are loaded on first use
+    * `eager`: the PyUPS APIs imported with the module, as before the
+      :mod:`ups_api` facade
+    * `first_use`: the module then all the PyUPS APIs, as a worker which
+      ships
+
+    ::
+
+        python -m benchmarks.import_time --repeat 20 --output import.json
+
+"""
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+
+from benchmarks.fixtures import setup_environ
+
+MODES = ('lazy', 'eager', 'first_use')
+
+_CHILD = r'''
+import sys
+import json
+import time
+import resource
+
+import trytond.pool
+import trytond.model
+import trytond.wizard
+
+mode = sys.argv[1]
+start = time.time()
+if mode == 'eager':
+    import ups.shipping_package
+    import ups.rating_package
+    import ups.address_validation
+    import ups.worldship_api
+import trytond.modules.shipping_ups
+if mode == 'first_use':
+    from trytond.modules.shipping_ups.ups_api import ups, MODULES
+    for name in MODULES:
+        getattr(ups, name)
+duration = time.time() - start
+json.dump({
+    'duration': duration,
+    'maxrss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'ups_modules': len([
+        m for m in sys.modules
+        if m.startswith('ups.') and sys.modules[m] is not None]),
+}, sys.stdout)
+'''
+
+
+def measure(mode, repeat):
+    """
+    Return the runs of mode, each one in a new interpreter. trytond is
+    imported before the measure as the workers do in any case.
+    """
+    runs = []
+    for _ in xrange(repeat):
+        output = subprocess.check_output(
+            [sys.executable, '-c', _CHILD, mode]
+        )
+        runs.append(json.loads(output))
+    return runs
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def run_modes(modes=MODES, repeat=10):
+    results = []
+    for mode in modes:
+        runs = measure(mode, repeat)
+        result = {
+            'mode': mode,
+            'repeat': repeat,
+            'median': _median([r['duration'] for r in runs]),
+            'min': min(r['duration'] for r in runs),
+            # Kilobytes on Linux
+            'maxrss': _median([r['maxrss'] for r in runs]),
+            'ups_modules': runs[-1]['ups_modules'],
+        }
+        results.append(result)
+        sys.stderr.write(
+            '%-10s median %8.2f ms  min %8.2f ms  maxrss %7d kB  '
+            'ups modules %d\n' % (
+                mode, result['median'] * 1000, result['min'] * 1000,
+                result['maxrss'], result['ups_modules']))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument(
+        '--mode', action='append', dest='modes', choices=MODES,
+        help='Only run this mode, can be repeated')
+    parser.add_argument('--output', help='Write the JSON results there')
+    options = parser.parse_args(argv)
+
+    setup_environ()
+    report = {
+        'python': platform.python_version(),
+        'timestamp': time.time(),
+        'results': run_modes(options.modes or MODES, options.repeat),
+    }
+    if options.output:
+        with open(options.output, 'wb') as file_obj:
+            json.dump(report, file_obj, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks/load.py
+
+    Load test of concurrent checkouts (sale rating) and label runs against a
+    local stand-in of UPS.
+
+    The fixtures of :meth:`TestUPS.setup_defaults` are created in a new
+    database together with synthetic sales and shipments, then worker
+    threads rate the sales and generate the labels of the shipments, each
+    call in its own transaction. Throughput, latency percentiles and
+    database queries per call are reported as JSON::
+
+        python -m benchmarks.load --sales 2000 --shipments 2000 \\
+            --workers 8 --ups-latency 0.2 --output load.json
+
+    SQLite serializes writers, use PostgreSQL to size a worker fleet::
+
+        TRYTOND_DATABASE_URI=postgresql:// python -m benchmarks.load ...
+
+"""
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
+
+from benchmarks.fixtures import setup_environ, get_test_case, \
+    create_sales, create_shipments
+from benchmarks.ups_server import UPSStandIn
+
+_local = threading.local()
+
+
+class _QueryCounter(object):
+    "Count the queries executed by each thread"
+
+    def __init__(self, cursor_class):
+        self.cursor_class = cursor_class
+        self.execute = cursor_class.execute
+
+    def __enter__(self):
+        execute = self.execute
+
+        def counting_execute(cursor, *args, **kwargs):
+            _local.queries = getattr(_local, 'queries', 0) + 1
+            return execute(cursor, *args, **kwargs)
+        self.cursor_class.execute = counting_execute
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.cursor_class.execute = self.execute
+
+
+def _prepare(fixtures, options):
+    "Create the records to load and return (sale ids, shipment ids, context)"
+    from trytond.tests.test_tryton import DB_NAME, USER, CONTEXT
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+
+    with Transaction().start(DB_NAME, USER, context=CONTEXT) as transaction:
+        fixtures.setup_defaults()
+        Shipment = Pool().get('stock.shipment.out')
+
+        sales = create_sales(fixtures, options.sales, options.lines)
+        shipments = create_shipments(
+            fixtures, options.shipments, options.packages
+        )
+        # Labels are only generated for packed shipments
+        Shipment.write(shipments, {'state': 'packed'})
+        context = {'company': fixtures.company.id}
+        result = (
+            map(int, sales), map(int, shipments), context,
+            fixtures.carrier.id, fixtures.ups_next_day_air,
+        )
+        transaction.commit()
+    return result
+
+
+def _rate(sale_id, carrier_id, service_id):
+    from trytond.pool import Pool
+    pool = Pool()
+    Sale = pool.get('sale.sale')
+    Carrier = pool.get('carrier')
+    Service = pool.get('carrier.service')
+
+    Sale(sale_id).get_shipping_rate(Carrier(carrier_id), Service(service_id))
+
+
+def _label(shipment_id):
+    from trytond.pool import Pool
+    Shipment = Pool().get('stock.shipment.out')
+
+    Shipment(shipment_id).generate_shipping_labels()
+
+
+def _run_task(task):
+    from trytond.tests.test_tryton import DB_NAME, USER
+    from trytond.transaction import Transaction
+
+    kind, args, context = task
+    _local.queries = 0
+    error = None
+    start = time.time()
+    try:
+        with Transaction().start(
+                DB_NAME, USER, readonly=(kind == 'rate'),
+                context=context) as transaction:
+            if kind == 'rate':
+                _rate(*args)
+            else:
+                _label(*args)
+                transaction.commit()
+    except Exception, e:
+        error = '%s: %s' % (e.__class__.__name__, unicode(e)[:200])
+    return kind, time.time() - start, _local.queries, error
+
+
+def _summarize(results, wall_time):
+    from trytond.modules.shipping_ups.metrics import percentile
+
+    summary = {}
+    for kind in sorted(set(r[0] for r in results)):
+        done = [r for r in results if r[0] == kind]
+        ok = [r for r in done if r[3] is None]
+        durations = [r[1] for r in ok]
+        queries = [r[2] for r in ok]
+        errors = {}
+        for r in done:
+            if r[3] is not None:
+                errors[r[3]] = errors.get(r[3], 0) + 1
+        summary[kind] = {
+            'calls': len(done),
+            'succeeded': len(ok),
+            'throughput': len(ok) / wall_time if wall_time else None,
+            'latency': dict(
+                ('p%d' % p, percentile(durations, p)) for p in (50, 95, 99)
+            ),
+            'queries': {
+                'mean': (
+                    float(sum(queries)) / len(queries) if queries else None
+                ),
+                'p95': percentile(queries, 95),
+            },
+            'errors': errors,
+        }
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sales', type=int, default=1000)
+    parser.add_argument(
+        '--lines', type=int, default=3, help='Lines per sale')
+    parser.add_argument('--shipments', type=int, default=1000)
+    parser.add_argument(
+        '--packages', type=int, default=2, help='Packages per shipment')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument(
+        '--ups-latency', type=float, default=0.1,
+        help='Seconds the UPS stand-in waits before answering')
+    parser.add_argument(
+        '--ups-jitter', type=float, default=0.05,
+        help='Random extra seconds added to the latency')
+    parser.add_argument('--output', help='Write the JSON report there')
+    parser.add_argument(
+        '--keep', action='store_true', help='Do not drop the database')
+    options = parser.parse_args(argv)
+
+    # Worker threads need a database they can share
+    tmp_dir = tempfile.mkdtemp(prefix='ups-load-')
+    setup_environ(db_name='ups_load_%d' % int(time.time()))
+    from trytond.config import config
+    from trytond.modules.shipping_ups.tests import test_ups  # noqa
+    from trytond.modules.shipping_ups.metrics import registry
+    config.set('database', 'path', tmp_dir)
+
+    stand_in = UPSStandIn(options.ups_latency, options.ups_jitter).start()
+    if not config.has_section('ups'):
+        config.add_section('ups')
+    config.set('ups', 'base_url', stand_in.url)
+    config.set('ups', 'metrics', 'True')
+
+    fixtures = get_test_case()
+    try:
+        sys.stderr.write('Creating %d sales and %d shipments\n' % (
+            options.sales, options.shipments
+        ))
+        sale_ids, shipment_ids, context, carrier_id, service_id = \
+            _prepare(fixtures, options)
+
+        tasks = [
+            ('rate', (sale_id, carrier_id, service_id), context)
+            for sale_id in sale_ids
+        ] + [
+            ('label', (shipment_id,), context)
+            for shipment_id in shipment_ids
+        ]
+        random.shuffle(tasks)
+
+        from trytond.tests.test_tryton import DB_NAME, USER
+        from trytond.transaction import Transaction
+        with Transaction().start(DB_NAME, USER):
+            cursor_class = type(Transaction().connection.cursor())
+
+        sys.stderr.write('Running %d calls on %d workers\n' % (
+            len(tasks), options.workers
+        ))
+        registry.reset()
+        pool = ThreadPool(options.workers)
+        with _QueryCounter(cursor_class):
+            start = time.time()
+            results = pool.map(_run_task, tasks, chunksize=1)
+            wall_time = time.time() - start
+        pool.close()
+        pool.join()
+    finally:
+        stand_in.stop()
+        if not options.keep:
+            from trytond.tests.test_tryton import drop_db
+            drop_db()
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        else:
+            sys.stderr.write('Database kept in %s\n' % tmp_dir)
+
+    report = {
+        'options': vars(options),
+        'wall_time': wall_time,
+        'calls': _summarize(results, wall_time),
+        'ups': registry.snapshot(),
+    }
+    if options.output:
+        with open(options.output, 'wb') as file_obj:
+            json.dump(report, file_obj, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks/run.py
+
+    Measure the UPS request builders and response parsers on synthetic
+    shipments of 1, 10, 100 and 500 packages.
+
+    Results are written as JSON, one entry per case and size, and can be
+    compared with the results of another revision::
+
+        python -m benchmarks.run --output base.json
+        python -m benchmarks.run --compare base.json --threshold 0.2
+
+"""
+import gc
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+
+from benchmarks.fixtures import setup_environ, get_test_case, \
+    create_shipment, create_shipments, create_sale, load_payload, \
+    process_label
+
+SIZES = (1, 10, 100, 500)
+
+#: Size in bytes of the label images of the recorded accept response
+LABEL_SIZE = 30 * 1024
+
+
+def _shipment_case(method, worldship=False):
+    def case(fixtures, size):
+        from trytond.pool import Pool
+        Shipment = Pool().get('stock.shipment.out')
+
+        shipment_id = create_shipment(fixtures, size, worldship).id
+
+        def setup():
+            return Shipment(shipment_id)
+        return setup, method
+    return case
+
+
+def _rate_request_xml(shipment):
+    shipment._get_rate_request_xml(shipment.carrier, shipment.carrier_service)
+
+
+def _confirm_xml(shipment):
+    shipment._get_shipment_confirm_xml()
+
+
+def _package_containers(shipment):
+    for package in shipment.packages:
+        package.get_ups_package_container()
+
+
+def _package_containers_rate(shipment):
+    for package in shipment.packages:
+        package.get_ups_package_container_rate()
+
+
+def _worldship_xml(shipment):
+    shipment.get_worldship_xml()
+
+
+def _sale_rate_request_xml(fixtures, size):
+    from trytond.pool import Pool
+    Sale = Pool().get('sale.sale')
+
+    sale_id = create_sale(fixtures, size).id
+
+    def setup():
+        return Sale(sale_id)
+
+    def run(sale):
+        sale._get_rate_request_xml(sale.carrier, sale.carrier_service)
+    return setup, run
+
+
+def _sale_rate_packages(fixtures, size):
+    "Packing of the lines into the box types of the carrier"
+    from trytond.pool import Pool
+    pool = Pool()
+    Sale = pool.get('sale.sale')
+    BoxType = pool.get('carrier.box_type')
+    Template = pool.get('product.template')
+    ModelData = pool.get('ir.model.data')
+
+    uom_inch = ModelData.get_id('product', 'uom_inch')
+    for xml_id, side in [('ups_2a', 12), ('ups_2b', 18), ('ups_2c', 24)]:
+        BoxType.write([BoxType(ModelData.get_id('shipping_ups', xml_id))], {
+            'length': side, 'width': side, 'height': side,
+            'distance_unit': uom_inch,
+        })
+    Template.write([fixtures.product.template], {
+        'length': 10, 'length_uom': uom_inch,
+        'width': 6, 'width_uom': uom_inch,
+        'height': 4, 'height_uom': uom_inch,
+    })
+    sale_id = create_sale(fixtures, size).id
+
+    def setup():
+        return Sale(sale_id)
+
+    def run(sale):
+        sale._get_ups_rate_packages(sale.carrier)
+    return setup, run
+
+
+def _parse_rate_response(fixtures, size):
+    from lxml import objectify
+    from ups.rating_package import RatingService
+    from trytond.pool import Pool
+    Shipment = Pool().get('stock.shipment.out')
+
+    shipment_id = create_shipment(fixtures, 1).id
+    payload = load_payload('rate_response', size, 'RatedPackage')
+
+    def setup():
+        return Shipment(shipment_id)
+
+    def run(shipment):
+        response = objectify.fromstring(payload)
+        RatingService.look_for_error(response)
+        shipment._get_ups_rates(shipment.carrier, response)
+    return setup, run
+
+
+def _parse_accept_response(fixtures, size):
+    import base64
+    from itertools import izip
+    from trytond.pool import Pool
+    from trytond.modules.shipping_ups.accept_response import parse_header, \
+        iter_package_results
+    Shipment = Pool().get('stock.shipment.out')
+
+    shipment_id = create_shipment(fixtures, size).id
+    payload = load_payload(
+        'accept_response', size, 'PackageResults', LABEL_SIZE
+    )
+
+    def setup():
+        return Shipment(shipment_id)
+
+    def run(shipment):
+        results = parse_header(payload).ShipmentResults
+        shipment._get_ups_shipment_cost(results)
+        for package, result in izip(
+                shipment.packages, iter_package_results(payload)):
+            unicode(result.TrackingNumber.text)
+            data = package._process_raw_label(
+                result.LabelImage.GraphicImage.text
+            )
+            buffer(base64.decodestring(data))
+    return setup, run
+
+
+def _process_labels(fixtures, size):
+    from trytond.modules.shipping_ups.label_processing import submit
+
+    label = 'GIF89a' + ''.join(chr(i % 251) for i in xrange(LABEL_SIZE))
+
+    def run(record):
+        pending = [submit(process_label, label) for _ in xrange(size)]
+        for result in pending:
+            result.get()
+    return lambda: None, run
+
+
+def _reconcile_billing(fixtures, size):
+    "Reconciliation of 3 charges per package of size 2 packages shipments"
+    from io import BytesIO
+    from decimal import Decimal
+    from trytond.pool import Pool
+    from trytond.modules.shipping_ups.invoice_reconciliation import \
+        iter_billing_records
+    pool = Pool()
+    Reconciliation = pool.get('shipping.ups.invoice.reconciliation')
+    Shipment = pool.get('stock.shipment.out')
+    Tracking = pool.get('shipment.tracking')
+
+    shipments = create_shipments(fixtures, size, 2)
+    Shipment.write(shipments, {'cost': Decimal('12.00')})
+    packages = [p for s in shipments for p in s.packages]
+    Tracking.create([{
+        'carrier': fixtures.carrier.id,
+        'tracking_number': '1ZBILL%d' % package.id,
+        'origin': str(package),
+    } for package in packages])
+    rows = [
+        'Tracking Number,Charge Category Code,Charge Description,'
+        'Invoice Currency Code,Net Amount'
+    ]
+    for package in packages:
+        rows.extend([
+            '1ZBILL%d,SHP,Ground,USD,5.00' % package.id,
+            '1ZBILL%d,SHP,Fuel Surcharge,USD,1.00' % package.id,
+            '1ZBILL%d,ADJ,Shipping Charge Correction,USD,0.50' % package.id,
+        ])
+    data = '\n'.join(rows)
+
+    def run(_):
+        Reconciliation.reconcile(
+            'Benchmark', iter_billing_records(BytesIO(data))
+        )
+    return lambda: None, run
+
+
+CASES = [
+    ('sale.rate_request_xml', _sale_rate_request_xml),
+    ('sale.rate_packages', _sale_rate_packages),
+    ('shipment.rate_request_xml', _shipment_case(_rate_request_xml)),
+    ('shipment.confirm_xml', _shipment_case(_confirm_xml)),
+    ('package.container', _shipment_case(_package_containers)),
+    ('package.container_rate', _shipment_case(_package_containers_rate)),
+    ('shipment.worldship_xml', _shipment_case(_worldship_xml, True)),
+    ('parse.rate_response', _parse_rate_response),
+    ('parse.accept_response', _parse_accept_response),
+    ('process.labels', _process_labels),
+    ('reconcile.billing_file', _reconcile_billing),
+]
+
+
+def measure(setup, run, repeat):
+    """
+    Return the durations of repeat runs. Each run starts with an empty
+    transaction cache so records are read from the database as they would
+    be by a fresh request.
+    """
+    from trytond.transaction import Transaction
+
+    durations = []
+    for _ in xrange(repeat):
+        Transaction().cache.clear()
+        record = setup()
+        gc.collect()
+        start = time.time()
+        run(record)
+        durations.append(time.time() - start)
+    return durations
+
+
+def run_cases(names=None, sizes=SIZES, repeat=5):
+    """
+    Run the benchmark cases and return their results. A case which fails
+    is reported with its error instead of timings.
+    """
+    from trytond.tests.test_tryton import DB_NAME, USER, CONTEXT
+    from trytond.transaction import Transaction
+
+    fixtures = get_test_case()
+    results = []
+    with Transaction().start(DB_NAME, USER, context=CONTEXT) as transaction:
+        fixtures.setup_defaults()
+        with transaction.set_context(company=fixtures.company.id):
+            for name, case in CASES:
+                if names and name not in names:
+                    continue
+                for size in sizes:
+                    result = {'name': name, 'packages': size}
+                    try:
+                        durations = measure(
+                            *case(fixtures, size), repeat=repeat
+                        )
+                    except Exception, e:
+                        result['error'] = '%s: %s' % (
+                            e.__class__.__name__, e
+                        )
+                    else:
+                        durations.sort()
+                        median = durations[len(durations) // 2]
+                        result.update({
+                            'repeat': repeat,
+                            'min': durations[0],
+                            'median': median,
+                            'max': durations[-1],
+                            'ops_per_sec': 1 / median if median else None,
+                        })
+                    results.append(result)
+                    sys.stderr.write('%s\n' % _format(result))
+        transaction.rollback()
+    return results
+
+
+def _revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _format(result):
+    if 'error' in result:
+        return '%-28s %4d  ERROR %s' % (
+            result['name'], result['packages'], result['error']
+        )
+    return '%-28s %4d  median %9.3f ms  min %9.3f ms' % (
+        result['name'], result['packages'],
+        result['median'] * 1000, result['min'] * 1000
+    )
+
+
+def compare(results, baseline, threshold):
+    """
+    Return (name, packages, ratio) for the results whose median is slower
+    than the baseline by more than threshold (0.2 for 20%).
+    """
+    base = dict(
+        ((r['name'], r['packages']), r) for r in baseline['results']
+        if 'median' in r
+    )
+    regressions = []
+    for result in results:
+        reference = base.get((result['name'], result['packages']))
+        if not reference or 'median' not in result \
+                or not reference['median']:
+            continue
+        ratio = result['median'] / reference['median']
+        if ratio > 1 + threshold:
+            regressions.append((result['name'], result['packages'], ratio))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument(
+        '--sizes', default=','.join(map(str, SIZES)),
+        help='Comma separated numbers of packages')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument(
+        '--case', action='append', dest='cases',
+        choices=[name for name, _ in CASES],
+        help='Only run this case, can be repeated')
+    parser.add_argument('--output', help='Write the JSON results there')
+    parser.add_argument(
+        '--compare', help='JSON results of a previous run to compare with')
+    parser.add_argument(
+        '--threshold', type=float, default=0.2,
+        help='Slowdown ratio reported as a regression')
+    parser.add_argument(
+        '--label-processes', type=int, default=0,
+        help='Size of the pool of label processes')
+    options = parser.parse_args(argv)
+
+    setup_environ()
+    if options.label_processes:
+        from trytond.config import config
+        if not config.has_section('ups'):
+            config.add_section('ups')
+        config.set('ups', 'label_processes', str(options.label_processes))
+    results = run_cases(
+        options.cases, map(int, options.sizes.split(',')), options.repeat
+    )
+    report = {
+        'revision': _revision(),
+        'python': platform.python_version(),
+        'timestamp': time.time(),
+        'results': results,
+    }
+    if options.output:
+        with open(options.output, 'wb') as file_obj:
+            json.dump(report, file_obj, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+    if options.compare:
+        with open(options.compare, 'rb') as file_obj:
+            regressions = compare(
+                results, json.load(file_obj), options.threshold
+            )
+        for name, packages, ratio in regressions:
+            sys.stderr.write('REGRESSION %s %d packages: %.2fx slower\n' % (
+                name, packages, ratio
+            ))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmarks/ups_server.py
+
+    Local stand-in of the UPS XML API answering rate, confirm and accept
+    requests with the recorded payloads. Point the module at it with::
+
+        [ups]
+        base_url = http://127.0.0.1:<port>
+
+"""
+import re
+import copy
+import time
+import random
+import itertools
+from threading import Thread, Lock
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+from lxml import etree
+
+from benchmarks.fixtures import PAYLOADS_DIR, load_payload
+
+__all__ = ['UPSStandIn']
+
+_DIGEST_RE = re.compile(r'<ShipmentDigest>load-(\d+)-\d+</ShipmentDigest>')
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        server = self.server.stand_in
+        length = int(self.headers.getheader('content-length') or 0)
+        body = self.rfile.read(length)
+        server.wait()
+
+        call = self.path.rsplit('/', 1)[-1]
+        handler = {
+            'Rate': server.rate_response,
+            'ShipConfirm': server.confirm_response,
+            'ShipAccept': server.accept_response,
+        }.get(call)
+        if handler is None:
+            self.send_error(404)
+            return
+        response = handler(body)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class UPSStandIn(object):
+    """
+    Threaded HTTP server answering like UPS after latency seconds (plus a
+    uniform jitter). Every accept response holds new tracking numbers.
+    """
+
+    def __init__(self, latency=0, jitter=0, label_size=30 * 1024):
+        self.latency = latency
+        self.jitter = jitter
+        self.label_size = label_size
+        self._counter = itertools.count(1)
+        self._lock = Lock()
+        self._rate = load_payload('rate_response', 1, 'RatedPackage')
+        self._confirm = etree.parse(
+            '%s/confirm_response.xml' % PAYLOADS_DIR
+        ).getroot()
+        self._accept = etree.fromstring(load_payload(
+            'accept_response', 1, 'PackageResults', label_size
+        ))
+        self._server = None
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self._server.server_address
+
+    def start(self):
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self._server.stand_in = self
+        thread = Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def wait(self):
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+
+    def _next(self):
+        with self._lock:
+            return next(self._counter)
+
+    def rate_response(self, body):
+        return self._rate
+
+    def confirm_response(self, body):
+        # The accept request only holds the digest, it carries the number of
+        # packages to answer with
+        packages = body.count('<Package>')
+        root = copy.deepcopy(self._confirm)
+        root.find('ShipmentDigest').text = 'load-%d-%d' % (
+            packages, self._next()
+        )
+        return etree.tostring(root)
+
+    def accept_response(self, body):
+        match = _DIGEST_RE.search(body)
+        packages = int(match.group(1)) if match else 1
+        root = copy.deepcopy(self._accept)
+        results = root.find('ShipmentResults')
+        template = results.find('PackageResults')
+        for _ in xrange(packages - 1):
+            template.addnext(copy.deepcopy(template))
+        for element in results.iterfind('PackageResults'):
+            element.find('TrackingNumber').text = \
+                '1ZLOAD%012d' % self._next()
+        # As UPS, the shipment is identified by its lead tracking number
+        results.find('ShipmentIdentificationNumber').text = \
+            template.findtext('TrackingNumber')
+        return etree.tostring(root)
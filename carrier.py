@@ -3,16 +3,64 @@
     carrier
 
 """
+import math
+from functools import partial
+
+from logbook import Logger
 from trytond.model import fields
 from trytond.pool import PoolMeta, Pool
-from trytond.pyson import Eval
-from ups.shipping_package import ShipmentConfirm, ShipmentAccept, ShipmentVoid
-from ups.rating_package import RatingService
-from ups.address_validation import AddressValidation
+from trytond.pyson import Eval, Bool, Id
+from trytond.rpc import RPC
+from trytond.config import config
+from trytond.cache import Cache
+from lxml.builder import E
+
+from metrics import instrument, registry
+from cartonization import Box, Item
+from rate_shopping import call_all, get_timeout
+from ups_api import ups
 
-__all__ = ['Carrier', 'CarrierService', 'BoxType']
+__all__ = ['Carrier', 'CarrierService', 'BoxType', 'UOM']
 __metaclass__ = PoolMeta
 
+logger = Logger('trytond_ups')
+
+#: Units of the UPS UOM systems
+UOM_SYSTEMS = {
+    '00': {  # Metric
+        'weight': 'kg',
+        'length': 'cm',
+        'weight_uom_code': 'KGS',
+        'length_uom_code': 'cm',
+        # Maximum weight of a package
+        'max_weight': 70,
+        # Volume per unit of dimensional weight
+        'dim_divisor': 5000,
+    },
+    '01': {  # English
+        'weight': 'lb',
+        'length': 'in',
+        'weight_uom_code': 'LBS',
+        'length_uom_code': 'in',
+        'max_weight': 150,
+        'dim_divisor': 139,
+    },
+}
+
+
+#: Label formats of UPS: (print method, image format, file extension).
+#: GIF labels keep the png extension, :meth:`Package._process_raw_label` is
+#: expected to convert them.
+LABEL_FORMATS = {
+    'GIF': ('GIF', 'GIF', 'png'),
+    'PNG': ('GIF', 'PNG', 'png'),
+    'ZPL': ('ZPL', None, 'zpl'),
+    'EPL': ('EPL', None, 'epl'),
+}
+
+#: Formats of the thermal printers, stored as sent by UPS
+THERMAL_LABEL_FORMATS = ('ZPL', 'EPL')
+
 
 class Carrier:
     "Carrier"
@@ -79,6 +127,28 @@ class Carrier:
         'readonly': Eval('carrier_cost_method') != 'ups',
         'invisible': Eval('carrier_cost_method') != 'ups',
     }, depends=['carrier_cost_method'])
+    ups_label_format = fields.Selection([
+        ('GIF', 'GIF'),
+        ('PNG', 'PNG'),
+        ('ZPL', 'ZPL (Zebra)'),
+        ('EPL', 'EPL (Eltron)'),
+    ], 'Label Format', states={
+        'required': Eval('carrier_cost_method') == 'ups',
+        'readonly': Eval('carrier_cost_method') != 'ups',
+        'invisible': Eval('carrier_cost_method') != 'ups',
+    }, depends=['carrier_cost_method'],
+        help="Thermal labels (ZPL, EPL) are stored as sent by UPS and can "
+        "be sent to the printer as is")
+    ups_confirm_at_pack = fields.Boolean(
+        'Confirm at Pack',
+        states={
+            'readonly': Eval('carrier_cost_method') != 'ups',
+            'invisible': Eval('carrier_cost_method') != 'ups',
+        },
+        depends=['carrier_cost_method'],
+        help="Confirm packed shipments in the background so only the "
+        "accept request is left when their labels are generated"
+    )
     ups_weight_uom = fields.Function(
         fields.Many2One(
             'product.uom', 'Weight UOM',
@@ -109,6 +179,29 @@ class Carrier:
         'get_ups_default_uom'
     )
 
+    # WorldShip XML auto import/export
+    ups_worldship_shipments_dir = fields.Char(
+        'WorldShip Shipments Folder',
+        help='Folder where packed shipments are dropped for the XML auto '
+        'import of WorldShip',
+        states={
+            'invisible': Eval('carrier_cost_method') != 'ups_worldship',
+        },
+        depends=['carrier_cost_method']
+    )
+    ups_worldship_results_dir = fields.Char(
+        'WorldShip Results Folder',
+        help='Folder where WorldShip exports the processed shipments, they '
+        'are moved to its "archive" subfolder once imported or to "error" '
+        'when they can not be read',
+        states={
+            'invisible': Eval('carrier_cost_method') != 'ups_worldship',
+        },
+        depends=['carrier_cost_method']
+    )
+
+    _ups_uom_cache = Cache('carrier.ups_uom', context=False)
+
     @classmethod
     def __setup__(cls):
         super(Carrier, cls).__setup__()
@@ -124,6 +217,10 @@ class Carrier:
             'ups_credentials_required':
                 'UPS settings on UPS configuration are incomplete.',
         })
+        cls.__rpc__.update({
+            'get_ups_metrics': RPC(readonly=True),
+            'get_ups_metrics_prometheus': RPC(readonly=True),
+        })
 
     def _get_ups_service_name(self, service):
         """
@@ -140,43 +237,251 @@ class Carrier:
     def default_ups_uom_system():
         return '01'
 
-    def get_ups_default_uom(self, name):
+    @staticmethod
+    def default_ups_label_format():
+        # The labels printed in PDF batches must be PNG images
+        return 'PNG'
+
+    @property
+    def ups_thermal_label(self):
+        "Return True if the labels are printed on a thermal printer"
+        return self.ups_label_format in THERMAL_LABEL_FORMATS
+
+    @property
+    def ups_label_extension(self):
+        "Return the file extension of the labels"
+        return LABEL_FORMATS[self.ups_label_format or 'GIF'][2]
+
+    def get_ups_label_specification(self):
         """
-        Return default UOM on basis of uom_system
+        Return the LabelSpecification element of the shipment confirm
+        request for the label format of the carrier
         """
-        UOM = Pool().get('product.uom')
+        print_method, image_format, _ = \
+            LABEL_FORMATS[self.ups_label_format or 'GIF']
+        elements = [
+            ups.ShipmentConfirm.label_print_method_type(Code=print_method),
+        ]
+        if image_format:
+            elements.append(
+                ups.ShipmentConfirm.label_image_format_type(Code=image_format)
+            )
+        else:
+            # Thermal labels require the size of the label stock (inches)
+            elements.append(E.LabelStockSize(E.Height('4'), E.Width('6')))
+        return ups.ShipmentConfirm.label_specification_type(*elements)
 
-        uom_map = {
-            '00': {  # Metric
-                'weight': 'kg',
-                'length': 'cm',
-            },
-            '01': {  # English
-                'weight': 'lb',
-                'length': 'in',
+    @classmethod
+    def _get_ups_uom_table(cls):
+        """
+        Return the UOM table of the UPS systems::
+
+            {
+                'symbols': {'kg': 1, 'lb': 2, ...},
+                'uoms': {uom id: (category id, accurate field, factor,
+                    rate, rounding), ...},
             }
+
+        `uoms` holds every UOM of the weight and length categories so that
+        quantities can be converted without reading the database. The table
+        is built once and cached until a UOM is modified.
+        """
+        UOM = Pool().get('product.uom')
+
+        table = cls._ups_uom_cache.get('table')
+        if table is not None:
+            return table
+
+        symbols = set()
+        for values in UOM_SYSTEMS.values():
+            symbols.update([values['weight'], values['length']])
+        system_uoms = UOM.search([('symbol', 'in', list(symbols))])
+        table = {
+            'symbols': {},
+            'uoms': {},
         }
+        for uom in system_uoms:
+            table['symbols'].setdefault(uom.symbol, uom.id)
+        for uom in UOM.search([
+                ('category', 'in', list(set(
+                    u.category.id for u in system_uoms
+                ))),
+                ]):
+            table['uoms'][uom.id] = (
+                uom.category.id, uom.accurate_field, uom.factor, uom.rate,
+                uom.rounding,
+            )
+        cls._ups_uom_cache.set('table', table)
+        return table
 
-        return UOM.search([
-            ('symbol', '=', uom_map[self.ups_uom_system][name[4:-4]])
-        ])[0].id
+    @classmethod
+    def get_ups_default_uom(cls, carriers, names):
+        """
+        Return default UOM on basis of uom_system
+        """
+        symbols = cls._get_ups_uom_table()['symbols']
 
-    def get_ups_uom_code(self, name):
+        result = {}
+        for name in names:
+            result[name] = values = {}
+            for carrier in carriers:
+                system = UOM_SYSTEMS.get(carrier.ups_uom_system)
+                values[carrier.id] = system and symbols.get(
+                    system[name[4:-4]]
+                )
+        return result
+
+    @classmethod
+    def get_ups_uom_code(cls, carriers, names):
         """
         Return UOM code names depending on the system
         """
-        uom_map = {
-            '00': {  # Metric
-                'weight_uom_code': 'KGS',
-                'length_uom_code': 'cm',
-            },
-            '01': {  # English
-                'weight_uom_code': 'LBS',
-                'length_uom_code': 'in',
-            }
-        }
+        result = {}
+        for name in names:
+            result[name] = values = {}
+            for carrier in carriers:
+                system = UOM_SYSTEMS.get(carrier.ups_uom_system)
+                values[carrier.id] = system and system[name[4:]]
+        return result
 
-        return uom_map[self.ups_uom_system][name[4:]]
+    def ups_convert_weight(self, weight, from_uom):
+        """
+        Convert weight from from_uom to the weight UOM of the UPS system of
+        the carrier. This gives the same result as `compute_qty` but uses
+        the cached UOM table instead of reading the UOMs.
+        """
+        return self._ups_convert(weight, from_uom, self.ups_weight_uom)
+
+    def ups_convert_length(self, length, from_uom):
+        "Convert length from from_uom to the length UOM of the carrier"
+        return self._ups_convert(length, from_uom, self.ups_length_uom)
+
+    def _ups_convert(self, quantity, from_uom, to_uom):
+        UOM = Pool().get('product.uom')
+
+        uoms = self._get_ups_uom_table()['uoms']
+        if not quantity or from_uom is None or to_uom is None \
+                or from_uom.id not in uoms or to_uom.id not in uoms:
+            return UOM.compute_qty(from_uom, quantity, to_uom)
+
+        from_category, from_field, from_factor, from_rate, _ = \
+            uoms[from_uom.id]
+        to_category, to_field, to_factor, to_rate, rounding = uoms[to_uom.id]
+        if from_category != to_category:
+            return UOM.compute_qty(from_uom, quantity, to_uom)
+
+        if from_field == 'factor':
+            amount = quantity * from_factor
+        else:
+            amount = quantity / from_rate
+        if to_field == 'factor':
+            amount = amount / to_factor
+        else:
+            amount = amount * to_rate
+        return UOM(rounding=rounding).round(amount)
+
+    @property
+    def ups_max_weight(self):
+        "Maximum weight of a package in the weight UOM of the carrier"
+        system = UOM_SYSTEMS.get(self.ups_uom_system)
+        return system and system['max_weight']
+
+    @property
+    def ups_dim_divisor(self):
+        "Volume of a unit of dimensional weight in the UOMs of the carrier"
+        system = UOM_SYSTEMS.get(self.ups_uom_system)
+        return system and system['dim_divisor']
+
+    def get_ups_boxes(self):
+        """
+        Return the UPS box types of the carrier with dimensions as
+        cartonization boxes, in the UOMs of the carrier.
+        """
+        boxes = []
+        for box_type in self.box_types:
+            if box_type.carrier_cost_method != 'ups' or not all([
+                    box_type.length, box_type.width, box_type.height,
+                    box_type.distance_unit]):
+                continue
+            dimensions = sorted([
+                self.ups_convert_length(value, box_type.distance_unit)
+                for value in (
+                    box_type.length, box_type.width, box_type.height
+                )
+            ], reverse=True)
+            max_weight = None
+            if box_type.max_weight and box_type.weight_uom:
+                max_weight = self.ups_convert_weight(
+                    box_type.max_weight, box_type.weight_uom
+                )
+            boxes.append(Box(box_type.id, tuple(dimensions), max_weight))
+        return boxes
+
+    def get_ups_cartonization_items(self, lines):
+        """
+        Return the cartonization items of lines, dictionaries of the id,
+        product, quantity and unit (ids) of a sale line or move: one per
+        line, with the quantity in whole units of the product and the weight
+        and dimensions of one unit in the UOMs of the carrier.
+        """
+        pool = Pool()
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+        UOM = pool.get('product.uom')
+
+        products = Product.read(
+            list(set(l['product'] for l in lines)), ['template']
+        )
+        templates = dict((t['id'], t) for t in Template.read(
+            list(set(p['template'] for p in products)), [
+                'type', 'default_uom', 'weight', 'weight_uom',
+                'length', 'length_uom', 'width', 'width_uom',
+                'height', 'height_uom',
+            ]))
+        templates = dict(
+            (p['id'], templates[p['template']]) for p in products
+        )
+
+        factors = {}
+
+        def factor(from_uom, to_uom):
+            "Return the ratio converting from_uom to to_uom"
+            key = (from_uom, to_uom)
+            if key not in factors:
+                factors[key] = UOM.compute_qty(
+                    UOM(from_uom), 1, UOM(to_uom), round=False
+                )
+            return factors[key]
+
+        length_uom = self.ups_length_uom.id
+        weight_uom = self.ups_weight_uom.id
+        items = []
+        for line in lines:
+            template = templates[line['product']]
+            if template['type'] == 'service':
+                continue
+            quantity = line['quantity']
+            if line['unit'] != template['default_uom']:
+                quantity *= factor(line['unit'], template['default_uom'])
+            units = int(math.ceil(quantity))
+            if not units:
+                continue
+            dimensions = None
+            if all(
+                    template[name] and template[name + '_uom']
+                    for name in ('length', 'width', 'height')):
+                dimensions = tuple(sorted([
+                    template[name] * factor(
+                        template[name + '_uom'], length_uom
+                    ) for name in ('length', 'width', 'height')
+                ], reverse=True))
+            weight = 0
+            if template['weight'] and template['weight_uom']:
+                weight = template['weight'] * quantity * factor(
+                    template['weight_uom'], weight_uom
+                ) / units
+            items.append(Item(line['id'], units, dimensions, weight))
+        return items
 
     def ups_api_instance(self, call='confirm', return_xml=False):
         """Return Instance of UPS
@@ -190,26 +495,99 @@ class Carrier:
             self.raise_user_error('ups_credentials_required')
 
         if call == 'confirm':
-            call_method = ShipmentConfirm
+            call_method = ups.ShipmentConfirm
         elif call == 'accept':
-            call_method = ShipmentAccept
+            call_method = ups.ShipmentAccept
         elif call == 'void':
-            call_method = ShipmentVoid
+            call_method = ups.ShipmentVoid
         elif call == 'rate':
-            call_method = RatingService
+            call_method = ups.RatingService
         elif call == 'address_val':
-            call_method = AddressValidation
+            call_method = ups.AddressValidation
         else:
             call_method = None
 
         if call_method:
-            return call_method(
+            client = call_method(
                 license_no=self.ups_license_key,
                 user_id=self.ups_user_id,
                 password=self.ups_password,
                 sandbox=self.ups_is_test,
                 return_xml=return_xml
             )
+            base_url = config.get('ups', 'base_url')
+            if base_url:
+                # Send the requests to a proxy or a stand-in of UPS
+                client.base_url = {
+                    'sandbox': base_url,
+                    'production': base_url,
+                }
+            return instrument(client, self.id, call)
+
+    @classmethod
+    def shop_ups_rates(cls, carriers, record, timeout=None):
+        """
+        Rate record, a sale or a customer shipment, with all the services
+        of the UPS carriers and return the rates, cheapest first.
+
+        The requests of the carriers are sent concurrently, the carriers
+        failing or not answering within timeout seconds (the
+        `rate_shopping_timeout` of the `ups` section by default) are left
+        out.
+        """
+        Currency = Pool().get('currency.currency')
+
+        if timeout is None:
+            timeout = get_timeout()
+        carriers = [c for c in carriers if c.carrier_cost_method == 'ups']
+
+        # Elements which do not depend on the account are built once
+        ups_cache = {}
+        requests = []
+        for carrier in carriers:
+            rate_request = record._get_rate_request_xml(
+                carrier, None, ups_cache
+            )
+            rate_api = carrier.ups_api_instance(call='rate')
+            requests.append(partial(rate_api.request, rate_request))
+
+        rates = []
+        for carrier, result in zip(carriers, call_all(requests, timeout)):
+            if result is None:
+                logger.warning(
+                    'Rate request of carrier %s timed out' % carrier.id
+                )
+                continue
+            response, exception = result
+            if exception is not None:
+                logger.warning(
+                    'Rate request of carrier %s failed: %s'
+                    % (carrier.id, exception)
+                )
+                continue
+            record._record_ups_rates(carrier, response)
+            rates.extend(record._get_ups_rates(carrier, response))
+
+        currency = record.company.currency
+        return sorted(rates, key=lambda rate: Currency.compute(
+            rate['cost_currency'], rate['cost'], currency, round=False
+        ))
+
+    @classmethod
+    def get_ups_metrics(cls):
+        """
+        Return the metrics of the UPS requests sent by this server process,
+        one dictionary per carrier and call type. Metrics are only collected
+        when `metrics` is set in the `ups` section of the configuration.
+        """
+        return registry.snapshot()
+
+    @classmethod
+    def get_ups_metrics_prometheus(cls):
+        """
+        Return the metrics of the UPS requests in the Prometheus text format
+        """
+        return registry.to_prometheus()
 
     @classmethod
     def view_attributes(cls):
@@ -218,6 +596,11 @@ class Carrier:
                 '//group[@id="ups_configuration"]', 'states', {
                     'invisible': Eval('carrier_cost_method') != 'ups'
                 }
+            ), (
+                '//group[@id="ups_worldship_configuration"]', 'states', {
+                    'invisible':
+                        Eval('carrier_cost_method') != 'ups_worldship'
+                }
             )
         ]
 
@@ -240,6 +623,17 @@ class CarrierService:
 class BoxType:
     __name__ = "carrier.box_type"
 
+    max_weight = fields.Float(
+        'Maximum Weight', help='Maximum weight of a package of this box'
+    )
+    weight_uom = fields.Many2One(
+        'product.uom', 'Weight Unit', states={
+            'required': Bool(Eval('max_weight')),
+        }, domain=[
+            ('category', '=', Id('product', 'uom_cat_weight'))
+        ], depends=['max_weight']
+    )
+
     @classmethod
     def __setup__(cls):
         super(BoxType, cls).__setup__()
@@ -250,3 +644,22 @@ class BoxType:
         ]:
             if selection not in cls.carrier_cost_method.selection:
                 cls.carrier_cost_method.selection.append(selection)
+
+
+class UOM:
+    __name__ = 'product.uom'
+
+    @classmethod
+    def create(cls, vlist):
+        Pool().get('carrier')._ups_uom_cache.clear()
+        return super(UOM, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        Pool().get('carrier')._ups_uom_cache.clear()
+        super(UOM, cls).write(*args)
+
+    @classmethod
+    def delete(cls, uoms):
+        Pool().get('carrier')._ups_uom_cache.clear()
+        super(UOM, cls).delete(uoms)
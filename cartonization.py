@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+"""
+    cartonization.py
+
+    Packing of items into the box types of a carrier, to rate an order as
+    the packages it will be shipped in instead of one package of its total
+    weight.
+
+    Packing is a first fit decreasing on volume and weight: items are
+    placed, largest first, in the first open carton with room left, new
+    cartons use the largest box the item fits in, and each carton is then
+    moved to the smallest box holding its contents.
+
+    Items are not placed one by one, a box holds the units of an item in a
+    grid: as many whole units per axis as fit, in the best orientation.
+    Items of several lines share a box by the part of their grid they
+    fill, and volumes are filled up to :data:`FILL_RATIO` at most.
+
+    :func:`search` packs with several heuristics until a time budget is
+    spent and ranks the packings by billable weight and package count.
+
+    Dimensions and weights must all be in the same units.
+
+"""
+import math
+import time
+from itertools import permutations
+from collections import namedtuple
+
+__all__ = [
+    'Item', 'Box', 'Carton', 'pack', 'search', 'billable_weight',
+    'FILL_RATIO',
+]
+
+#: Part of the volume of a box which can be filled with items
+FILL_RATIO = 0.85
+
+#: Tolerance of the float comparisons
+EPSILON = 1e-9
+
+#: Units of an order line. dimensions are sorted longest first or None
+#: when unknown, weight is the weight of one unit.
+Item = namedtuple('Item', ['key', 'quantity', 'dimensions', 'weight'])
+
+#: Box type which can be used. dimensions are sorted longest first,
+#: max_weight is None when only the carrier limit applies.
+Box = namedtuple('Box', ['key', 'dimensions', 'max_weight'])
+
+
+def _volume(dimensions):
+    if not dimensions:
+        return 0
+    length, width, height = dimensions
+    return length * width * height
+
+
+def _fits(dimensions, box_dimensions):
+    "Tell if sorted dimensions fit in sorted box dimensions"
+    if not dimensions:
+        return True
+    return (
+        dimensions[0] <= box_dimensions[0] + EPSILON
+        and dimensions[1] <= box_dimensions[1] + EPSILON
+        and dimensions[2] <= box_dimensions[2] + EPSILON
+    )
+
+
+def _grid(dimensions, box_dimensions):
+    """
+    Return how many units of the dimensions fit in the box dimensions as
+    a grid of whole units, in the best orientation
+    """
+    if not dimensions:
+        return None
+    return max(
+        int(box_dimensions[0] / d[0] + EPSILON)
+        * int(box_dimensions[1] / d[1] + EPSILON)
+        * int(box_dimensions[2] / d[2] + EPSILON)
+        for d in set(permutations(dimensions))
+    )
+
+
+def _limit(box, max_weight):
+    if box.max_weight is None:
+        return max_weight
+    return min(box.max_weight, max_weight)
+
+
+class Carton(object):
+    """
+    Package of a packing. `box` is None for an item shipped in its own
+    packaging, whose dimensions are then the ones of the item.
+    """
+    __slots__ = (
+        'box', 'dimensions', 'max_weight', 'capacity', 'volume', 'weight',
+        'extent', 'contents', 'occupancy', 'items',
+    )
+
+    def __init__(self, box, max_weight, dimensions=None):
+        self.box = box
+        self.dimensions = box.dimensions if box else dimensions
+        self.max_weight = max_weight
+        self.capacity = _volume(self.dimensions) * FILL_RATIO
+        self.volume = 0
+        self.weight = 0
+        # Largest dimensions of the items, sorted longest first
+        self.extent = (0, 0, 0)
+        self.contents = {}
+        # Part of the grid slots of the box used by the items
+        self.occupancy = 0.
+        # Item of each key in contents
+        self.items = {}
+
+    def _slots(self, item, dimensions=None):
+        "Return the grid slots of item in the dimensions or the carton"
+        if self.box is None:
+            return None
+        return _grid(item.dimensions, dimensions or self.dimensions)
+
+    def room(self, item, volume, quantity):
+        """
+        Return how many of the quantity units of item, of the given unit
+        volume, fit in the carton
+        """
+        if item.weight:
+            quantity = min(quantity, int(
+                (self.max_weight - self.weight) / item.weight + EPSILON
+            ))
+        if volume:
+            quantity = min(quantity, int(
+                (self.capacity - self.volume) / volume + EPSILON
+            ))
+        slots = self._slots(item)
+        if slots is not None:
+            quantity = min(quantity, int(
+                (1 - self.occupancy) * slots + EPSILON
+            ))
+        if quantity > 0 and _fits(item.dimensions, self.dimensions):
+            return quantity
+        return 0
+
+    def add(self, item, volume, quantity):
+        self.contents[item.key] = self.contents.get(item.key, 0) + quantity
+        self.items[item.key] = item
+        self.volume += volume * quantity
+        self.weight += item.weight * quantity
+        if item.dimensions:
+            self.extent = tuple(map(max, self.extent, item.dimensions))
+        slots = self._slots(item)
+        if slots:
+            self.occupancy += float(quantity) / slots
+
+    @property
+    def full(self):
+        return (
+            self.weight >= self.max_weight - EPSILON
+            or self.volume >= self.capacity - EPSILON
+            or self.occupancy >= 1 - EPSILON
+        )
+
+    def _get_occupancy(self, dimensions):
+        "Return the part of the grid slots of dimensions the contents use"
+        occupancy = 0.
+        for key, quantity in self.contents.iteritems():
+            item = self.items[key]
+            if not item.dimensions:
+                continue
+            slots = _grid(item.dimensions, dimensions)
+            if not slots:
+                return None
+            occupancy += float(quantity) / slots
+        return occupancy
+
+    def shrink(self, boxes, max_weight):
+        "Move the contents to the smallest of boxes holding them"
+        for box in boxes:
+            capacity = _volume(box.dimensions) * FILL_RATIO
+            limit = _limit(box, max_weight)
+            if not (self.volume <= capacity + EPSILON
+                    and self.weight <= limit + EPSILON
+                    and _fits(self.extent, box.dimensions)):
+                continue
+            occupancy = self._get_occupancy(box.dimensions)
+            if occupancy is not None and occupancy <= 1 + EPSILON:
+                self.box, self.dimensions = box, box.dimensions
+                self.max_weight, self.capacity = limit, capacity
+                self.occupancy = occupancy
+                return
+
+
+def _get_box(capacities, item, volume, max_weight):
+    "Return the largest box the item fits in or None"
+    for box, capacity in reversed(capacities):
+        if (volume <= capacity + EPSILON
+                and item.weight <= _limit(box, max_weight) + EPSILON
+                and _fits(item.dimensions, box.dimensions)):
+            return box
+
+
+def _fill(open_cartons, item, volume, quantity):
+    """
+    Put the units of item in the open cartons with room left, return the
+    quantity left and whether a carton got full.
+    """
+    filled = False
+    for carton in open_cartons:
+        # Cheap test first, most cartons are skipped
+        if volume > carton.capacity - carton.volume + EPSILON:
+            continue
+        count = carton.room(item, volume, quantity)
+        if count:
+            carton.add(item, volume, count)
+            filled = filled or carton.full
+            quantity -= count
+            if not quantity:
+                break
+    return quantity, filled
+
+
+def pack(items, boxes, max_weight):
+    """
+    Pack the items into the boxes and return the cartons. Cartons weigh
+    at most max_weight (and the maximum weight of their box). Items which
+    fit in no box are shipped alone in their own packaging.
+    """
+    # Smallest first, so shrink picks the first box holding the contents
+    boxes = sorted(boxes, key=lambda b: _volume(b.dimensions))
+    capacities = [(b, _volume(b.dimensions) * FILL_RATIO) for b in boxes]
+    # Larger lines first among equal units, they are split less often
+    items = sorted(
+        ((_volume(i.dimensions), i) for i in items),
+        key=lambda v: (v[0], v[1].weight, v[1].quantity), reverse=True
+    )
+    cartons = []
+    # Cartons which may still receive items
+    open_cartons = []
+    for volume, item in items:
+        box = _get_box(capacities, item, volume, max_weight)
+        if box is None:
+            for _ in xrange(item.quantity):
+                carton = Carton(None, max_weight, item.dimensions)
+                carton.add(item, volume, 1)
+                cartons.append(carton)
+            continue
+
+        quantity, filled = _fill(open_cartons, item, volume, item.quantity)
+        while quantity:
+            carton = Carton(box, _limit(box, max_weight))
+            count = carton.room(item, volume, quantity)
+            carton.add(item, volume, count)
+            quantity -= count
+            cartons.append(carton)
+            open_cartons.append(carton)
+            filled = filled or carton.full
+        if filled:
+            open_cartons = [c for c in open_cartons if not c.full]
+
+    for carton in cartons:
+        if carton.box is not None:
+            carton.shrink(boxes, max_weight)
+    return cartons
+
+
+def billable_weight(cartons, divisor):
+    """
+    Return the weight billed for the cartons: for each one, the largest of
+    its weight and of its dimensional weight (volume / divisor), both
+    rounded up to the next unit.
+    """
+    total = 0
+    for carton in cartons:
+        total += max(
+            math.ceil(carton.weight - EPSILON),
+            math.ceil(float(_volume(carton.dimensions)) / divisor - EPSILON),
+        )
+    return total
+
+
+def _get_box_subsets(boxes):
+    "Yield the box subsets tried by search, most promising first"
+    yield boxes
+    for box in boxes:
+        yield [box]
+    if len(boxes) > 2:
+        for box in boxes:
+            yield [b for b in boxes if b is not box]
+
+
+def search(items, boxes, max_weight, divisor, budget):
+    """
+    Pack the items with each subset of boxes in turn until budget seconds
+    are spent, at least once. Return the (score, cartons) of the distinct
+    packings, best first: the lowest billable weight then package count.
+    """
+    start = time.time()
+    seen, packings = set(), {}
+    for subset in _get_box_subsets(boxes):
+        key = frozenset(b.key for b in subset)
+        if key in seen:
+            continue
+        seen.add(key)
+        cartons = pack(items, subset, max_weight)
+        layout = tuple(sorted(
+            (c.box and c.box.key, tuple(sorted(c.contents.items())))
+            for c in cartons
+        ))
+        if layout not in packings:
+            score = (billable_weight(cartons, divisor), len(cartons))
+            packings[layout] = (score, cartons)
+        if time.time() - start >= budget:
+            break
+    return sorted(packings.values(), key=lambda p: p[0])
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+    filestore.py
+
+    Write the UPS labels and accept responses to the filestore of the
+    database as soon as they are received, only references to the files
+    are kept until the records are created.
+
+    The labels are stored in the layout of `ir.attachment`, the attachments
+    are then created with the digest and collision of their file instead of
+    their data.
+
+"""
+import os
+import errno
+import hashlib
+import tempfile
+
+from trytond.config import config
+
+__all__ = ['store', 'read_start', 'store_file', 'open_file', 'remove_file']
+
+#: Bytes copied at once
+CHUNK_SIZE = 64 * 1024
+
+
+def get_directory(database_name, *names):
+    """
+    Return the directory of names in the filestore of the database, created
+    if missing.
+    """
+    directory = os.path.join(
+        config.get('database', 'path'), database_name, *names
+    )
+    try:
+        os.makedirs(directory, 0770)
+    except OSError, e:
+        # Created by a concurrent label process
+        if e.errno != errno.EEXIST:
+            raise
+    return directory
+
+
+def _write(directory, filename, chunks):
+    """
+    Write the chunks to directory/filename through a temporary file, a
+    concurrent reader never sees a partial file.
+    """
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file_obj:
+            for chunk in chunks:
+                file_obj.write(chunk)
+        os.rename(temp_path, os.path.join(directory, filename))
+    except Exception:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+
+
+def store(database_name, data):
+    """
+    Write data to the filestore of the database as `ir.attachment` does and
+    return its digest and collision. It runs without transaction, in the
+    label processes, so the collisions are found from the files.
+    """
+    digest = hashlib.md5(data).hexdigest()
+    directory = get_directory(database_name, digest[0:2], digest[2:4])
+    collision = 0
+    while True:
+        filename = digest
+        if collision:
+            filename += '-' + str(collision)
+        path = os.path.join(directory, filename)
+        if not os.path.isfile(path):
+            _write(directory, filename, [data])
+            return digest, collision
+        with open(path, 'rb') as file_obj:
+            # The labels are buffers
+            if buffer(file_obj.read()) == buffer(data):
+                return digest, collision
+        collision += 1
+
+
+def read_start(database_name, digest, collision, size):
+    """
+    Return the first size bytes of the attachment file of digest and
+    collision, an empty string if there is no file.
+    """
+    if not digest:
+        return ''
+    filename = digest
+    if collision:
+        filename += '-' + str(collision)
+    try:
+        with open(os.path.join(
+                    config.get('database', 'path'), database_name,
+                    digest[0:2], digest[2:4], filename), 'rb') as file_obj:
+            return file_obj.read(size)
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return ''
+
+
+def store_file(database_name, name, filename, file_obj):
+    """
+    Copy file_obj from its start to the name directory of the filestore of
+    the database and return its path relative to the filestore.
+    """
+    file_obj.seek(0)
+    _write(
+        get_directory(database_name, name), filename,
+        iter(lambda: file_obj.read(CHUNK_SIZE), '')
+    )
+    return os.path.join(name, filename)
+
+
+def open_file(database_name, path):
+    "Open the file stored by :func:`store_file` at path"
+    return open(os.path.join(
+            config.get('database', 'path'), database_name, path), 'rb')
+
+
+def remove_file(database_name, path):
+    "Remove the file stored by :func:`store_file` at path, if it exists"
+    try:
+        os.unlink(os.path.join(
+                config.get('database', 'path'), database_name, path))
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
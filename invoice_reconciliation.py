@@ -0,0 +1,447 @@
+# -*- coding: utf-8 -*-
+"""
+    invoice_reconciliation.py
+
+    Reconcile the UPS billing files with the costs stored on the shipments
+    when their labels are bought.
+
+    A billing file is a CSV with one row per charge. Its rows are matched
+    in batches to the shipments through the tracking numbers of their
+    packages.
+
+    A file uploaded with the wizard is held in memory. The files dropped in
+    the billing folder are streamed from disk, so memory does not grow with
+    their size; a cron reconciles each one in its own transaction and moves
+    it to the `archive` subfolder once committed, or to `error` when it can
+    not be reconciled::
+
+        [ups]
+        billing_dir = /var/lib/ups/billing
+
+"""
+import os
+import re
+import csv
+import codecs
+from cStringIO import StringIO
+from itertools import islice
+from collections import namedtuple
+from decimal import Decimal, InvalidOperation
+
+from logbook import Logger
+
+from trytond.config import config
+from trytond.exceptions import UserError
+from trytond.model import fields, ModelSQL, ModelView
+from trytond.pool import Pool, PoolMeta
+from trytond.pyson import PYSONEncoder
+from trytond.transaction import Transaction
+from trytond.wizard import Wizard, StateView, StateAction, Button
+
+from worldship import process_new_files
+
+__all__ = [
+    'InvoiceReconciliation', 'InvoiceReconciliationLine',
+    'InvoiceReconciliationImportStart', 'InvoiceReconciliationImport',
+]
+__metaclass__ = PoolMeta
+
+logger = Logger('trytond_ups')
+
+#: Charge of a billing file
+BillingRecord = namedtuple('BillingRecord', [
+    'tracking_number', 'invoice_number', 'currency', 'amount', 'category',
+    'description', 'entered_weight', 'billed_weight',
+])
+
+#: Header of the columns of the billing file read for each field of
+#: :data:`BillingRecord`, the tracking number and amount are required
+BILLING_COLUMNS = {
+    'tracking_number': 'Tracking Number',
+    'invoice_number': 'Invoice Number',
+    'currency': 'Invoice Currency Code',
+    'amount': 'Net Amount',
+    'category': 'Charge Category Code',
+    'description': 'Charge Description',
+    'entered_weight': 'Entered Weight',
+    'billed_weight': 'Billed Weight',
+}
+
+#: Charge category of the adjustments billed after the shipment
+ADJUSTMENT_CATEGORY = 'ADJ'
+
+#: Description of the adjustments correcting the dimensional weight
+DIM_CORRECTION_RE = re.compile(
+    r'dimension|\bdim\b|shipping charge correction', re.IGNORECASE
+)
+
+
+def get_tolerance():
+    "Return the difference of cost accepted as matching"
+    return Decimal(config.get('ups', 'reconciliation_tolerance') or '0.01')
+
+
+def get_billing_dir():
+    return config.get('ups', 'billing_dir')
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def iter_billing_records(file_obj):
+    """
+    Stream the charges of a UPS billing CSV file as :data:`BillingRecord`.
+    The header must name the columns of :data:`BILLING_COLUMNS`, rows
+    without tracking number or with an invalid amount are skipped.
+    """
+    reader = csv.reader(file_obj)
+    header = next(reader, None)
+    if not header:
+        return
+    header = [name.lstrip(codecs.BOM_UTF8).strip() for name in header]
+    indexes = []
+    for field in BillingRecord._fields:
+        name = BILLING_COLUMNS[field]
+        if name in header:
+            indexes.append(header.index(name))
+        elif field in ('tracking_number', 'amount'):
+            raise ValueError('Column "%s" missing in billing file' % name)
+        else:
+            indexes.append(None)
+
+    for row in reader:
+        values = [
+            row[i].strip() if i is not None and i < len(row) else ''
+            for i in indexes
+        ]
+        (tracking_number, invoice_number, currency, amount, category,
+            description, entered_weight, billed_weight) = values
+        try:
+            amount = Decimal(amount)
+        except InvalidOperation:
+            amount = None
+        if not tracking_number or amount is None:
+            logger.debug('Skipping billing row {0!r}'.format(row))
+            continue
+        yield BillingRecord(
+            unicode(tracking_number), invoice_number, currency, amount,
+            category, description, _to_float(entered_weight),
+            _to_float(billed_weight)
+        )
+
+
+def is_dim_correction(record):
+    "Tell if the charge record corrects the dimensional weight"
+    if record.category != ADJUSTMENT_CATEGORY:
+        return False
+    return bool(
+        DIM_CORRECTION_RE.search(record.description)
+        or (record.billed_weight and record.entered_weight
+            and record.billed_weight > record.entered_weight)
+    )
+
+
+class InvoiceReconciliation(ModelSQL, ModelView):
+    "UPS Invoice Reconciliation"
+    __name__ = 'shipping.ups.invoice.reconciliation'
+
+    name = fields.Char('Name', required=True, readonly=True)
+    charges = fields.Integer('Charges', readonly=True)
+    lines = fields.One2Many(
+        'shipping.ups.invoice.reconciliation.line', 'reconciliation',
+        'Lines', readonly=True
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(InvoiceReconciliation, cls).__setup__()
+        cls._order.insert(0, ('create_date', 'DESC'))
+
+    @classmethod
+    def reconcile(cls, name, records):
+        """
+        Create the reconciliation of the charges of records, an iterable of
+        :data:`BillingRecord` consumed in batches.
+        """
+        Line = Pool().get('shipping.ups.invoice.reconciliation.line')
+
+        records = iter(records)
+        size = Transaction().database.IN_MAX
+        # An invalid file fails before anything is created
+        batch = list(islice(records, size))
+        reconciliation, = cls.create([{'name': name}])
+        count = 0
+        while batch:
+            count += len(batch)
+            Line.add_charges(reconciliation, batch)
+            batch = list(islice(records, size))
+        cls.write([reconciliation], {'charges': count})
+        return reconciliation
+
+    @classmethod
+    def import_billing_files_cron(cls):
+        """
+        Reconcile the files of the billing folder, each one in its own
+        transaction, see :func:`worldship.process_new_files`.
+        """
+        directory = get_billing_dir()
+        if not directory:
+            return
+
+        def reconcile(path):
+            with open(path, 'rb') as file_obj:
+                cls.reconcile(
+                    os.path.basename(path), iter_billing_records(file_obj)
+                )
+        process_new_files(
+            directory, reconcile, (ValueError, csv.Error, UserError)
+        )
+
+
+class InvoiceReconciliationLine(ModelSQL, ModelView):
+    "UPS Invoice Reconciliation Line"
+    __name__ = 'shipping.ups.invoice.reconciliation.line'
+
+    reconciliation = fields.Many2One(
+        'shipping.ups.invoice.reconciliation', 'Reconciliation',
+        required=True, readonly=True, select=True, ondelete='CASCADE'
+    )
+    shipment = fields.Many2One(
+        'stock.shipment.out', 'Shipment', readonly=True, select=True
+    )
+    tracking_number = fields.Char(
+        'Tracking Number', readonly=True, select=True,
+        help='First tracking number billed for the shipment'
+    )
+    invoice_number = fields.Char('Invoice Number', readonly=True)
+    currency_code = fields.Char('Currency', readonly=True)
+    expected_cost = fields.Numeric(
+        'Expected Cost', digits=(16, 2), readonly=True
+    )
+    billed_cost = fields.Numeric('Billed Cost', digits=(16, 2), readonly=True)
+    difference = fields.Numeric('Difference', digits=(16, 2), readonly=True)
+    charges = fields.Integer('Charges', readonly=True)
+    state = fields.Selection([
+        ('matched', 'Matched'),
+        ('overbilled', 'Overbilled'),
+        ('underbilled', 'Underbilled'),
+        ('unmatched', 'Unmatched'),
+    ], 'State', readonly=True, select=True)
+    dim_correction = fields.Boolean(
+        'DIM Correction', readonly=True,
+        help='The dimensional weight was corrected by UPS'
+    )
+    surcharge = fields.Boolean(
+        'Surcharge', readonly=True,
+        help='Other adjustments were billed after the shipment'
+    )
+
+    @classmethod
+    def _get_shipments(cls, tracking_numbers):
+        """
+        Return the shipment id of the tracking numbers, the ones of the
+        packages or of the shipments themselves
+        """
+        pool = Pool()
+        Tracking = pool.get('shipment.tracking')
+        Package = pool.get('stock.package')
+
+        origins = {}
+        for tracking in Tracking.search_read([
+                    ('tracking_number', 'in', tracking_numbers),
+                ], order=[('id', 'ASC')],
+                fields_names=['tracking_number', 'origin']):
+            if tracking['origin']:
+                origins[tracking['tracking_number']] = \
+                    tracking['origin'].split(',')
+        package_ids = list(set(
+            int(id_) for model, id_ in origins.itervalues()
+            if model == 'stock.package'
+        ))
+        package_shipments = {}
+        for package in Package.search_read([
+                    ('id', 'in', package_ids),
+                ], fields_names=['shipment']):
+            model, id_ = (package['shipment'] or ',').split(',')
+            if model == 'stock.shipment.out':
+                package_shipments[package['id']] = int(id_)
+
+        shipments = {}
+        for number, (model, id_) in origins.iteritems():
+            if model == 'stock.package':
+                shipment = package_shipments.get(int(id_))
+            elif model == 'stock.shipment.out':
+                shipment = int(id_)
+            else:
+                shipment = None
+            if shipment is not None:
+                shipments[number] = shipment
+        return shipments
+
+    @classmethod
+    def _get_values(cls, values, expected_cost, expected_currency):
+        "Complete the line values with the difference and state"
+        Currency = Pool().get('currency.currency')
+
+        if expected_cost is None:
+            values.update({
+                'expected_cost': None,
+                'difference': None,
+                'state': 'unmatched',
+            })
+            return values
+        billed_cost = values['billed_cost']
+        if (expected_currency and values['currency_code']
+                and values['currency_code'] != expected_currency.code):
+            currencies = Currency.search([
+                ('code', '=', values['currency_code']),
+            ], limit=1)
+            if not currencies:
+                logger.warning(
+                    'Unknown currency {0} billed for {1}'.format(
+                        values['currency_code'], values.get('tracking_number')
+                    )
+                )
+                values.update({
+                    'expected_cost': expected_cost,
+                    'difference': None,
+                    'state': 'unmatched',
+                })
+                return values
+            billed_cost = Currency.compute(
+                currencies[0], billed_cost, expected_currency
+            )
+        difference = billed_cost - expected_cost
+        if abs(difference) <= get_tolerance():
+            state = 'matched'
+        elif difference > 0:
+            state = 'overbilled'
+        else:
+            state = 'underbilled'
+        values.update({
+            'expected_cost': expected_cost,
+            'difference': difference,
+            'state': state,
+        })
+        return values
+
+    @classmethod
+    def add_charges(cls, reconciliation, records):
+        """
+        Add the charges of records to the lines of reconciliation: one line
+        per shipment, or per tracking number when no shipment has it. The
+        lines of shipments already billed by a previous batch are updated.
+        """
+        Shipment = Pool().get('stock.shipment.out')
+
+        shipments = cls._get_shipments(
+            list(set(r.tracking_number for r in records))
+        )
+        groups = {}
+        for record in records:
+            # Unmatched charges are grouped by tracking number
+            key = shipments.get(record.tracking_number, record.tracking_number)
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = {
+                    'reconciliation': reconciliation.id,
+                    'tracking_number': record.tracking_number,
+                    'invoice_number': record.invoice_number,
+                    'currency_code': record.currency,
+                    'billed_cost': Decimal(0),
+                    'charges': 0,
+                    'dim_correction': False,
+                    'surcharge': False,
+                }
+            group['billed_cost'] += record.amount
+            group['charges'] += 1
+            if is_dim_correction(record):
+                group['dim_correction'] = True
+            elif record.category == ADJUSTMENT_CATEGORY:
+                group['surcharge'] = True
+
+        shipment_ids = [k for k in groups if isinstance(k, (int, long))]
+        unmatched = [k for k in groups if isinstance(k, basestring)]
+        costs = dict(
+            (s.id, (s.cost, s.cost_currency))
+            for s in Shipment.browse(shipment_ids)
+        )
+        existing = cls.search([
+            ('reconciliation', '=', reconciliation.id),
+            ['OR',
+                ('shipment', 'in', shipment_ids),
+                [
+                    ('shipment', '=', None),
+                    ('tracking_number', 'in', unmatched),
+                ]],
+        ])
+        to_write = []
+        for line in existing:
+            group = groups.pop(
+                line.shipment.id if line.shipment else line.tracking_number
+            )
+            values = {
+                'billed_cost': line.billed_cost + group['billed_cost'],
+                'charges': line.charges + group['charges'],
+                'dim_correction': (
+                    line.dim_correction or group['dim_correction']),
+                'surcharge': line.surcharge or group['surcharge'],
+                'currency_code': line.currency_code,
+            }
+            to_write.extend([[line], cls._get_values(
+                values, line.expected_cost, line.shipment
+                and line.shipment.cost_currency
+            )])
+        if to_write:
+            cls.write(*to_write)
+
+        vlist = []
+        for key, values in groups.iteritems():
+            expected_cost, currency = costs.get(key, (None, None))
+            if key in costs:
+                values['shipment'] = key
+                expected_cost = expected_cost or Decimal(0)
+            vlist.append(cls._get_values(values, expected_cost, currency))
+        return cls.create(vlist)
+
+
+class InvoiceReconciliationImportStart(ModelView):
+    'UPS Invoice Reconciliation Import Start'
+    __name__ = 'shipping.ups.invoice.reconciliation.import.start'
+
+    file = fields.Binary(
+        'UPS Billing File', required=True, filename='filename'
+    )
+    filename = fields.Char('File Name')
+
+
+class InvoiceReconciliationImport(Wizard):
+    'Reconcile UPS Billing File'
+    __name__ = 'shipping.ups.invoice.reconciliation.import'
+
+    start = StateView(
+        'shipping.ups.invoice.reconciliation.import.start',
+        'shipping_ups.invoice_reconciliation_import_start_view_form',
+        [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Import', 'import_', 'tryton-ok', default=True),
+        ]
+    )
+    import_ = StateAction('shipping_ups.act_invoice_reconciliation')
+
+    def do_import_(self, action):
+        Reconciliation = Pool().get('shipping.ups.invoice.reconciliation')
+
+        reconciliation = Reconciliation.reconcile(
+            self.start.filename or 'UPS Billing',
+            # Read in place, the upload is not copied
+            iter_billing_records(StringIO(self.start.file))
+        )
+        action['pyson_domain'] = PYSONEncoder().encode([
+            ('id', '=', reconciliation.id),
+        ])
+        return action, {}
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+    label_batch.py
+
+    Assemble the stored UPS labels of many shipments into one print
+    document, a multi-page PDF for the image labels or the concatenated
+    printer commands for the thermal labels.
+
+    The document is streamed from::
+
+        GET /<database>/shipping_ups/labels?shipments=1,2,3&order=pick_path
+
+"""
+import struct
+
+from werkzeug.wrappers import Response
+from werkzeug.exceptions import abort
+
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.protocols.dispatcher import with_pool
+from trytond.wsgi import app
+
+__all__ = ['PDFWriter', 'ChunkBuffer', 'iter_png_chunks', 'check_png_header']
+
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+
+#: Bytes of a PNG image up to the end of its IHDR chunk
+PNG_HEADER_SIZE = 33
+
+#: Resolution of the label images, UPS renders them for 203 dpi printers
+LABEL_DPI = 203
+
+#: Mimetype of the batch documents by format
+MIMETYPES = {
+    'pdf': 'application/pdf',
+    'zpl': 'application/octet-stream',
+    'epl': 'application/octet-stream',
+}
+
+
+def iter_png_chunks(data):
+    "Yield (type, data) for every chunk of a PNG image"
+    if data[:8] != PNG_SIGNATURE:
+        raise ValueError('Not a PNG image')
+    position = 8
+    while position < len(data):
+        length, = struct.unpack('>I', data[position:position + 4])
+        chunk_type = data[position + 4:position + 8]
+        yield chunk_type, data[position + 8:position + 8 + length]
+        position += length + 12
+
+
+def check_png_header(data):
+    """
+    Raise ValueError if data, the start of an image, is not a PNG image
+    supported by :class:`PDFWriter`. Only its first PNG_HEADER_SIZE bytes
+    are read, the labels are checked before the document is streamed.
+    """
+    data = data[:PNG_HEADER_SIZE]
+    if len(data) < PNG_HEADER_SIZE:
+        raise ValueError('Not a PNG image')
+    chunk_type, header = next(iter_png_chunks(data))
+    if chunk_type != 'IHDR' or len(header) != 13:
+        raise ValueError('Not a PNG image')
+    _, _, _, color_type, _, _, interlace = struct.unpack('>IIBBBBB', header)
+    if interlace or color_type not in (0, 2, 3):
+        raise ValueError('PNG image with alpha or interlace')
+
+
+class PDFWriter(object):
+    """
+    Write a PDF of one PNG image per page to a file object, page after page.
+    Only the offsets of the objects are kept in memory.
+
+    The compressed data of the PNG images is copied as is, PDF decodes it
+    with the same filter and predictors. Images with an alpha channel or
+    interlaced are not supported.
+    """
+
+    def __init__(self, file_obj, dpi=LABEL_DPI):
+        self.file_obj = file_obj
+        self.dpi = dpi
+        self.offsets = {}
+        self.pages = []
+        self.position = 0
+        # Object 1 is the catalog and 2 the page tree, written at the end
+        self.next_object = 3
+        self._write('%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def _write(self, data):
+        self.file_obj.write(data)
+        self.position += len(data)
+
+    def _object(self, number, content, stream=None):
+        self.offsets[number] = self.position
+        self._write('%d 0 obj\n%s\n' % (number, content))
+        if stream is not None:
+            self._write('stream\n')
+            self._write(stream)
+            self._write('\nendstream\n')
+        self._write('endobj\n')
+
+    def _reserve(self, count):
+        numbers = range(self.next_object, self.next_object + count)
+        self.next_object += count
+        return numbers
+
+    def add_png(self, data):
+        "Add a page showing the PNG image data"
+        header, palette, idat = None, None, []
+        for chunk_type, chunk in iter_png_chunks(data):
+            if chunk_type == 'IHDR':
+                header = struct.unpack('>IIBBBBB', chunk)
+            elif chunk_type == 'PLTE':
+                palette = chunk
+            elif chunk_type == 'IDAT':
+                idat.append(chunk)
+            elif chunk_type == 'IEND':
+                break
+        width, height, depth, color_type, _, _, interlace = header
+        if interlace or color_type not in (0, 2, 3):
+            raise ValueError('PNG image with alpha or interlace')
+        if color_type == 3:
+            color_space = '[/Indexed /DeviceRGB %d <%s>]' % (
+                len(palette) // 3 - 1, palette.encode('hex')
+            )
+            colors = 1
+        elif color_type == 2:
+            color_space, colors = '/DeviceRGB', 3
+        else:
+            color_space, colors = '/DeviceGray', 1
+
+        image, content, page = self._reserve(3)
+        image_data = ''.join(idat)
+        self._object(image, (
+            '<< /Type /XObject /Subtype /Image /Width %d /Height %d '
+            '/ColorSpace %s /BitsPerComponent %d /Filter /FlateDecode '
+            '/DecodeParms << /Predictor 15 /Colors %d /BitsPerComponent %d '
+            '/Columns %d >> /Length %d >>'
+        ) % (
+            width, height, color_space, depth, colors, depth, width,
+            len(image_data)
+        ), image_data)
+
+        page_width = width * 72.0 / self.dpi
+        page_height = height * 72.0 / self.dpi
+        drawing = 'q %.2f 0 0 %.2f 0 0 cm /Label Do Q' % (
+            page_width, page_height
+        )
+        self._object(
+            content, '<< /Length %d >>' % len(drawing), drawing
+        )
+        self._object(page, (
+            '<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.2f %.2f] '
+            '/Resources << /XObject << /Label %d 0 R >> >> '
+            '/Contents %d 0 R >>'
+        ) % (page_width, page_height, image, content))
+        self.pages.append(page)
+
+    def close(self):
+        "Write the page tree and the cross-reference table"
+        self._object(2, '<< /Type /Pages /Kids [%s] /Count %d >>' % (
+            ' '.join('%d 0 R' % page for page in self.pages), len(self.pages)
+        ))
+        self._object(1, '<< /Type /Catalog /Pages 2 0 R >>')
+        xref = self.position
+        self._write('xref\n0 %d\n0000000000 65535 f \n' % self.next_object)
+        for number in xrange(1, self.next_object):
+            self._write('%010d 00000 n \n' % self.offsets[number])
+        self._write(
+            'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n'
+            % (self.next_object, xref)
+        )
+
+
+class ChunkBuffer(object):
+    "File object collecting the data written since the last flush"
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def flush(self):
+        data, self.chunks = ''.join(self.chunks), []
+        return data
+
+
+@app.route(
+    '/<string:database_name>/shipping_ups/labels', methods=['GET'])
+@app.auth_required
+@with_pool
+def ups_labels(request, pool):
+    """
+    Stream the labels of the shipments given as comma separated ids in the
+    `shipments` argument, ordered by `number` (default) or `pick_path`.
+    """
+    try:
+        ids = map(int, request.args.get('shipments', '').split(','))
+    except ValueError:
+        abort(400)
+    order = request.args.get('order', 'number')
+    if order not in ('number', 'pick_path'):
+        abort(400)
+    user = request.user_id
+    context = {'_check_access': True}
+
+    with Transaction().start(
+            pool.database_name, user, readonly=True, context=context):
+        Shipment = pool.get('stock.shipment.out')
+        # The labels which can not be printed are reported here, before
+        # the response is started
+        format_, attachment_ids = Shipment.get_ups_label_batch(
+            Shipment.browse(ids), order
+        )
+    if not attachment_ids:
+        abort(404)
+
+    def generate():
+        with Transaction().start(
+                pool.database_name, user, readonly=True, context=context):
+            Shipment = Pool().get('stock.shipment.out')
+            for chunk in Shipment.iter_ups_label_batch(
+                    format_, attachment_ids):
+                yield chunk
+
+    response = Response(
+        generate(), mimetype=MIMETYPES[format_], direct_passthrough=True
+    )
+    response.headers['Content-Disposition'] = \
+        'attachment; filename=ups_labels.%s' % format_
+    return response
@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -*-
+"""
+    label_journal.py
+
+    Journal of the UPS labels bought, written in its own transaction so that
+    a label accepted by UPS is not lost when the transaction saving it fails.
+
+    The accept response, with the label images, is copied to the filestore
+    of the database. A daily cron removes the responses whose labels are
+    saved and deletes the entries which are not pending anymore after the
+    retention::
+
+        [ups]
+        # Days the entries are kept, default is 30
+        label_journal_days = 30
+
+"""
+import datetime
+from cStringIO import StringIO
+from contextlib import contextmanager
+
+from sql import Cast
+from sql.operators import Concat, Or
+
+from trytond import backend
+from trytond.config import config
+from trytond.model import fields, ModelSQL, ModelView
+from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction
+from trytond.tools import grouped_slice, reduce_ids
+
+from accept_response import parse_header
+from filestore import store_file, open_file, remove_file
+
+__all__ = ['LabelJournal']
+__metaclass__ = PoolMeta
+
+#: Days the entries are kept by default
+DEFAULT_RETENTION = 30
+
+#: Directory of the accept responses in the filestore
+RESPONSE_DIRECTORY = 'ups_label_journal'
+
+
+def get_retention():
+    return config.getint(
+        'ups', 'label_journal_days', default=DEFAULT_RETENTION
+    )
+
+
+class LabelJournal(ModelSQL, ModelView):
+    "UPS Label Journal"
+    __name__ = 'shipping.ups.label.journal'
+
+    shipment = fields.Many2One(
+        'stock.shipment.out', 'Shipment', required=True, readonly=True,
+        select=True, ondelete='CASCADE'
+    )
+    carrier = fields.Many2One(
+        'carrier', 'Carrier', required=True, readonly=True
+    )
+    packages = fields.Char(
+        'Packages', readonly=True,
+        help='Ids of the packages in the order sent to UPS'
+    )
+    state = fields.Selection([
+        ('confirmed', 'Confirmed'),
+        ('accepted', 'Accepted'),
+        ('saved', 'Saved'),
+        ('expired', 'Expired'),
+        ('failed', 'Failed'),
+    ], 'State', readonly=True, select=True)
+    digest = fields.Text('Shipment Digest', readonly=True)
+    identification_number = fields.Char(
+        'Shipment Identification Number', readonly=True, select=True
+    )
+    accept_response_file = fields.Char(
+        'Accept Response File', readonly=True,
+        help='Path of the accept response in the filestore'
+    )
+    error = fields.Text('Error', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(LabelJournal, cls).__setup__()
+        cls._order.insert(0, ('create_date', 'DESC'))
+        cls._error_messages.update({
+            'labels_in_progress':
+                'The labels of shipment "%s" are being generated by another '
+                'request.',
+            'accepted_for_other_packages':
+                'A label was already bought for other packages of shipment '
+                '"%s" (%s), void it and delete its journal entry first.',
+        })
+
+    @staticmethod
+    def default_state():
+        return 'confirmed'
+
+    @staticmethod
+    def _get_packages_key(shipment):
+        return ','.join(str(package.id) for package in shipment.packages)
+
+    @staticmethod
+    @contextmanager
+    def _journal_transaction():
+        """
+        Run the block in a new transaction committed at its end. SQLite
+        allows only one writer, the journal is then written in the current
+        transaction.
+        """
+        if backend.name() == 'sqlite':
+            yield
+            return
+        with Transaction().new_transaction():
+            yield
+
+    @classmethod
+    def lock_shipment(cls, shipment):
+        """
+        Lock the row of the shipment until the end of the transaction, a
+        concurrent generation of its labels fails instead of waiting.
+        """
+        if backend.name() != 'postgresql':
+            return
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+
+        cursor = Transaction().connection.cursor()
+        try:
+            # Unlike FOR UPDATE, it does not block the journal entries
+            # referencing the shipment
+            cursor.execute(
+                'SELECT id FROM "%s" WHERE id = %%s '
+                'FOR NO KEY UPDATE NOWAIT' % shipment._table,
+                (shipment.id,)
+            )
+        except DatabaseOperationalError:
+            cls.raise_user_error(
+                'labels_in_progress', error_args=(shipment.rec_name,)
+            )
+
+    @classmethod
+    def lock_available(cls, shipments):
+        """
+        Lock the rows of the shipments which are not locked by another
+        transaction and return them.
+        """
+        if backend.name() != 'postgresql' or not shipments:
+            return shipments
+        Shipment = Pool().get('stock.shipment.out')
+
+        cursor = Transaction().connection.cursor()
+        cursor.execute(
+            'SELECT id FROM "%s" WHERE id IN (%s) '
+            'FOR NO KEY UPDATE SKIP LOCKED' % (
+                Shipment._table, ','.join(['%s'] * len(shipments))
+            ), [s.id for s in shipments]
+        )
+        locked = set(row[0] for row in cursor.fetchall())
+        return [s for s in shipments if s.id in locked]
+
+    @classmethod
+    def get_pending(cls, shipment):
+        """
+        Return the last entry of the shipment whose labels were not saved:
+        a confirmed entry to accept or an accepted entry to save. None if
+        the UPS calls must be made again.
+        """
+        Tracking = Pool().get('shipment.tracking')
+
+        entries = cls.search([
+            ('shipment', '=', shipment.id),
+            ('state', 'in', ['confirmed', 'accepted', 'saved']),
+        ], order=[('id', 'DESC')], limit=1)
+        if not entries:
+            return None
+        entry, = entries
+        if entry.state == 'saved':
+            return None
+        elif entry.state == 'accepted':
+            if Tracking.search([
+                    ('tracking_number', '=', entry.identification_number),
+                    ], limit=1):
+                # Saved, the labels were voided since
+                return None
+            if entry.packages != cls._get_packages_key(shipment):
+                cls.raise_user_error('accepted_for_other_packages', (
+                    shipment.rec_name, entry.identification_number
+                ))
+        elif entry.packages != cls._get_packages_key(shipment):
+            return None
+        return entry
+
+    def get_accept_response(self):
+        "Return the file of the accept response as received from UPS"
+        return open_file(
+            Transaction().database.name, self.accept_response_file
+        )
+
+    @classmethod
+    def log_confirm(cls, shipment, digest):
+        "Record the digest confirmed for the shipment and return its id"
+        with cls._journal_transaction():
+            entry, = cls.create([{
+                'shipment': shipment.id,
+                'carrier': shipment.carrier.id,
+                'packages': cls._get_packages_key(shipment),
+                'state': 'confirmed',
+                'digest': digest,
+            }])
+            return entry.id
+
+    @classmethod
+    def log_accept(cls, entry_id, data):
+        """
+        Record the accept response of the entry, data is a file or a string.
+        The response is copied to the filestore before the entry is written.
+        """
+        header = parse_header(data)
+        if isinstance(data, basestring):
+            data = StringIO(data)
+        path = store_file(
+            Transaction().database.name, RESPONSE_DIRECTORY,
+            '%s.xml' % entry_id, data
+        )
+        with cls._journal_transaction():
+            cls.write([cls(entry_id)], {
+                'state': 'accepted',
+                'identification_number': unicode(
+                    header.ShipmentResults.ShipmentIdentificationNumber
+                ),
+                'accept_response_file': path,
+            })
+
+    @classmethod
+    def mark_saved(cls, identification_numbers):
+        """
+        Mark the accepted entries of the shipment identification numbers as
+        saved. It is written in the current transaction, with the labels, so
+        their accept response is removed later by :meth:`purge`.
+        """
+        entries = []
+        for sub_numbers in grouped_slice(identification_numbers):
+            entries.extend(cls.search([
+                ('identification_number', 'in', list(sub_numbers)),
+                ('state', '=', 'accepted'),
+            ]))
+        if entries:
+            cls.write(entries, {'state': 'saved'})
+
+    @classmethod
+    def log_failure(cls, shipment, error):
+        "Record the error of a confirm request sent ahead of the labels"
+        with cls._journal_transaction():
+            cls.create([{
+                'shipment': shipment.id,
+                'carrier': shipment.carrier.id,
+                'packages': cls._get_packages_key(shipment),
+                'state': 'failed',
+                'error': error,
+            }])
+
+    @classmethod
+    def expire(cls, entry_id):
+        "Mark the digest of the entry as not usable anymore"
+        with cls._journal_transaction():
+            cls.write([cls(entry_id)], {'state': 'expired'})
+
+    @classmethod
+    def expire_shipments(cls, shipment_ids):
+        """
+        Expire the digests confirmed for the shipments, they were changed
+        since. Accepted entries are kept, their labels are paid.
+        """
+        if not shipment_ids:
+            return
+        entries = cls.search([
+            ('shipment', 'in', list(shipment_ids)),
+            ('state', 'in', ['confirmed', 'failed']),
+        ])
+        if entries:
+            cls.write(entries, {'state': 'expired'})
+
+    @classmethod
+    def has_expirable(cls, shipment_ids=(), package_ids=(), move_ids=()):
+        """
+        Tell with one query if the shipments, the shipments of the packages
+        or of the packages of the moves have digests to expire. Writes of
+        records without such entries skip the comparison of their values.
+        """
+        pool = Pool()
+        Package = pool.get('stock.package')
+        Move = pool.get('stock.move')
+        journal = cls.__table__()
+        package = Package.__table__()
+        move = Move.__table__()
+        cursor = Transaction().connection.cursor()
+
+        # Packages reference their shipment as "model,id"
+        shipment = Concat(
+            'stock.shipment.out,',
+            Cast(journal.shipment, Package.shipment.sql_type().base)
+        )
+        where = Or()
+        if shipment_ids:
+            where.append(reduce_ids(journal.shipment, shipment_ids))
+        if package_ids:
+            where.append(shipment.in_(package.select(
+                        package.shipment,
+                        where=reduce_ids(package.id, package_ids))))
+        if move_ids:
+            move_package = package.join(
+                move, condition=move.package == package.id
+            )
+            where.append(shipment.in_(move_package.select(
+                        package.shipment,
+                        where=reduce_ids(move.id, move_ids))))
+        if not where:
+            return False
+        cursor.execute(*journal.select(
+                journal.id,
+                where=journal.state.in_(['confirmed', 'failed']) & where,
+                limit=1))
+        return cursor.fetchone() is not None
+
+    @classmethod
+    def purge(cls, days=None):
+        """
+        Remove the accept responses of the saved entries and delete the
+        entries older than days (the retention by default) which are not
+        pending: the accepted entries whose labels were not saved are kept.
+        """
+        if days is None:
+            days = get_retention()
+        table = cls.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        limit = datetime.datetime.now() - datetime.timedelta(days=days)
+
+        # The labels of the saved entries are committed
+        saved = cls.search([
+            ('state', '=', 'saved'),
+            ('accept_response_file', '!=', None),
+        ])
+        paths = [e.accept_response_file for e in saved]
+        if saved:
+            cls.write(saved, {'accept_response_file': None})
+        cursor.execute(*table.delete(
+                where=(table.create_date < limit)
+                & table.state.in_(['saved', 'expired', 'failed'])))
+        for path in paths:
+            remove_file(transaction.database.name, path)
+
+    @classmethod
+    def purge_label_journal_cron(cls):
+        "Cron to delete the entries past the retention"
+        cls.purge()
+
+    @classmethod
+    def get_to_confirm(cls, shipments):
+        """
+        Return the shipments whose last entry is expired or which have no
+        entry, they must be confirmed ahead of their labels.
+        """
+        last_states = {}
+        for sub_ids in grouped_slice([s.id for s in shipments]):
+            for entry in cls.search_read([
+                        ('shipment', 'in', list(sub_ids)),
+                    ], order=[('id', 'ASC')],
+                    fields_names=['shipment', 'state']):
+                last_states[entry['shipment']] = entry['state']
+        return [
+            s for s in shipments
+            if last_states.get(s.id, 'expired') == 'expired'
+        ]
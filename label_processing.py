@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+    label_processing.py
+
+    Post-processing of the UPS labels in a pool of worker processes, so the
+    CPU bound conversions of the labels of a batch run on several cores
+    while the next labels are bought::
+
+        [ups]
+        # Default is 0, the labels are processed in the request thread
+        label_processes = 4
+
+    When enabled, :meth:`Package._process_raw_label` is run in the pool by
+    :func:`process_raw_label`, see :meth:`Package._get_ups_label_processor`.
+    The label processes are forked from the server process with the pools
+    of its databases: they run without transaction.
+
+"""
+import os
+import base64
+from threading import Lock
+from multiprocessing import Pool as ProcessPool
+
+from trytond.config import config
+from trytond.pool import Pool
+
+from filestore import store
+
+__all__ = [
+    'get_processes', 'get_pool', 'submit', 'Done', 'shutdown',
+    'process_raw_label',
+]
+
+_lock = Lock()
+_pool = None
+# Process which created the pool and databases loaded at that time
+_pool_pid = None
+_pool_databases = frozenset()
+
+
+def get_processes():
+    return config.getint('ups', 'label_processes', default=0)
+
+
+def get_pool():
+    "Return the pool of label processes, None when disabled"
+    global _pool, _pool_pid, _pool_databases
+
+    processes = get_processes()
+    if processes <= 0:
+        return None
+    databases = frozenset(Pool.database_list())
+    with _lock:
+        # The pool of a parent process can not be used after a fork, and
+        # the processes only know the databases loaded before they started
+        if (_pool is None or _pool_pid != os.getpid()
+                or not databases <= _pool_databases):
+            if _pool is not None and _pool_pid == os.getpid():
+                # The pending labels are still processed
+                _pool.close()
+            _pool = ProcessPool(processes)
+            _pool_pid = os.getpid()
+            _pool_databases = databases
+        return _pool
+
+
+def shutdown():
+    "Stop the label processes of the current process"
+    global _pool, _pool_pid, _pool_databases
+
+    with _lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.terminate()
+            _pool.join()
+        _pool = _pool_pid = None
+        _pool_databases = frozenset()
+
+
+class Done(object):
+    "Result already computed, with the interface of an AsyncResult"
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def get(self, timeout=None):
+        return self.value
+
+
+def submit(func, *args):
+    """
+    Return the pending result of func called with args, in the label
+    processes when enabled. Its `get` method waits for the value and
+    raises the exception of func.
+    """
+    pool = get_pool()
+    if pool is None:
+        return Done(func(*args))
+    return pool.apply_async(func, args)
+
+
+def process_raw_label(database_name, package_id, image):
+    """
+    Write the label of the base64 encoded image processed by
+    :meth:`Package._process_raw_label` of the package to the filestore and
+    return its digest and collision. There is no transaction, only the id
+    of the package can be used.
+    """
+    Package = Pool(database_name).get('stock.package')
+    return store(database_name, base64.decodestring(
+            Package(package_id)._process_raw_label(image)))
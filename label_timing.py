@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+    label_timing.py
+
+    Time spent in each phase of the UPS label generation.
+
+"""
+from trytond.model import fields, ModelSQL, ModelView
+from trytond.pool import PoolMeta
+from trytond.rpc import RPC
+
+from metrics import percentile
+
+__all__ = ['LabelTiming']
+__metaclass__ = PoolMeta
+
+#: Phases of :meth:`ShipmentOut.generate_shipping_labels`, in order
+LABEL_PHASES = [
+    'build_xml', 'confirm', 'accept', 'labels', 'tracking', 'attachments',
+    'search_save',
+]
+
+
+class LabelTiming(ModelSQL, ModelView):
+    "UPS Label Timing"
+    __name__ = 'shipping.ups.label.timing'
+
+    shipment = fields.Many2One(
+        'stock.shipment.out', 'Shipment', required=True, readonly=True,
+        select=True, ondelete='CASCADE'
+    )
+    carrier = fields.Many2One(
+        'carrier', 'Carrier', required=True, readonly=True
+    )
+    packages = fields.Integer('Packages', readonly=True)
+    build_xml = fields.Integer('Build XML (ms)', readonly=True)
+    confirm = fields.Integer('Confirm (ms)', readonly=True)
+    accept = fields.Integer('Accept (ms)', readonly=True)
+    labels = fields.Integer('Labels (ms)', readonly=True)
+    tracking = fields.Integer('Tracking Create (ms)', readonly=True)
+    attachments = fields.Integer('Attachment Create (ms)', readonly=True)
+    search_save = fields.Integer('Save (ms)', readonly=True)
+    total = fields.Integer('Total (ms)', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(LabelTiming, cls).__setup__()
+        cls._order.insert(0, ('create_date', 'DESC'))
+        cls.__rpc__.update({
+            'get_percentiles': RPC(readonly=True),
+        })
+
+    @classmethod
+    def record(cls, shipment, timer):
+        """
+        Store the phases measured by timer for the labels of shipment
+
+        :param timer: A :class:`metrics.PhaseTimer`
+        """
+        return cls.record_many([(shipment, timer)])[0]
+
+    @classmethod
+    def record_many(cls, timings):
+        "Store the phases of a list of (shipment, timer)"
+        vlist = []
+        for shipment, timer in timings:
+            values = {
+                'shipment': shipment.id,
+                'carrier': shipment.carrier.id,
+                'packages': len(shipment.packages),
+                'total': int(round(timer.total * 1000)),
+            }
+            for phase in LABEL_PHASES:
+                values[phase] = int(round(timer.phases.get(phase, 0) * 1000))
+            vlist.append(values)
+        return cls.create(vlist)
+
+    @classmethod
+    def get_percentiles(cls, domain=None, percents=(50, 95, 99)):
+        """
+        Return the percentiles of the time spent in each phase by the label
+        generations matching domain::
+
+            {'confirm': {'p50': 640, 'p95': 1210, 'p99': 2300}, ...}
+        """
+        phases = LABEL_PHASES + ['total']
+        timings = cls.search_read(domain or [], fields_names=phases)
+        result = {}
+        for phase in phases:
+            values = [t[phase] for t in timings if t[phase] is not None]
+            result[phase] = dict(
+                ('p%s' % percent, percentile(values, percent))
+                for percent in percents
+            )
+        return result
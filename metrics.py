@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+"""
+    metrics.py
+
+    Latency, payload size and error metrics of the requests sent to UPS.
+
+    Metrics are kept in memory, per server process, and are only collected
+    when enabled in the trytond configuration::
+
+        [ups]
+        metrics = True
+        # Times a rate or address validation request is sent again on a
+        # network error
+        retries = 1
+        # Store the time spent in each phase of the label generation
+        label_timing = True
+
+"""
+import math
+import time
+import socket
+import urllib2
+from threading import Lock
+from contextlib import contextmanager
+
+from trytond.config import config
+
+from ups_api import ups
+
+__all__ = [
+    'is_enabled', 'get_retries', 'is_label_timing_enabled', 'instrument',
+    'InstrumentedClient', 'registry', 'MetricsRegistry', 'parse_error_code',
+    'PhaseTimer', 'percentile',
+]
+
+#: Upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+#: Calls which can safely be sent again, they do not buy anything
+IDEMPOTENT_CALLS = ('rate', 'address_val')
+
+#: Errors which are worth a retry
+NETWORK_ERRORS = (urllib2.URLError, socket.error)
+
+
+def is_enabled():
+    return config.getboolean('ups', 'metrics', default=False)
+
+
+def get_retries():
+    return config.getint('ups', 'retries', default=0)
+
+
+def is_label_timing_enabled():
+    return config.getboolean('ups', 'label_timing', default=False)
+
+
+def parse_error_code(exception):
+    """
+    Return the code of a UPS error, `Hard-111285` for a `PyUPSException`
+    raised with `Hard-111285:The postal code ...`. Other exceptions are
+    reported by class name.
+    """
+    if isinstance(exception, ups.PyUPSException):
+        return unicode(exception[0]).split(':', 1)[0]
+    if isinstance(exception, NETWORK_ERRORS):
+        return 'network'
+    return exception.__class__.__name__
+
+
+class _Series(object):
+    "Metrics of one call type of one carrier"
+    __slots__ = (
+        'count', 'latency_buckets', 'latency_sum', 'request_bytes',
+        'response_bytes', 'errors', 'retries', 'coalesced',
+    )
+
+    def __init__(self):
+        self.count = 0
+        self.latency_buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.errors = {}
+        self.retries = 0
+        self.coalesced = 0
+
+
+class MetricsRegistry(object):
+    """
+    Thread safe store of the UPS metrics keyed by (carrier id, call type).
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._series = {}
+
+    def _get_series(self, carrier_id, call):
+        key = (carrier_id, call)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = _Series()
+        return series
+
+    def observe(
+            self, carrier_id, call, duration, request_bytes=0,
+            response_bytes=0, error=None):
+        "Record one request sent to UPS"
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if duration <= bound:
+                break
+        else:
+            index = len(LATENCY_BUCKETS)
+        with self._lock:
+            series = self._get_series(carrier_id, call)
+            series.count += 1
+            series.latency_buckets[index] += 1
+            series.latency_sum += duration
+            series.request_bytes += request_bytes
+            series.response_bytes += response_bytes
+            if error:
+                series.errors[error] = series.errors.get(error, 0) + 1
+
+    def retried(self, carrier_id, call):
+        with self._lock:
+            self._get_series(carrier_id, call).retries += 1
+
+    def coalesced(self, carrier_id, call):
+        "Record a request answered with the response of an identical one"
+        with self._lock:
+            self._get_series(carrier_id, call).coalesced += 1
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+    def snapshot(self):
+        """
+        Return the metrics as a list of dictionaries, one per carrier and
+        call type. Latency buckets are cumulative as in Prometheus.
+        """
+        result = []
+        with self._lock:
+            for (carrier_id, call), series in sorted(self._series.items()):
+                cumulative, buckets = 0, []
+                for bound, count in zip(
+                        LATENCY_BUCKETS + ('+Inf',), series.latency_buckets):
+                    cumulative += count
+                    buckets.append((bound, cumulative))
+                result.append({
+                    'carrier': carrier_id,
+                    'call': call,
+                    'count': series.count,
+                    'latency_buckets': buckets,
+                    'latency_sum': series.latency_sum,
+                    'request_bytes': series.request_bytes,
+                    'response_bytes': series.response_bytes,
+                    'errors': dict(series.errors),
+                    'retries': series.retries,
+                    'coalesced': series.coalesced,
+                })
+        return result
+
+    def to_prometheus(self):
+        "Return the metrics in the Prometheus text exposition format"
+        snapshot = self.snapshot()
+        lines = []
+
+        def header(name, type_, help_):
+            lines.append('# HELP %s %s' % (name, help_))
+            lines.append('# TYPE %s %s' % (name, type_))
+
+        def labels(values, **extra):
+            items = [
+                ('carrier', values['carrier']), ('call', values['call'])
+            ] + sorted(extra.items())
+            return '{%s}' % ','.join(
+                '%s="%s"' % (key, unicode(value).replace('"', '\\"'))
+                for key, value in items
+            )
+
+        header(
+            'ups_request_duration_seconds', 'histogram',
+            'Duration of the requests sent to UPS'
+        )
+        for values in snapshot:
+            for bound, count in values['latency_buckets']:
+                lines.append('ups_request_duration_seconds_bucket%s %d' % (
+                    labels(values, le=bound), count
+                ))
+            lines.append('ups_request_duration_seconds_sum%s %f' % (
+                labels(values), values['latency_sum']
+            ))
+            lines.append('ups_request_duration_seconds_count%s %d' % (
+                labels(values), values['count']
+            ))
+
+        for name, key, help_ in [
+            ('ups_request_bytes_total', 'request_bytes',
+                'Size of the requests sent to UPS'),
+            ('ups_response_bytes_total', 'response_bytes',
+                'Size of the responses received from UPS'),
+            ('ups_request_retries_total', 'retries',
+                'Requests sent again after a network error'),
+            ('ups_request_coalesced_total', 'coalesced',
+                'Requests answered with the response of an identical one'),
+        ]:
+            header(name, 'counter', help_)
+            for values in snapshot:
+                lines.append('%s%s %d' % (name, labels(values), values[key]))
+
+        header(
+            'ups_request_errors_total', 'counter',
+            'Requests which failed, by UPS error code'
+        )
+        for values in snapshot:
+            for code, count in sorted(values['errors'].items()):
+                lines.append('ups_request_errors_total%s %d' % (
+                    labels(values, code=code), count
+                ))
+        return '\n'.join(lines) + '\n'
+
+
+#: Metrics of the current process
+registry = MetricsRegistry()
+
+
+class InstrumentedClient(object):
+    """
+    Proxy of a PyUPS API client recording the metrics of its requests.
+    Everything but `request` is delegated to the wrapped client.
+    """
+
+    def __init__(self, client, carrier_id, call, retries=0, record=True):
+        self._client = client
+        self._record = record
+        self._carrier_id = carrier_id
+        self._call = call
+        self._retries = retries if call in IDEMPOTENT_CALLS else 0
+        self._sizes = None
+
+        send_request = client.send_request
+
+        def _send_request(url, data):
+            self._sizes = (len(data), 0)
+            result = send_request(url, data)
+            self._sizes = (len(data), len(result))
+            return result
+        # request looks up send_request on the instance
+        client.send_request = _send_request
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def set_sizes(self, request_bytes, response_bytes):
+        "Record the sizes of a request sent without `send_request`"
+        self._sizes = (request_bytes, response_bytes)
+
+    def request(self, *args, **kwargs):
+        return self.call(lambda client: client.request(*args, **kwargs))
+
+    def call(self, func):
+        """
+        Return func called with the wrapped client, the request it sends is
+        recorded and retried as the ones of `request`.
+        """
+        attempt = 0
+        while True:
+            self._sizes = None
+            error = None
+            start = time.time()
+            try:
+                return func(self._client)
+            except NETWORK_ERRORS, exc:
+                error = parse_error_code(exc)
+                if attempt < self._retries:
+                    attempt += 1
+                    if self._record:
+                        registry.retried(self._carrier_id, self._call)
+                    continue
+                raise
+            except Exception, exc:
+                error = parse_error_code(exc)
+                raise
+            finally:
+                if self._record:
+                    request_bytes, response_bytes = self._sizes or (0, 0)
+                    registry.observe(
+                        self._carrier_id, self._call, time.time() - start,
+                        request_bytes, response_bytes, error
+                    )
+
+
+def instrument(client, carrier_id, call):
+    """
+    Wrap client in an :class:`InstrumentedClient` if metrics or retries are
+    enabled, return it untouched otherwise.
+    """
+    if client is None:
+        return client
+    record, retries = is_enabled(), get_retries()
+    if not record and not (retries and call in IDEMPOTENT_CALLS):
+        return client
+    return InstrumentedClient(client, carrier_id, call, retries, record)
+
+
+class _NullPhase(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+
+class PhaseTimer(object):
+    """
+    Accumulate the time spent in the named phases of an operation::
+
+        timer = PhaseTimer()
+        with timer.phase('confirm'):
+            ...
+        timer.phases  # {'confirm': 0.82}
+
+    A disabled timer does not measure anything.
+    """
+    _null_phase = _NullPhase()
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.phases = {}
+        self._start = time.time()
+        self._end = None
+        self._added = 0
+
+    @contextmanager
+    def _phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.time() - start
+
+    def phase(self, name):
+        if not self.enabled:
+            return self._null_phase
+        return self._phase(name)
+
+    def add(self, name, duration):
+        "Add duration seconds measured elsewhere to the phase and the total"
+        if self.enabled:
+            self.phases[name] = self.phases.get(name, 0) + duration
+            self._added += duration
+
+    def stop(self):
+        "Stop the clock of the total, phases can still be added"
+        if self._end is None:
+            self._end = time.time()
+
+    @property
+    def total(self):
+        return (self._end or time.time()) - self._start + self._added
+
+
+def percentile(values, percent):
+    "Return the nearest-rank percentile of values"
+    if not values:
+        return None
+    values = sorted(values)
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
@@ -10,12 +10,11 @@ from orderedset import OrderedSet
 from lxml import etree
 from logbook import Logger
 
-from ups.worldship_api import WorldShip
-from ups.shipping_package import ShipmentConfirm
-from ups.base import PyUPSException
 from trytond.pool import Pool, PoolMeta
 from trytond.transaction import Transaction
 
+from ups_api import ups
+
 
 __all__ = ['Address']
 __metaclass__ = PoolMeta
@@ -74,7 +73,7 @@ class Address:
         if self.zip:
             vals['PostalCode'] = self.zip
 
-        return ShipmentConfirm.address_type(**vals)
+        return ups.ShipmentConfirm.address_type(**vals)
 
     def to_ups_from_address(self):
         '''
@@ -122,7 +121,7 @@ class Address:
         if email:
             vals['EMailAddress'] = email
 
-        return ShipmentConfirm.ship_from_type(
+        return ups.ShipmentConfirm.ship_from_type(
             self._get_ups_address_xml(), **vals)
 
     def to_ups_to_address(self):
@@ -165,7 +164,9 @@ class Address:
 
         # TODO: LocationID is optional
 
-        return ShipmentConfirm.ship_to_type(self._get_ups_address_xml(), **vals)
+        return ups.ShipmentConfirm.ship_to_type(
+            self._get_ups_address_xml(), **vals
+        )
 
     def to_ups_shipper(self, carrier):
         '''
@@ -214,7 +215,7 @@ class Address:
         if email:
             vals['EMailAddress'] = email
 
-        return ShipmentConfirm.shipper_type(
+        return ups.ShipmentConfirm.shipper_type(
             self._get_ups_address_xml(),
             **vals
         )
@@ -284,7 +285,7 @@ class Address:
                 '\n--------END RESPONSE--------'
                 % etree.tostring(address_response, pretty_print=True)
             )
-        except PyUPSException, exc:
+        except ups.PyUPSException, exc:
             self.raise_user_error(unicode(exc[0]))
 
         if (len(address_response.AddressValidationResult) == 1) and \
@@ -390,11 +391,11 @@ class Address:
         """
         values = self.to_worldship_address()
         values['CompanyOrName'] = self.name or self.party.name
-        return WorldShip.ship_to_type(**values)
+        return ups.WorldShip.ship_to_type(**values)
 
     def to_worldship_from_address(self):
         """
         Return xml object from address
         """
         values = self.to_worldship_address()
-        return WorldShip.ship_from_type(**values)
+        return ups.WorldShip.ship_from_type(**values)
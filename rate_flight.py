@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+    rate_flight.py
+
+    Coalescing of identical rate requests: while a request is sent to UPS,
+    the identical requests wait for it and share its response instead of
+    being sent too.
+
+    Requests are coalesced between the threads of a server process, and
+    between processes on PostgreSQL when enabled::
+
+        [ups]
+        # Default is True
+        coalesce_rates = True
+        coalesce_rates_across_workers = True
+        # Seconds a process waits for the request of another one, default
+        # is 10
+        coalesce_rates_timeout = 10
+
+    The response is shared serialized, each caller gets its own tree.
+
+    A process waiting for another one holds a connection of its pool and
+    waits on an advisory lock for the duration of the UPS request. After
+    `coalesce_rates_timeout` it sends the request itself.
+
+"""
+import sys
+import hashlib
+import datetime
+from threading import Lock, Event
+
+from logbook import Logger
+from lxml import etree, objectify
+
+from trytond import backend
+from trytond.config import config
+from trytond.model import fields, ModelSQL
+from trytond.transaction import Transaction
+
+from metrics import is_enabled, registry
+
+__all__ = ['SingleFlight', 'RateFlight', 'get_fingerprint']
+
+logger = Logger('trytond_ups')
+
+#: Age of the stored responses deleted when a new one is stored
+PURGE_DELAY = datetime.timedelta(hours=1)
+
+
+def is_coalescing_enabled():
+    return config.getboolean('ups', 'coalesce_rates', default=True)
+
+
+def is_coalescing_across_workers_enabled():
+    return config.getboolean(
+        'ups', 'coalesce_rates_across_workers', default=False
+    )
+
+
+def get_timeout():
+    return config.getfloat('ups', 'coalesce_rates_timeout', default=10)
+
+
+def get_fingerprint(carrier, request):
+    "Return the fingerprint of the request sent with the carrier account"
+    digest = hashlib.sha1(str(carrier.id))
+    digest.update(etree.tostring(request, method='c14n'))
+    return digest.hexdigest()
+
+
+class _Call(object):
+    "Request in flight"
+
+    def __init__(self):
+        self.event = Event()
+        self.result = None
+        self.exc_info = None
+
+
+class SingleFlight(object):
+    """
+    Run a function once for the concurrent calls with the same key, the
+    other callers wait for its end and get its result or exception.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._calls = {}
+
+    def do(self, key, func):
+        "Return (result of func, whether it came from another call)"
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.event.wait()
+            if call.exc_info:
+                raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+            return call.result, True
+
+        try:
+            call.result = func()
+        except Exception:
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result, False
+
+
+#: Rate requests in flight in the current process
+flights = SingleFlight()
+
+
+class RateFlight(ModelSQL):
+    """
+    UPS Rate Flight
+
+    Last response received for a rate request, shared with the processes
+    which waited for it. Requests are serialized by a PostgreSQL advisory
+    lock on their fingerprint.
+    """
+    __name__ = 'shipping.ups.rate.flight'
+
+    fingerprint = fields.Char('Fingerprint', required=True, select=True)
+    response = fields.Text('Response', required=True)
+
+    @staticmethod
+    def _get_lock_id(fingerprint):
+        # Advisory locks are keyed by a signed 64 bits integer
+        return int(fingerprint[:15], 16)
+
+    @classmethod
+    def _get_response(cls, fingerprint):
+        with Transaction().new_transaction(readonly=True):
+            records = cls.search([
+                ('fingerprint', '=', fingerprint),
+            ], order=[('id', 'DESC')], limit=1)
+            if records:
+                return objectify.fromstring(records[0].response)
+
+    @classmethod
+    def _set_response(cls, fingerprint, response):
+        purge_date = datetime.datetime.now() - PURGE_DELAY
+        with Transaction().new_transaction():
+            cls.delete(cls.search([
+                'OR',
+                ('fingerprint', '=', fingerprint),
+                ('create_date', '<', purge_date),
+            ]))
+            if response is not None:
+                cls.create([{
+                    'fingerprint': fingerprint,
+                    'response': etree.tostring(response),
+                }])
+
+    @classmethod
+    def do(cls, fingerprint, func):
+        """
+        Return (result of func, whether it came from another process). When
+        a process is already sending the request, wait for it and return
+        its response. The request is sent again if that process failed or
+        did not answer within the timeout.
+        """
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+        lock_id = cls._get_lock_id(fingerprint)
+        # The session lock is held by its own connection, so it does not
+        # depend on the end of the current transaction
+        with Transaction().new_transaction(autocommit=True) as transaction:
+            cursor = transaction.connection.cursor()
+            cursor.execute('SELECT pg_try_advisory_lock(%s)', (lock_id,))
+            leader, = cursor.fetchone()
+            locked = leader
+            if not leader:
+                cursor.execute(
+                    'SET lock_timeout = %s', (int(get_timeout() * 1000),)
+                )
+                try:
+                    cursor.execute('SELECT pg_advisory_lock(%s)', (lock_id,))
+                    locked = True
+                except DatabaseOperationalError:
+                    pass
+                finally:
+                    cursor.execute('RESET lock_timeout')
+            if locked:
+                try:
+                    if not leader:
+                        response = cls._get_response(fingerprint)
+                        if response is not None:
+                            return response, True
+                    # Responses of previous flights must not be shared
+                    cls._set_response(fingerprint, None)
+                    response = func()
+                    cls._set_response(fingerprint, response)
+                    return response, False
+                finally:
+                    cursor.execute(
+                        'SELECT pg_advisory_unlock(%s)', (lock_id,)
+                    )
+        logger.debug(
+            'Rate request %s in flight for too long, sent again' % fingerprint
+        )
+        return func(), False
+
+    @classmethod
+    def request(cls, carrier, rate_api, rate_request, on_response=None):
+        """
+        Send the rate request to UPS unless an identical request is in
+        flight, in which case its response is returned.
+
+        on_response is called with the response when it is received from
+        UPS, in the transaction of the caller, not with the shared ones.
+        lxml trees can not be used by several threads, the callers sharing
+        a response get their own tree.
+        """
+        if not is_coalescing_enabled():
+            response = rate_api.request(rate_request)
+            if on_response:
+                on_response(response)
+            return response
+        fingerprint = get_fingerprint(carrier, rate_request)
+        # Tree of the response of the thread which sent the request
+        received = []
+
+        def send():
+            if (is_coalescing_across_workers_enabled()
+                    and backend.name() == 'postgresql'):
+                response, shared = cls.do(
+                    fingerprint, lambda: rate_api.request(rate_request)
+                )
+            else:
+                response, shared = rate_api.request(rate_request), False
+            if on_response and not shared:
+                on_response(response)
+            received.append(response)
+            return etree.tostring(response), shared
+
+        (data, shared), waited = flights.do(fingerprint, send)
+        if received:
+            response, = received
+        else:
+            response = objectify.fromstring(data)
+        if shared or waited:
+            logger.debug(
+                'Rate request %s answered with the response of an '
+                'identical request' % fingerprint
+            )
+            if is_enabled():
+                registry.coalesced(carrier.id, 'rate')
+        return response
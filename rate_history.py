@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+"""
+    rate_history.py
+
+    History of the rates quoted by UPS, one record per service of each rate
+    response, to feed rate caching, estimation and spend analytics.
+
+    Quotes are only appended, a daily cron deletes the ones older than the
+    retention. They are written with the transaction rating, the quotes of
+    the read-only transactions are buffered and written by batches::
+
+        [ups]
+        # Default is True
+        rate_history = True
+        # Days the quotes are kept, default is 90
+        rate_history_days = 90
+
+"""
+import math
+import time
+import datetime
+from decimal import Decimal
+from threading import Lock
+
+from sql import Cast
+from sql.aggregate import Count, Min, Max, Avg
+
+from trytond import backend
+from trytond.config import config
+from trytond.model import fields, ModelSQL, ModelView
+from trytond.pool import Pool
+from trytond.rpc import RPC
+from trytond.transaction import Transaction
+
+__all__ = ['RateHistory']
+
+#: Days the quotes are kept by default
+DEFAULT_RETENTION = 90
+
+#: Columns of the composite indexes, lane lookups filter on a prefix of
+#: them and on the date
+INDEXES = [
+    ['origin_zip3', 'destination_zip3', 'service_code', 'weight_bracket',
+        'date'],
+    ['carrier', 'date'],
+]
+
+#: Quotes buffered by the read-only transactions are written in a new
+#: transaction once there are as many or the oldest is that old (seconds)
+FLUSH_SIZE = 100
+FLUSH_DELAY = 60
+#: Quotes buffered at most per database, the oldest are dropped
+MAX_PENDING = 10000
+
+_lock = Lock()
+#: (time of the first quote, quotes) waiting to be written, by database
+_pending = {}
+
+
+def is_enabled():
+    return config.getboolean('ups', 'rate_history', default=True)
+
+
+def get_retention():
+    return config.getint('ups', 'rate_history_days', default=DEFAULT_RETENTION)
+
+
+def get_zip3(address):
+    "Return the first 3 characters of the postal code of address"
+    return (address.zip or '').replace(' ', '')[:3].upper() or None
+
+
+class RateHistory(ModelSQL, ModelView):
+    "UPS Rate History"
+    __name__ = 'shipping.ups.rate.history'
+
+    date = fields.DateTime('Date', required=True, readonly=True, select=True)
+    carrier = fields.Many2One(
+        'carrier', 'Carrier', required=True, readonly=True,
+        ondelete='CASCADE'
+    )
+    origin_country = fields.Many2One(
+        'country.country', 'Origin Country', readonly=True
+    )
+    origin_zip3 = fields.Char('Origin ZIP3', size=3, readonly=True)
+    destination_country = fields.Many2One(
+        'country.country', 'Destination Country', readonly=True
+    )
+    destination_zip3 = fields.Char('Destination ZIP3', size=3, readonly=True)
+    service_code = fields.Char('Service Code', required=True, readonly=True)
+    weight_bracket = fields.Integer(
+        'Weight Bracket', readonly=True,
+        help='Billable weight rounded up to the next unit'
+    )
+    weight_uom_code = fields.Char('Weight UOM Code', readonly=True)
+    currency = fields.Many2One(
+        'currency.currency', 'Currency', required=True, readonly=True
+    )
+    published_cost = fields.Numeric(
+        'Published Cost', digits=(16, 2), required=True, readonly=True
+    )
+    negotiated_cost = fields.Numeric(
+        'Negotiated Cost', digits=(16, 2), readonly=True
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(RateHistory, cls).__setup__()
+        cls._order.insert(0, ('date', 'DESC'))
+        cls._error_messages.update({
+            'append_only': 'The UPS rate history can not be modified.',
+        })
+        cls.__rpc__.update({
+            'get_lane_statistics': RPC(readonly=True),
+        })
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+
+        super(RateHistory, cls).__register__(module_name)
+
+        table = TableHandler(cls, module_name)
+        for columns in INDEXES:
+            table.index_action(columns, 'add')
+
+    @staticmethod
+    def default_date():
+        return datetime.datetime.now()
+
+    @classmethod
+    def write(cls, *args):
+        cls.raise_user_error('append_only')
+
+    @classmethod
+    def _create_quotes(cls, vlist):
+        """
+        Create the quotes in the current transaction with the ones buffered
+        before. A read-only transaction buffers them, they are created in a
+        new transaction every FLUSH_SIZE quotes or FLUSH_DELAY seconds
+        (SQLite allows only one writer, they wait for a writable one).
+        """
+        transaction = Transaction()
+        database_name = transaction.database.name
+        now = time.time()
+        with _lock:
+            since, pending = _pending.pop(database_name, (now, []))
+            pending.extend(vlist)
+            del pending[:-MAX_PENDING]
+            wait = backend.name() == 'sqlite' or (
+                len(pending) < FLUSH_SIZE and now - since < FLUSH_DELAY)
+            if transaction.readonly and wait:
+                if pending:
+                    _pending[database_name] = (since, pending)
+                return
+        if not pending:
+            return
+        if transaction.readonly:
+            with transaction.new_transaction():
+                cls.create(pending)
+        else:
+            cls.create(pending)
+
+    @classmethod
+    def _get_quotes(cls, carrier, response):
+        "Yield the values of each rated service of a rate response"
+        for rated_shipment in response.iterchildren(tag='RatedShipment'):
+            values = {
+                'service_code': rated_shipment.Service.Code.text,
+                'currency_code': (
+                    rated_shipment.TotalCharges.CurrencyCode.text),
+                'published_cost': Decimal(str(
+                    rated_shipment.TotalCharges.MonetaryValue
+                )),
+                'weight_uom_code': carrier.ups_weight_uom_code,
+            }
+            if hasattr(rated_shipment, 'NegotiatedRates'):
+                values['negotiated_cost'] = Decimal(str(
+                    rated_shipment.NegotiatedRates.NetSummaryCharges.GrandTotal.MonetaryValue  # noqa
+                ))
+            billing_weight = getattr(rated_shipment, 'BillingWeight', None)
+            if billing_weight is not None:
+                values['weight_bracket'] = int(math.ceil(
+                    float(billing_weight.Weight)
+                ))
+                values['weight_uom_code'] = (
+                    billing_weight.UnitOfMeasurement.Code.text)
+            yield values
+
+    @classmethod
+    def record(cls, carrier, from_address, to_address, response):
+        """
+        Store the quotes of the rate response received by carrier for a
+        shipment from from_address to to_address. It must be called once
+        per response received from UPS, not for the shared responses.
+        """
+        Currency = Pool().get('currency.currency')
+
+        if not is_enabled():
+            return
+        quotes = list(cls._get_quotes(carrier, response))
+        if not quotes:
+            return
+        currencies = dict(
+            (c['code'], c['id']) for c in Currency.search_read([
+                ('code', 'in', list(set(q['currency_code'] for q in quotes))),
+            ], fields_names=['code'])
+        )
+        lane = {
+            'date': datetime.datetime.now(),
+            'carrier': carrier.id,
+            'origin_country': (
+                from_address.country and from_address.country.id),
+            'origin_zip3': get_zip3(from_address),
+            'destination_country': (
+                to_address.country and to_address.country.id),
+            'destination_zip3': get_zip3(to_address),
+        }
+        vlist = []
+        for quote in quotes:
+            currency = currencies.get(quote.pop('currency_code'))
+            if currency is None:
+                continue
+            quote.update(lane, currency=currency)
+            vlist.append(quote)
+        cls._create_quotes(vlist)
+
+    @classmethod
+    def purge(cls, days=None):
+        "Delete the quotes older than days (the retention by default)"
+        if days is None:
+            days = get_retention()
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        limit = datetime.datetime.now() - datetime.timedelta(days=days)
+        # One statement, the history can be large
+        cursor.execute(*table.delete(where=table.date < limit))
+
+    @classmethod
+    def purge_rate_history_cron(cls):
+        "Cron to delete the quotes past the retention"
+        cls._create_quotes([])
+        cls.purge()
+
+    @classmethod
+    def get_lane_statistics(
+            cls, origin_zip3, destination_zip3, service_code=None,
+            weight_bracket=None, days=None):
+        """
+        Return the statistics of the quotes of the lane in the last days
+        (the retention by default), one dictionary per service code, weight
+        bracket and currency with the `count` of quotes, the `min_cost`,
+        `avg_cost` and `max_cost` published, the `avg_negotiated_cost` and
+        the `last_date` quoted.
+        """
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        if days is None:
+            days = get_retention()
+        where = (
+            (table.origin_zip3 == origin_zip3)
+            & (table.destination_zip3 == destination_zip3)
+            & (table.date >= (
+                datetime.datetime.now() - datetime.timedelta(days=days)))
+        )
+        if service_code is not None:
+            where &= table.service_code == service_code
+        if weight_bracket is not None:
+            where &= table.weight_bracket == weight_bracket
+        group_by = [
+            table.service_code, table.weight_bracket, table.weight_uom_code,
+            table.currency,
+        ]
+        # SQLite stores the numerics as strings
+        type_ = cls.published_cost.sql_type().base
+        published_cost = Cast(table.published_cost, type_)
+        cursor.execute(*table.select(*(group_by + [
+                        Count(table.id), Min(published_cost),
+                        Avg(published_cost), Max(published_cost),
+                        Avg(Cast(table.negotiated_cost, type_)),
+                        Max(table.date),
+                        ]),
+                where=where, group_by=group_by))
+
+        def cost(value):
+            if value is None:
+                return None
+            return Decimal(str(value)).quantize(Decimal('0.01'))
+
+        def date(value):
+            # Aggregates are not converted by SQLite
+            if isinstance(value, basestring):
+                value = datetime.datetime.strptime(
+                    value, '%Y-%m-%d %H:%M:%S.%f'
+                    if '.' in value else '%Y-%m-%d %H:%M:%S'
+                )
+            return value
+
+        result = []
+        for row in cursor.fetchall():
+            (service, bracket, uom_code, currency, count, min_cost,
+                avg_cost, max_cost, avg_negotiated_cost, last_date) = row
+            result.append({
+                'service_code': service,
+                'weight_bracket': bracket,
+                'weight_uom_code': uom_code,
+                'currency': currency,
+                'count': count,
+                'min_cost': cost(min_cost),
+                'avg_cost': cost(avg_cost),
+                'max_cost': cost(max_cost),
+                'avg_negotiated_cost': cost(avg_negotiated_cost),
+                'last_date': date(last_date),
+            })
+        return result
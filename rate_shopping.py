@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+    rate_shopping.py
+
+    Rate shopping across UPS carrier accounts: the rate requests of all the
+    carriers are sent at once and only the responses received before a
+    shared deadline are used::
+
+        [ups]
+        # Seconds, default is 10
+        rate_shopping_timeout = 10
+
+"""
+import sys
+import time
+import copy
+from threading import Thread
+
+from trytond.config import config
+
+__all__ = ['call_all', 'get_cached_elements', 'get_timeout']
+
+#: Seconds given to the carriers to answer
+DEFAULT_TIMEOUT = 10
+
+
+def get_timeout():
+    return config.getfloat(
+        'ups', 'rate_shopping_timeout', default=DEFAULT_TIMEOUT
+    )
+
+
+class _Call(Thread):
+    "Function run in its own thread"
+
+    def __init__(self, func):
+        super(_Call, self).__init__()
+        # Calls still running at the deadline must not block the process
+        self.daemon = True
+        self.func = func
+        self.result = None
+        self.exception = None
+
+    def run(self):
+        try:
+            self.result = self.func()
+        except Exception:
+            self.exception = sys.exc_info()[1]
+
+
+def call_all(funcs, timeout):
+    """
+    Run the functions concurrently and return, for each one, its (result,
+    exception) or None if it did not end within timeout seconds. The calls
+    past the deadline are left to end on their own.
+
+    The functions run outside of the transaction, they must not use the
+    pool.
+    """
+    deadline = time.time() + timeout
+    calls = [_Call(func) for func in funcs]
+    for call in calls:
+        call.start()
+    results = []
+    for call in calls:
+        call.join(max(deadline - time.time(), 0))
+        if call.is_alive():
+            results.append(None)
+        else:
+            results.append((call.result, call.exception))
+    return results
+
+
+def get_cached_elements(ups_cache, key, build):
+    """
+    Return the XML elements returned by build, called once per key when
+    ups_cache is given. Elements can only have one parent, so copies of
+    the cached ones are returned.
+    """
+    if ups_cache is None:
+        return build()
+    if key not in ups_cache:
+        ups_cache[key] = build()
+    return map(copy.deepcopy, ups_cache[key])
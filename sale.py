@@ -4,15 +4,18 @@
 
 """
 from decimal import Decimal
+from functools import partial
 from logbook import Logger
 
 from lxml import etree
 from lxml.builder import E
-from ups.rating_package import RatingService
-from ups.base import PyUPSException
 from trytond.model import fields
 from trytond.pool import PoolMeta, Pool
 
+from cartonization import pack
+from rate_shopping import get_cached_elements
+from ups_api import ups
+
 __all__ = ['Configuration', 'Sale']
 __metaclass__ = PoolMeta
 
@@ -51,7 +54,7 @@ class Sale:
         return False
 
     def get_shipping_rate(self, carrier, carrier_service=None, silent=False):
-        Currency = Pool().get('currency.currency')
+        RateFlight = Pool().get('shipping.ups.rate.flight')
 
         if carrier.carrier_cost_method != 'ups':
             return super(Sale, self).get_shipping_rate(
@@ -74,14 +77,18 @@ class Sale:
         )
 
         try:
-            response = rate_api.request(rate_request)
+            # Identical requests in flight share one response
+            response = RateFlight.request(
+                carrier, rate_api, rate_request,
+                on_response=partial(self._record_ups_rates, carrier)
+            )
             # Logging.
             logger.debug(
                 '--------START RATE API RESPONSE--------\n%s'
                 '\n--------END RESPONSE--------'
                 % etree.tostring(response, pretty_print=True)
             )
-        except PyUPSException, e:
+        except ups.PyUPSException, e:
             if silent:
                 return []
 
@@ -102,6 +109,24 @@ class Sale:
                 self.raise_user_error('WeightExceed: %s' % unicode(error[1]))
             self.raise_user_error(unicode(e[0]))
 
+        return self._get_ups_rates(carrier, response)
+
+    def _record_ups_rates(self, carrier, response):
+        "Store the quotes of a rate response received from UPS"
+        RateHistory = Pool().get('shipping.ups.rate.history')
+
+        RateHistory.record(
+            carrier, self._get_ship_from_address(), self.shipment_address,
+            response
+        )
+
+    def _get_ups_rates(self, carrier, response):
+        """
+        Return the rates of the services of carrier found in the response of
+        a UPS rate request
+        """
+        Currency = Pool().get('currency.currency')
+
         rates = []
         for rated_shipment in response.iterchildren(tag='RatedShipment'):
             for service in carrier.services:
@@ -155,9 +180,66 @@ class Sale:
             rates.append(rate)
         return rates
 
-    def _get_rate_request_xml(self, carrier, carrier_service):
+    def _get_rate_request_xml(
+            self, carrier, carrier_service, ups_cache=None):
+        """
+        Return the rate request of the sale for carrier.
+
+        :param ups_cache: Optional dict shared by the requests of several
+            carriers, the elements which do not depend on the account of
+            the carrier are then built once.
+        """
+        from_address = self._get_ship_from_address()
+
+        # Packing only depends on the boxes and the UOMs of the carrier
+        shipment_args = get_cached_elements(ups_cache, (
+            'sale_rate_packages', self.id, carrier.ups_uom_system,
+            tuple(carrier.get_ups_boxes()),
+        ), lambda: self._get_ups_rate_packages(carrier))
+        shipment_args.append(
+            from_address.to_ups_shipper(carrier=carrier)  # Shipper
+        )
+        shipment_args.extend(get_cached_elements(ups_cache, (
+            'ship_to_from', self.shipment_address.id, from_address.id
+        ), lambda: [
+            self.shipment_address.to_ups_to_address(),  # Ship to
+            from_address.to_ups_from_address(),         # Ship from
+        ]))
+
+        if carrier.ups_negotiated_rates:
+            shipment_args.append(
+                ups.RatingService.rate_information_type(negotiated=True)
+            )
+
+        if carrier_service:
+            # TODO: handle ups_saturday_delivery
+            shipment_args.append(
+                ups.RatingService.service_type(Code=carrier_service.code)
+            )
+            request_option = E.RequestOption('Rate')
+        else:
+            request_option = E.RequestOption('Shop')
+
+        return ups.RatingService.rating_request_type(
+            E.Shipment(*shipment_args), RequestOption=request_option
+        )
+
+    def _get_ups_rate_packages(self, carrier):
+        """
+        Return the packages of the rate request: the lines packed into the
+        box types of the carrier which have dimensions, or the whole sale
+        in the box type of the sale configuration if there are none.
+        """
+        boxes = carrier.get_ups_boxes()
+        if boxes:
+            cartons = pack(
+                self._get_ups_cartonization_items(carrier), boxes,
+                carrier.ups_max_weight
+            )
+            if cartons:
+                return self._get_ups_carton_packages(carrier, cartons)
+
         SaleConfiguration = Pool().get("sale.configuration")
-        Uom = Pool().get('product.uom')
         config = SaleConfiguration(1)
 
         code = length = width = height = dimensions_symbol = None
@@ -170,23 +252,24 @@ class Sale:
             dimensions_symbol = box_type.distance_unit and \
                 box_type.distance_unit.symbol.upper()
 
-        package_type = RatingService.packaging_type(Code=code)
+        package_type = ups.RatingService.packaging_type(Code=code)
 
-        package_weight = RatingService.package_weight_type(
-            Weight="%.2f" % Uom.compute_qty(
-                self.weight_uom, self.weight, carrier.ups_weight_uom
+        package_weight = ups.RatingService.package_weight_type(
+            Weight="%.2f" % carrier.ups_convert_weight(
+                self.weight, self.weight_uom
             ),
             Code=carrier.ups_weight_uom_code,
         )
-        package_service_options = RatingService.package_service_options_type(
-            RatingService.insured_value_type(MonetaryValue='0')
-        )
+        package_service_options = \
+            ups.RatingService.package_service_options_type(
+                ups.RatingService.insured_value_type(MonetaryValue='0')
+            )
 
         args = [package_type, package_weight, package_service_options]
 
         # Only send dimensions if box type has all information
         if length and width and height and dimensions_symbol:
-            package_dimensions = RatingService.dimensions_type(
+            package_dimensions = ups.RatingService.dimensions_type(
                 Code=dimensions_symbol,
                 Length=str(length),
                 Width=str(width),
@@ -194,34 +277,58 @@ class Sale:
             )
             args.append(package_dimensions)
 
-        shipment_args = [RatingService.package_type(*args)]
-
-        from_address = self._get_ship_from_address()
-
-        shipment_args.extend([
-            from_address.to_ups_shipper(carrier=carrier),  # Shipper
-            self.shipment_address.to_ups_to_address(),      # Ship to
-            from_address.to_ups_from_address(),   # Ship from
-
-        ])
-
-        if carrier.ups_negotiated_rates:
-            shipment_args.append(
-                RatingService.rate_information_type(negotiated=True)
-            )
-
-        if carrier_service:
-            # TODO: handle ups_saturday_delivery
-            shipment_args.append(
-                RatingService.service_type(Code=carrier_service.code)
-            )
-            request_option = E.RequestOption('Rate')
-        else:
-            request_option = E.RequestOption('Shop')
-
-        return RatingService.rating_request_type(
-            E.Shipment(*shipment_args), RequestOption=request_option
+        return [ups.RatingService.package_type(*args)]
+
+    def _get_ups_cartonization_items(self, carrier):
+        """
+        Return the cartonization items of the lines. Lines are read in
+        bulk, large carts are packed for every rate request.
+        """
+        SaleLine = Pool().get('sale.line')
+
+        lines = SaleLine.search_read([
+                ('sale', '=', self.id),
+                ('type', '=', 'line'),
+                ('product', '!=', None),
+                ('quantity', '>', 0),
+                ], order=[('id', 'ASC')],
+            fields_names=['product', 'quantity', 'unit'])
+        return carrier.get_ups_cartonization_items(lines)
+
+    def _get_ups_carton_packages(self, carrier, cartons):
+        "Return the rate request packages of the cartons"
+        BoxType = Pool().get('carrier.box_type')
+
+        box_codes = dict(
+            (b.id, b.code)
+            for b in BoxType.browse([c.box.key for c in cartons if c.box])
         )
+        length_symbol = carrier.ups_length_uom.symbol.upper()
+        packages = []
+        for carton in cartons:
+            length, width, height = carton.dimensions or (None,) * 3
+            code = box_codes[carton.box.key] if carton.box else '02'
+            args = [
+                ups.RatingService.packaging_type(Code=code),
+                ups.RatingService.package_weight_type(
+                    Weight="%.2f" % carton.weight,
+                    Code=carrier.ups_weight_uom_code,
+                ),
+                ups.RatingService.package_service_options_type(
+                    ups.RatingService.insured_value_type(MonetaryValue='0')
+                ),
+            ]
+            # Only send dimensions if the box type is 'Customer Supplied
+            # Package', as Package._get_ups_package_template
+            if code == '02' and carton.dimensions:
+                args.append(ups.RatingService.dimensions_type(
+                    Code=length_symbol,
+                    Length="%.2f" % length,
+                    Width="%.2f" % width,
+                    Height="%.2f" % height,
+                ))
+            packages.append(ups.RatingService.package_type(*args))
+        return packages
 
     def create_shipment(self, shipment_type):
         Shipment = Pool().get('stock.shipment.out')
@@ -3,22 +3,38 @@
     stock.py
 
 """
+import csv
+import copy
 from decimal import Decimal
+from itertools import islice, izip
+from contextlib import contextmanager
 import base64
 from lxml import etree
 from lxml.builder import E
 from logbook import Logger
 
-from ups.shipping_package import ShipmentConfirm, ShipmentAccept
-from ups.rating_package import RatingService
-from ups.base import PyUPSException
-from ups.worldship_api import WorldShip
-from trytond.model import fields, ModelView
+from trytond import backend
+from trytond.model import fields, ModelView, Model
 from trytond.transaction import Transaction
+from trytond.exceptions import UserError
+from trytond.tools import grouped_slice
 from trytond.wizard import Wizard, StateView, Button, StateTransition
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval
 from trytond.rpc import RPC
+from trytond.config import config
+
+from worldship import iter_worldship_files, write_atomic, \
+    process_new_files, own_transaction
+from metrics import PhaseTimer, is_label_timing_enabled, NETWORK_ERRORS
+from label_batch import PDFWriter, ChunkBuffer, check_png_header, \
+    PNG_HEADER_SIZE
+from cartonization import search
+from rate_shopping import get_cached_elements
+from ups_api import ups
+from accept_response import send_raw, parse_header, iter_package_results
+from label_processing import submit, get_processes, process_raw_label
+from filestore import store, read_start
 
 __metaclass__ = PoolMeta
 __all__ = [
@@ -31,6 +47,85 @@ STATES = {
 }
 logger = Logger('trytond_ups')
 
+#: Fields of shipments, packages and moves sent in the confirm request, the
+#: digest confirmed ahead of the labels expires when they change
+UPS_CONFIRM_FIELDS = set([
+    'carrier', 'carrier_service', 'delivery_address', 'warehouse',
+    'ups_saturday_delivery',
+])
+UPS_PACKAGE_FIELDS = set([
+    'shipment', 'box_type', 'length', 'width', 'height', 'distance_unit',
+    'override_weight', 'override_weight_uom', 'moves',
+])
+UPS_MOVE_FIELDS = set(['package', 'product', 'quantity', 'uom'])
+
+
+#: States of the shipments which can be packed automatically
+UPS_AUTO_PACK_STATES = ['draft', 'waiting', 'assigned', 'packed']
+
+#: Seconds spent searching a cheaper package layout by default
+UPS_AUTO_PACK_BUDGET = 0.05
+
+#: Package containers without weight, see
+#: :meth:`Package._get_ups_package_template`
+PACKAGE_TEMPLATES = {}
+PACKAGE_TEMPLATES_SIZE = 1024
+
+
+def ups_changed(records, values, names):
+    """
+    Return the records for which values change one of the fields names.
+    Relations written with other values than ids (like the actions of
+    One2Many) are always changes.
+    """
+    names = names & set(values)
+    changed = []
+    for record in records:
+        for name in names:
+            value = getattr(record, name)
+            if isinstance(value, Model):
+                if values[name] not in (value.id, str(value)):
+                    break
+            elif isinstance(value, (list, tuple)) or values[name] != value:
+                break
+        else:
+            continue
+        changed.append(record)
+    return changed
+
+
+@contextmanager
+def savepoint(name):
+    """
+    Roll back the writes of the block when it raises, the transaction goes
+    on. Not on SQLite where the driver commits before a savepoint.
+    """
+    if backend.name() == 'sqlite':
+        yield
+        return
+    cursor = Transaction().connection.cursor()
+    cursor.execute('SAVEPOINT "%s"' % name)
+    try:
+        yield
+    except Exception:
+        cursor.execute('ROLLBACK TO SAVEPOINT "%s"' % name)
+        raise
+    finally:
+        cursor.execute('RELEASE SAVEPOINT "%s"' % name)
+
+
+def prefetch(records, *names):
+    """
+    Read the field names on all the records.
+
+    Records browsed together, or reached through the same field of records
+    browsed together, share their ids: reading a field on the first one
+    reads it for all of them in a single query and caches the values.
+    """
+    for record in records:
+        for name in names:
+            getattr(record, name)
+
 
 class ShipmentOut:
     "Shipment Out"
@@ -40,10 +135,43 @@ class ShipmentOut:
         "Is Saturday Delivery", states=STATES, depends=['state']
     )
 
+    ups_worldship_exported = fields.Boolean(
+        "Exported to WorldShip", readonly=True, select=True
+    )
+
     @staticmethod
     def default_ups_saturday_delivery():
         return False
 
+    @staticmethod
+    def default_ups_worldship_exported():
+        return False
+
+    @classmethod
+    def copy(cls, shipments, default=None):
+        if default is None:
+            default = {}
+        default = default.copy()
+        default['ups_worldship_exported'] = False
+        return super(ShipmentOut, cls).copy(shipments, default=default)
+
+    @classmethod
+    def write(cls, *args):
+        LabelJournal = Pool().get('shipping.ups.label.journal')
+
+        actions = iter(args)
+        expired = set()
+        for shipments, values in zip(actions, actions):
+            if not (UPS_CONFIRM_FIELDS & set(values)
+                    and LabelJournal.has_expirable(
+                        shipment_ids=[s.id for s in shipments])):
+                continue
+            expired.update(s.id for s in ups_changed(
+                shipments, values, UPS_CONFIRM_FIELDS
+            ))
+        super(ShipmentOut, cls).write(*args)
+        LabelJournal.expire_shipments(expired)
+
     @classmethod
     def __setup__(cls):
         super(ShipmentOut, cls).__setup__()
@@ -60,13 +188,77 @@ class ShipmentOut:
             'invalid_state': 'Labels can only be generated when the '
                 'shipment is in Packed or Done states only',
             'no_packages': 'Shipment %s has no packages',
+            'ups_no_rate': 'UPS returned no rate for shipment %s',
+            'ups_label_batch_mixed_formats': 'The labels of the shipments '
+                'are not all in the same format: %s',
+            'ups_label_not_png': 'Label "%s" is not a PNG image, use the '
+                'PNG label format to print labels in PDF',
+            'ups_label_batch_gif': 'Carrier "%s" makes GIF labels, set its '
+                'label format to PNG to print labels in PDF',
+            'ups_auto_pack_unavailable':
+                'The split moves can not be assigned again, their products '
+                'are not available anymore.',
+            'ups_auto_pack_labelled':
+                'The packages of shipment "%s" have labels, void them '
+                'before packing it again.',
+        })
+        cls._buttons.update({
+            'ups_auto_pack': {
+                'invisible': (
+                    ~Eval('state').in_(UPS_AUTO_PACK_STATES)
+                    | (Eval('carrier_cost_method') != 'ups')
+                ),
+            },
         })
         cls.__rpc__.update({
             'make_ups_labels': RPC(readonly=False, instantiate=0),
             'get_ups_shipping_cost': RPC(readonly=False, instantiate=0),
             'get_worldship_xml': RPC(instantiate=0, readonly=True),
+            'get_worldship_xmls': RPC(instantiate=0, readonly=True),
+            'import_worldship_tracking_numbers': RPC(readonly=False),
         })
 
+    @classmethod
+    def ups_prefetch(cls, shipments):
+        """
+        Load in bulk the records read by the UPS and WorldShip XML builders
+        (moves, products, packages, box types and units of measure) for all
+        the shipments, one level at a time, so that building the requests
+        does not query the database once per move or package.
+        """
+        prefetch(
+            shipments, 'carrier', 'carrier_service', 'delivery_address',
+            'warehouse', 'outgoing_moves', 'packages'
+        )
+
+        moves = [m for s in shipments for m in s.carrier_cost_moves]
+        prefetch(moves, 'product', 'uom', 'quantity', 'unit_price')
+        products = [m.product for m in moves]
+        prefetch(
+            products, 'name', 'code', 'list_price', 'default_uom',
+            'country_of_origin'
+        )
+        prefetch(
+            filter(None, [p.country_of_origin for p in products]), 'code'
+        )
+
+        packages = [p for s in shipments for p in s.packages]
+        prefetch(
+            packages, 'code', 'box_type', 'length', 'width', 'height',
+            'distance_unit', 'override_weight', 'override_weight_uom', 'moves'
+        )
+        box_types = filter(None, [p.box_type for p in packages])
+        prefetch(
+            box_types, 'code', 'length', 'width', 'height', 'distance_unit'
+        )
+
+        for uoms in (
+                [m.uom for m in moves],
+                [p.default_uom for p in products],
+                filter(None, [p.distance_unit for p in packages]),
+                filter(None, [b.distance_unit for b in box_types])):
+            prefetch(uoms, 'symbol', 'category', 'factor', 'rate', 'rounding')
+
     def _get_ups_packages(self):
         """
         Return UPS Packages XML
@@ -77,14 +269,17 @@ class ShipmentOut:
             package_containers.append(package.get_ups_package_container())
         return package_containers
 
-    def _get_ups_packages_rate(self):
+    def _get_ups_packages_rate(self, carrier=None):
         """
-        Return UPS Packages XML for shipping rate
+        Return UPS Packages XML for shipping rate, in the UOMs of carrier
+        (default to the carrier of the shipment)
         """
         package_containers = []
 
         for package in self.packages:
-            package_containers.append(package.get_ups_package_container_rate())
+            package_containers.append(
+                package.get_ups_package_container_rate(carrier)
+            )
         return package_containers
 
     def _get_carrier_context(self):
@@ -98,16 +293,54 @@ class ShipmentOut:
         context['shipment'] = self.id
         return context
 
-    def get_shipping_rate(self, carrier, carrier_service=None, silent=False):
-        Currency = Pool().get('currency.currency')
+    @staticmethod
+    def _get_ups_api_instance(carrier, call, ups_cache=None):
+        """
+        Return the API instance of carrier for call.
+
+        :param ups_cache: Optional dict shared by the shipments processed in
+            one call, the instance is then created once per carrier.
+        """
+        if ups_cache is None:
+            return carrier.ups_api_instance(call=call)
+        key = ('api', carrier.id, call)
+        if key not in ups_cache:
+            ups_cache[key] = carrier.ups_api_instance(call=call)
+        return ups_cache[key]
+
+    def _get_ups_ship_from_xml(self, carrier, ups_cache=None):
+        """
+        Return the Shipper and ShipFrom elements built from the warehouse
+        address.
 
+        :param ups_cache: Optional dict shared by the shipments processed in
+            one call, the elements are then built once per address and
+            carrier and a copy is returned.
+        """
+        from_address = self._get_ship_from_address()
+        key = ('ship_from', from_address.id, carrier.id)
+        if ups_cache is None or key not in ups_cache:
+            elements = (
+                from_address.to_ups_shipper(carrier=carrier),
+                from_address.to_ups_from_address(),
+            )
+            if ups_cache is None:
+                return elements
+            ups_cache[key] = elements
+        return tuple(map(copy.deepcopy, ups_cache[key]))
+
+    def get_shipping_rate(
+            self, carrier, carrier_service=None, silent=False,
+            ups_cache=None):
         if carrier.carrier_cost_method != 'ups':
             return super(ShipmentOut, self).get_shipping_rate(
                 carrier, carrier_service, silent
             )
 
-        rate_request = self._get_rate_request_xml(carrier, carrier_service)
-        rate_api = carrier.ups_api_instance(call="rate")
+        rate_request = self._get_rate_request_xml(
+            carrier, carrier_service, ups_cache
+        )
+        rate_api = self._get_ups_api_instance(carrier, 'rate', ups_cache)
 
         # Logging.
         logger.debug(
@@ -123,13 +356,14 @@ class ShipmentOut:
 
         try:
             response = rate_api.request(rate_request)
+            self._record_ups_rates(carrier, response)
             # Logging.
             logger.debug(
                 '--------START RATE API RESPONSE--------\n%s'
                 '\n--------END RESPONSE--------'
                 % etree.tostring(response, pretty_print=True)
             )
-        except PyUPSException, e:
+        except ups.PyUPSException, e:
             if silent:
                 return []
 
@@ -150,6 +384,24 @@ class ShipmentOut:
                 self.raise_user_error('WeightExceed: %s' % unicode(error[1]))
             self.raise_user_error(unicode(e[0]))
 
+        return self._get_ups_rates(carrier, response)
+
+    def _record_ups_rates(self, carrier, response):
+        "Store the quotes of a rate response received from UPS"
+        RateHistory = Pool().get('shipping.ups.rate.history')
+
+        RateHistory.record(
+            carrier, self._get_ship_from_address(), self.delivery_address,
+            response
+        )
+
+    def _get_ups_rates(self, carrier, response):
+        """
+        Return the rates of the services of carrier found in the response of
+        a UPS rate request
+        """
+        Currency = Pool().get('currency.currency')
+
         rates = []
         for rated_shipment in response.iterchildren(tag='RatedShipment'):
             for service in carrier.services:
@@ -196,34 +448,42 @@ class ShipmentOut:
             rates.append(rate)
         return rates
 
-    def _get_rate_request_xml(self, carrier, carrier_service):
+    def _get_rate_request_xml(
+            self, carrier, carrier_service, ups_cache=None):
 
-        packages = self._get_ups_packages_rate()
+        # Packages only depend on the UOMs of the carrier
+        packages = get_cached_elements(
+            ups_cache, ('rate_packages', self.id, carrier.ups_uom_system),
+            lambda: self._get_ups_packages_rate(carrier)
+        )
 
-        from_address = self._get_ship_from_address()
+        shipper, ship_from = self._get_ups_ship_from_xml(carrier, ups_cache)
+        ship_to, = get_cached_elements(
+            ups_cache, ('ship_to', self.delivery_address.id),
+            lambda: [self.delivery_address.to_ups_to_address()]
+        )
 
         shipment_args = [
-            from_address.to_ups_shipper(carrier=carrier),  # Shipper
-            self.delivery_address.to_ups_to_address(),      # Ship to
-            from_address.to_ups_from_address(),   # Ship from
-
+            shipper,                                    # Shipper
+            ship_to,                                    # Ship to
+            ship_from,                                  # Ship from
         ]
         shipment_args.extend(packages)
         if carrier.ups_negotiated_rates:
             shipment_args.append(
-                RatingService.rate_information_type(negotiated=True)
+                ups.RatingService.rate_information_type(negotiated=True)
             )
 
         if carrier_service:
             # TODO: handle ups_saturday_delivery
             shipment_args.append(
-                RatingService.service_type(Code=self.carrier_service.code)
+                ups.RatingService.service_type(Code=self.carrier_service.code)
             )
             request_option = E.RequestOption('Rate')
         else:
             request_option = E.RequestOption('Shop')
 
-        return RatingService.rating_request_type(
+        return ups.RatingService.rating_request_type(
             E.Shipment(*shipment_args), RequestOption=request_option
         )
 
@@ -256,7 +516,7 @@ class ShipmentOut:
             )
         return charges, currency
 
-    def _get_shipment_confirm_xml(self):
+    def _get_shipment_confirm_xml(self, ups_cache=None):
         """
         Return XML of shipment for shipment_confirm
         """
@@ -267,13 +527,13 @@ class ShipmentOut:
             self.raise_user_error('ups_service_type_missing')
 
         payment_info_prepaid = \
-            ShipmentConfirm.payment_information_prepaid_type(
+            ups.ShipmentConfirm.payment_information_prepaid_type(
                 AccountNumber=carrier.ups_shipper_no
             )
-        payment_info = ShipmentConfirm.payment_information_type(
+        payment_info = ups.ShipmentConfirm.payment_information_type(
             payment_info_prepaid)
         packages = self._get_ups_packages()
-        shipment_service = ShipmentConfirm.shipment_service_option_type(
+        shipment_service = ups.ShipmentConfirm.shipment_service_option_type(
             SaturdayDelivery='1' if self.ups_saturday_delivery
             else 'None'
         )
@@ -281,17 +541,18 @@ class ShipmentOut:
             move.product.name for move in self.carrier_cost_moves
         ])
         from_address = self._get_ship_from_address()
+        shipper, ship_from = self._get_ups_ship_from_xml(carrier, ups_cache)
 
         shipment_args = [
-            from_address.to_ups_shipper(carrier=carrier),
+            shipper,
             self.delivery_address.to_ups_to_address(),
-            from_address.to_ups_from_address(),
-            ShipmentConfirm.service_type(Code=self.carrier_service.code),
+            ship_from,
+            ups.ShipmentConfirm.service_type(Code=self.carrier_service.code),
             payment_info, shipment_service,
         ]
         if carrier.ups_negotiated_rates:
             shipment_args.append(
-                ShipmentConfirm.rate_information_type(negotiated=True)
+                ups.ShipmentConfirm.rate_information_type(negotiated=True)
             )
         if from_address.country.code == 'US' and \
                 self.delivery_address.country.code in ['PR', 'CA']:
@@ -306,25 +567,32 @@ class ShipmentOut:
                 self.raise_user_error("Company is not in context")
 
             company = Company(company_id)
-            shipment_args.append(ShipmentConfirm.invoice_line_total_type(
+            shipment_args.append(ups.ShipmentConfirm.invoice_line_total_type(
                 MonetaryValue=monetary_value,
                 CurrencyCode=company.currency.code
             ))
 
         shipment_args.extend(packages)
-        shipment_confirm = ShipmentConfirm.shipment_confirm_request_type(
-            *shipment_args, Description=description[:35]
+        shipment_confirm = ups.ShipmentConfirm.shipment_confirm_request_type(
+            *shipment_args, Description=description[:35],
+            LabelSpecification=carrier.get_ups_label_specification()
         )
         return shipment_confirm
 
     def generate_shipping_labels(self, **kwargs):
-        Attachment = Pool().get('ir.attachment')
-        Tracking = Pool().get('shipment.tracking')
+        """
+        Generate the UPS labels of the shipment.
+
+        :param ups_cache: Optional dict shared by the shipments processed in
+            one call, see :meth:`make_ups_labels`.
+        :param ups_labels: Optional list to which the labels are added
+            instead of being saved, see :meth:`_save_ups_labels`.
+        """
+        LabelJournal = Pool().get('shipping.ups.label.journal')
 
         if self.carrier_cost_method != "ups":
             return super(ShipmentOut, self).generate_shipping_labels(**kwargs)
 
-        carrier = self.carrier
         if self.state not in ('packed', 'done'):
             self.raise_user_error('invalid_state')
 
@@ -337,8 +605,51 @@ class ShipmentOut:
         if not self.packages:
             self.raise_user_error("no_packages", error_args=(self.id,))
 
-        shipment_confirm = self._get_shipment_confirm_xml()
-        shipment_confirm_instance = carrier.ups_api_instance(call="confirm")
+        timer = PhaseTimer(is_label_timing_enabled())
+        ups_cache = kwargs.get('ups_cache')
+        LabelJournal.lock_shipment(self)
+        entry = LabelJournal.get_pending(self)
+        if entry and entry.state == 'accepted':
+            # Bought by a previous attempt which did not save the labels
+            data = entry.get_accept_response()
+        else:
+            if entry:
+                entry_id, digest = entry.id, entry.digest
+            else:
+                digest = ups.ShipmentConfirm.extract_digest(
+                    self._ups_shipment_confirm(timer, ups_cache)
+                )
+                entry_id = LabelJournal.log_confirm(self, digest)
+            try:
+                data = self._ups_shipment_accept(digest, timer, ups_cache)
+            except UserError:
+                # The digest can not be accepted anymore
+                LabelJournal.expire(entry_id)
+                raise
+            LabelJournal.log_accept(entry_id, data)
+
+        try:
+            label = self._get_ups_label_values(data, timer)
+        finally:
+            data.close()
+        # The time to save is added by _save_ups_labels
+        timer.stop()
+        labels = kwargs.get('ups_labels')
+        if labels is not None:
+            # Saved with the labels of the other shipments of the batch
+            labels.append(label)
+        else:
+            self._save_ups_labels([label])
+
+    def _ups_shipment_confirm(self, timer, ups_cache=None):
+        "Send the shipment confirm request and return the response"
+        carrier = self.carrier
+        with timer.phase('build_xml'):
+            self.ups_prefetch([self])
+            shipment_confirm = self._get_shipment_confirm_xml(ups_cache)
+        shipment_confirm_instance = self._get_ups_api_instance(
+            carrier, 'confirm', ups_cache
+        )
 
         # Logging.
         logger.debug(
@@ -353,7 +664,10 @@ class ShipmentOut:
         )
 
         try:
-            response = shipment_confirm_instance.request(shipment_confirm)
+            with timer.phase('confirm'):
+                response = shipment_confirm_instance.request(
+                    shipment_confirm
+                )
 
             # Logging.
             logger.debug(
@@ -361,14 +675,221 @@ class ShipmentOut:
                 '\n--------END RESPONSE--------'
                 % etree.tostring(response, pretty_print=True)
             )
-        except PyUPSException, e:
+        except ups.PyUPSException, e:
             self.raise_user_error(unicode(e[0]))
+        return response
+
+    def ups_confirm(self, ups_cache=None):
+        """
+        Send the shipment confirm request ahead of the labels. The digest is
+        kept in the label journal for :meth:`generate_shipping_labels` and
+        the quoted charges are stored on the shipment.
+        """
+        LabelJournal = Pool().get('shipping.ups.label.journal')
+
+        LabelJournal.lock_shipment(self)
+        if LabelJournal.get_pending(self):
+            return
+        response = self._ups_shipment_confirm(PhaseTimer(False), ups_cache)
+        LabelJournal.log_confirm(
+            self, ups.ShipmentConfirm.extract_digest(response)
+        )
+        cost, currency = self._get_ups_shipment_cost(response)
+        self.__class__.write([self], {
+            'cost': cost,
+            'cost_currency': currency.id,
+        })
+
+    @classmethod
+    def confirm_ups_shipments_cron(cls):
+        """
+        Confirm the packed shipments of the carriers confirming at pack,
+        unless they were confirmed since their packages last changed.
+        """
+        pool = Pool()
+        Carrier = pool.get('carrier')
+        LabelJournal = pool.get('shipping.ups.label.journal')
+
+        carriers = Carrier.search([
+            ('carrier_cost_method', '=', 'ups'),
+            ('ups_confirm_at_pack', '=', True),
+        ])
+        if not carriers:
+            return
+        shipments = cls.search([
+            ('carrier', 'in', [c.id for c in carriers]),
+            ('state', '=', 'packed'),
+            ('tracking_number', '=', None),
+        ])
+        shipments = LabelJournal.get_to_confirm(
+            [s for s in shipments if s.packages]
+        )
+        # Shipments whose labels are being generated are left for later
+        shipments = LabelJournal.lock_available(shipments)
+        ups_cache = {}
+        for sub_shipments in grouped_slice(shipments):
+            sub_shipments = cls.browse(sub_shipments)
+            cls.ups_prefetch(sub_shipments)
+            for shipment in sub_shipments:
+                error = None
+                try:
+                    with savepoint('ups_confirm'), Transaction().set_context(
+                            company=shipment.company.id):
+                        shipment.ups_confirm(ups_cache)
+                except UserError, e:
+                    error = e.message
+                except ups.PyUPSException, e:
+                    error = unicode(e[0])
+                except NETWORK_ERRORS, e:
+                    error = unicode(e)
+                if error is not None:
+                    logger.warning(
+                        'Shipment {0} not confirmed: {1}'
+                        .format(shipment.id, error)
+                    )
+                    LabelJournal.log_failure(shipment, error)
 
-        digest = ShipmentConfirm.extract_digest(response)
+    @classmethod
+    @ModelView.button
+    def ups_auto_pack(cls, shipments):
+        """
+        Replace the packages of the shipments by the layout in the UPS box
+        types of their carrier with the lowest billable weight, then the
+        fewest packages.
 
-        shipment_accept = ShipmentAccept.shipment_accept_request_type(digest)
+        The existing packages are deleted, the button asks for a
+        confirmation. Units are packed in a grid of whole units per box,
+        not placed one by one, the layout should be checked by the packer.
+        """
+        for shipment in shipments:
+            if shipment.carrier_cost_method != 'ups':
+                shipment.raise_user_error('ups_wrong_carrier')
+            shipment._ups_auto_pack()
 
-        shipment_accept_instance = carrier.ups_api_instance(call="accept")
+    def _ups_auto_pack(self):
+        Package = Pool().get('stock.package')
+
+        if any(p.tracking_number for p in self.packages):
+            self.raise_user_error(
+                'ups_auto_pack_labelled', error_args=(self.rec_name,)
+            )
+        carrier = self.carrier
+        moves = self.carrier_cost_moves
+        items = carrier.get_ups_cartonization_items([{
+            'id': m.id,
+            'product': m.product.id,
+            'quantity': m.quantity,
+            'unit': m.uom.id,
+        } for m in moves])
+        packings = search(
+            items, carrier.get_ups_boxes(), carrier.ups_max_weight,
+            carrier.ups_dim_divisor,
+            config.getfloat(
+                'ups', 'auto_pack_budget', default=UPS_AUTO_PACK_BUDGET
+            )
+        )
+        cartons = self._choose_ups_packing(packings)
+
+        Package.delete(list(self.packages))
+        carton_moves = self._split_ups_moves(moves, items, cartons)
+        length_uom = carrier.ups_length_uom
+        vlist = []
+        for carton, move_ids in zip(cartons, carton_moves):
+            values = {
+                'shipment': str(self),
+                'moves': [('add', move_ids)],
+            }
+            if carton.box:
+                values['box_type'] = carton.box.key
+            elif carton.dimensions:
+                values.update({
+                    'length': carton.dimensions[0],
+                    'width': carton.dimensions[1],
+                    'height': carton.dimensions[2],
+                    'distance_unit': length_uom.id,
+                })
+            vlist.append(values)
+        return Package.create(vlist)
+
+    def _choose_ups_packing(self, packings):
+        """
+        Return the cartons of the packing to use among packings, the
+        (score, cartons) found by the search, best first. Downstream modules
+        can compare the top candidates with estimated or cached rates.
+        """
+        return packings[0][1]
+
+    @classmethod
+    def _split_ups_moves(cls, moves, items, cartons):
+        """
+        Return the move ids of each carton. Moves whose units are packed in
+        several cartons are split, one move per carton. Assigned moves are
+        drafted to be split and assigned again if their units are still
+        available.
+        """
+        Move = Pool().get('stock.move')
+
+        units = dict((i.key, i.quantity) for i in items)
+        shares = {}
+        for index, carton in enumerate(cartons):
+            for move_id, count in carton.contents.iteritems():
+                shares.setdefault(move_id, []).append((index, count))
+
+        carton_moves = [[] for _ in cartons]
+        to_draft, writes = [], []
+        for move in moves:
+            parts = shares.get(move.id, [])
+            if len(parts) == 1:
+                carton_moves[parts[0][0]].append(move.id)
+                continue
+            if not parts:
+                continue
+            if move.state == 'assigned':
+                to_draft.append(move)
+            left = move.quantity
+            for index, count in parts[1:]:
+                quantity = move.uom.round(
+                    move.quantity * count / units[move.id]
+                )
+                left -= quantity
+                writes.append((move, index, quantity))
+            carton_moves[parts[0][0]].append(move.id)
+            writes.append((move, None, move.uom.round(left)))
+        if to_draft:
+            # Quantities of assigned moves can not be changed
+            Move.draft(to_draft)
+        drafted = set(m.id for m in to_draft)
+        # Read again, assign_try only assigns draft moves
+        to_assign = Move.browse(list(drafted))
+        for move, index, quantity in writes:
+            if index is None:
+                Move.write([move], {'quantity': quantity})
+            else:
+                new_move, = Move.copy([move], default={
+                    'quantity': quantity,
+                    'package': None,
+                })
+                carton_moves[index].append(new_move.id)
+                if move.id in drafted:
+                    to_assign.append(new_move)
+        if to_assign and not Move.assign_try(to_assign):
+            cls.raise_user_error('ups_auto_pack_unavailable')
+        return carton_moves
+
+    def _ups_shipment_accept(self, digest, timer, ups_cache=None):
+        """
+        Send the shipment accept request of digest and return a temporary
+        file with the response data, parsed later as a stream by
+        :meth:`_get_ups_label_values`
+        """
+        carrier = self.carrier
+        shipment_accept = ups.ShipmentAccept.shipment_accept_request_type(
+            digest
+        )
+
+        shipment_accept_instance = self._get_ups_api_instance(
+            carrier, 'accept', ups_cache
+        )
 
         # Logging.
         logger.debug(
@@ -383,77 +904,267 @@ class ShipmentOut:
         )
 
         try:
-            response = shipment_accept_instance.request(shipment_accept)
+            with timer.phase('accept'):
+                data = send_raw(shipment_accept_instance, shipment_accept)
 
-            # Logging.
+            # Logging, the response is not read back for it
             logger.debug(
-                '--------SHIPMENT ACCEPT RESPONSE--------\n%s'
-                '\n--------END RESPONSE--------'
-                % etree.tostring(response, pretty_print=True)
+                'Received Shipment Accept Response for Shipment ID: {0}'
+                .format(self.id)
             )
-        except PyUPSException, e:
+        except ups.PyUPSException, e:
             self.raise_user_error(unicode(e[0]))
+        return data
 
-        shipment_res = response.ShipmentResults
-        shipment_identification_number = \
-            shipment_res.ShipmentIdentificationNumber.pyval
-
-        shipping_cost, currency = self._get_ups_shipment_cost(shipment_res)
-
-        self.__class__.write([self], {
-            'cost': shipping_cost,
+    def _get_ups_label_values(self, data, timer):
+        """
+        Return the cost, tracking numbers and label files of the accept
+        response data to save with :meth:`_save_ups_labels`. The packages
+        are parsed one at a time and each label is written to the filestore
+        once decoded, see :meth:`Package._submit_ups_label`.
+        """
+        carrier = self.carrier
+        shipment_results = parse_header(data).ShipmentResults
+        identification_number = unicode(
+            shipment_results.ShipmentIdentificationNumber.pyval
+        )
+        cost, currency = self._get_ups_shipment_cost(shipment_results)
+
+        packages = []
+        # The package results do not hold any info to identify which
+        # result is for what package, instead it returns the results
+        # in the order in which the packages were sent in request, so
+        # we read the result in the same order.
+        for stock_package, package in izip(
+                self.packages, iter_package_results(data)):
+            with timer.phase('labels'):
+                label = stock_package._submit_ups_label(
+                    carrier, package.LabelImage.GraphicImage.text
+                )
+            packages.append(
+                (stock_package, unicode(package.TrackingNumber.text), label)
+            )
+        return {
+            'shipment': self,
+            'timer': timer,
+            'cost': cost,
             'cost_currency': currency,
-        })
+            'identification_number': identification_number,
+            'packages': packages,
+        }
 
-        index = 0
-        tracking_values = []
-        attachment_values = []
-        for package in response.ShipmentResults.PackageResults:
-            tracking_number = unicode(package.TrackingNumber.pyval)
-
-            # The package results do not hold any info to identify which
-            # result is for what package, instead it returns the results
-            # in the order in which the packages were sent in request, so
-            # we read the result in the same order.
-            stock_package = self.packages[index]
-            tracking_values.append({
-                'carrier': self.carrier,
-                'tracking_number': tracking_number,
-                'origin': '%s,%d' % (
-                    stock_package.__name__, stock_package.id
-                )
-            })
+    @classmethod
+    def _save_ups_labels(cls, labels):
+        """
+        Save the labels of shipments returned by
+        :meth:`_get_ups_label_values` with one create of the tracking
+        numbers, one of the attachments and one write of the shipments.
+        The labels are already in the filestore, the attachments are
+        created with the digest and collision of their file.
+        """
+        pool = Pool()
+        Attachment = pool.get('ir.attachment')
+        Tracking = pool.get('shipment.tracking')
+        LabelTiming = pool.get('shipping.ups.label.timing')
+        LabelJournal = pool.get('shipping.ups.label.journal')
+
+        if not labels:
+            return
+        timer = PhaseTimer(any(label['timer'].enabled for label in labels))
+        tracking_values, attachment_values = [], []
+        # Index in tracking_values of the tracking of each attachment and
+        # of each shipment
+        attachment_trackings, shipment_trackings = [], []
+        for label in labels:
+            shipment = label['shipment']
+            identification_number = label['identification_number']
+            shipment_tracking = None
+            for package, tracking_number, label_file in label['packages']:
+                if not isinstance(label_file, tuple):
+                    # Pending, processed in the label processes while the
+                    # labels were bought
+                    with timer.phase('labels'):
+                        label_file = label_file.get()
+                digest, collision = label_file
+                if tracking_number == identification_number:
+                    shipment_tracking = len(tracking_values)
+                attachment_trackings.append(len(tracking_values))
+                tracking_values.append({
+                    'carrier': shipment.carrier.id,
+                    'tracking_number': tracking_number,
+                    'origin': str(package),
+                })
+                attachment_values.append({
+                    'name': "%s_%s_%s.%s" % (
+                        tracking_number,
+                        identification_number,
+                        package.code,
+                        shipment.carrier.ups_label_extension,
+                    ),
+                    'digest': digest,
+                    'collision': collision,
+                })
+            if shipment_tracking is None:
+                # UPS identifies the shipment by the tracking number of its
+                # lead package, else the shipment is tracked on its own
+                shipment_tracking = len(tracking_values)
+                tracking_values.append({
+                    'carrier': shipment.carrier.id,
+                    'tracking_number': identification_number,
+                    'origin': str(shipment),
+                })
+            shipment_trackings.append(shipment_tracking)
+
+        with timer.phase('tracking'):
+            trackings = Tracking.create(tracking_values)
+
+        for values, index in zip(attachment_values, attachment_trackings):
+            values['resource'] = str(trackings[index])
+        # The labels are already in the filestore of the database, named by
+        # their digest (so identical labels are stored once), only the
+        # references are created.
+        with timer.phase('attachments'):
+            Attachment.create(attachment_values)
+
+        with timer.phase('search_save'):
+            args = []
+            for label, index in zip(labels, shipment_trackings):
+                args.extend(([label['shipment']], {
+                    'cost': label['cost'],
+                    'cost_currency': label['cost_currency'].id,
+                    'tracking_number': trackings[index].id,
+                }))
+            cls.write(*args)
+            # The accept responses are not needed once the labels are saved
+            LabelJournal.mark_saved([
+                label['identification_number'] for label in labels
+            ])
 
-            index += 1
+        if timer.enabled:
+            # The time to save the batch is shared by its shipments
+            for label in labels:
+                for phase, duration in timer.phases.iteritems():
+                    label['timer'].add(phase, duration / len(labels))
+            LabelTiming.record_many([
+                (label['shipment'], label['timer']) for label in labels
+                if label['timer'].enabled
+            ])
 
-            data = stock_package._process_raw_label(
-                package.LabelImage.GraphicImage.pyval
+    def _get_ups_label_batch_key(self, order):
+        """
+        Return the key to sort the shipment in a batch of labels, by its
+        number or by the first location of its inventory moves in the tree
+        of locations for the pick path.
+        """
+        if order == 'pick_path':
+            return (
+                min([
+                    move.from_location.left for move in self.inventory_moves
+                ] or [0]),
+                self.number,
             )
+        return self.number
 
-            attachment_values.append({
-                'name': "%s_%s_%s.png" % (
-                    tracking_number,
-                    shipment_identification_number,
-                    stock_package.code,
-                ),
-                'data': buffer(base64.decodestring(data)),
-            })
-
-        tracking_numbers = Tracking.create(tracking_values)
+    @classmethod
+    def get_ups_label_batch(cls, shipments, order='number'):
+        """
+        Return the format of the print document (pdf for the image labels or
+        the extension of the thermal labels) and the ids of the label
+        attachments of the shipments in print order. The labels which can
+        not be printed in that format are rejected before any is streamed.
+        """
+        pool = Pool()
+        Attachment = pool.get('ir.attachment')
+        Tracking = pool.get('shipment.tracking')
 
-        for attachment, tracking_number in zip(
-            attachment_values, tracking_numbers
-        ):
-            attachment['resource'] = '%s,%d' % (
-                tracking_number.__name__, tracking_number.id
+        shipments = sorted(
+            shipments, key=lambda s: s._get_ups_label_batch_key(order)
+        )
+        database_name = Transaction().database.name
+        attachment_ids, formats = [], set()
+        # The carriers of the image labels and the labels which are not
+        # PNG images supported by PDFWriter
+        image_carriers, not_png = set(), []
+        for sub_shipments in grouped_slice(shipments):
+            sub_shipments = list(sub_shipments)
+            packages = {}
+            for shipment in sub_shipments:
+                for package in shipment.packages:
+                    packages[str(package)] = shipment.id
+            trackings = Tracking.search_read([
+                ('origin', 'in', packages.keys()),
+                ('state', '!=', 'cancelled'),
+            ], fields_names=['origin'])
+            resources = dict(
+                ('%s,%d' % (Tracking.__name__, t['id']), packages[t['origin']])
+                for t in trackings
+            )
+            # Only the names and the PNG headers are read, the data is read
+            # label by label by iter_ups_label_batch
+            labels = dict((s.id, []) for s in sub_shipments)
+            by_id = dict((s.id, s) for s in sub_shipments)
+            for attachment in Attachment.search_read([
+                        ('resource', 'in', resources.keys()),
+                    ], order=[('id', 'ASC')],
+                    fields_names=['name', 'resource', 'digest', 'collision']):
+                shipment = by_id[resources[attachment['resource']]]
+                labels[shipment.id].append(attachment['id'])
+                extension = attachment['name'].rsplit('.', 1)[-1].lower()
+                if extension != 'png':
+                    formats.add(extension)
+                    continue
+                formats.add('pdf')
+                image_carriers.add(shipment.carrier)
+                try:
+                    check_png_header(read_start(
+                            database_name, attachment['digest'],
+                            attachment['collision'], PNG_HEADER_SIZE))
+                except ValueError:
+                    not_png.append(attachment['name'])
+            for shipment in sub_shipments:
+                attachment_ids.extend(labels[shipment.id])
+        if len(formats) > 1:
+            cls.raise_user_error(
+                'ups_label_batch_mixed_formats',
+                error_args=(', '.join(sorted(formats)),)
             )
-        Attachment.create(attachment_values)
+        for carrier in image_carriers:
+            if (carrier and carrier.carrier_cost_method == 'ups'
+                    and (carrier.ups_label_format or 'GIF') == 'GIF'):
+                cls.raise_user_error(
+                    'ups_label_batch_gif', error_args=(carrier.rec_name,)
+                )
+        if not_png:
+            cls.raise_user_error('ups_label_not_png', error_args=(not_png[0],))
+        return (formats.pop() if formats else None), attachment_ids
 
-        shipment_tracking_number, = Tracking.search([
-            ('tracking_number', '=', shipment_identification_number)
-        ])
-        self.tracking_number = shipment_tracking_number.id
-        self.save()
+    @classmethod
+    def iter_ups_label_batch(cls, format_, attachment_ids):
+        """
+        Yield the print document of the labels chunk by chunk, a PDF with a
+        page per label or the concatenated thermal labels. The labels are
+        read one at a time, checked by :meth:`get_ups_label_batch`.
+        """
+        Attachment = Pool().get('ir.attachment')
+
+        output = ChunkBuffer()
+        writer = PDFWriter(output) if format_ == 'pdf' else None
+        for attachment_id in attachment_ids:
+            attachment = Attachment(attachment_id)
+            data = str(attachment.data)
+            if writer is None:
+                yield data
+                continue
+            try:
+                writer.add_png(data)
+            except ValueError:
+                cls.raise_user_error(
+                    'ups_label_not_png', error_args=(attachment.name,)
+                )
+            yield output.flush()
+        if writer is not None:
+            writer.close()
+            yield output.flush()
 
     def get_worldship_goods(self):
         """
@@ -483,9 +1194,12 @@ class ShipmentOut:
             goods.append(E.Goods(*values))
         return goods
 
-    def get_worldship_xml(self):
+    def get_worldship_xml(self, ups_cache=None):
         """
         Return shipment data with worldship understandable xml
+
+        :param ups_cache: Optional dict shared by the shipments processed in
+            one call, see :meth:`get_worldship_xmls`.
         """
         if not self.carrier:
             self.raise_user_error('Carrier is not defined for shipment.')
@@ -495,12 +1209,20 @@ class ShipmentOut:
                 (self.reference, self.carrier.rec_name)
             )
 
+        self.ups_prefetch([self])
         description = ','.join([
             move.product.name for move in self.carrier_cost_moves
         ])
         ship_to = self.delivery_address.to_worldship_to_address()
-        ship_from = self._get_ship_from_address().to_worldship_from_address()
-        shipment_information = WorldShip.shipment_information_type(
+        from_address = self._get_ship_from_address()
+        key = ('worldship_ship_from', from_address.id)
+        if ups_cache is None:
+            ship_from = from_address.to_worldship_from_address()
+        else:
+            if key not in ups_cache:
+                ups_cache[key] = from_address.to_worldship_from_address()
+            ship_from = copy.deepcopy(ups_cache[key])
+        shipment_information = ups.WorldShip.shipment_information_type(
             ServiceType="Standard",  # Worldease
             DescriptionOfGoods=description[:50],
             GoodsNotInFreeCirculation="0",
@@ -508,12 +1230,12 @@ class ShipmentOut:
         )
         xml_packages = []
         for package in self.packages:
-            xml_packages.append(WorldShip.package_type(
+            xml_packages.append(ups.WorldShip.package_type(
                 PackageID=str(package.id),
                 PackageType='CP',  # Custom Package
                 Weight="%.2f" % package.weight,
             ))
-        final_xml = WorldShip.get_xml(
+        final_xml = ups.WorldShip.get_xml(
             ship_to, ship_from, shipment_information,
             *(xml_packages + self.get_worldship_goods())
         )
@@ -523,11 +1245,307 @@ class ShipmentOut:
         }
         return rv
 
+    @classmethod
+    def _ups_batch(cls, shipments, method, result):
+        """
+        Call method on each shipment with a cache shared by all of them and
+        collect, for each shipment, the dict returned by result or the error
+        raised. The writes of a shipment failing with a user, UPS or network
+        error are rolled back, not the ones of the others.
+        """
+        ups_cache = {}
+        cls.ups_prefetch(shipments)
+        results = []
+        for shipment in shipments:
+            error = None
+            try:
+                with savepoint('ups_batch'), Transaction().set_context(
+                        company=shipment.company.id):
+                    value = method(shipment, ups_cache)
+            except UserError, e:
+                error = e.message
+            except ups.PyUPSException, e:
+                error = unicode(e[0])
+            except NETWORK_ERRORS, e:
+                error = unicode(e)
+            if error is not None:
+                logger.warning(
+                    'UPS request of shipment {0} failed: {1}'
+                    .format(shipment.id, error)
+                )
+                results.append({'id': shipment.id, 'error': error})
+                continue
+            values = result(shipment, value)
+            values['id'] = shipment.id
+            results.append(values)
+        return results
+
+    @classmethod
+    def make_ups_labels(cls, shipments):
+        """
+        Generate the UPS labels of several shipments in one call.
+
+        :return: A list with, for each shipment, a dict with its `id` and
+            either its `tracking_number` or the `error` raised
+        """
+        labels = []
+
+        def generate(shipment, ups_cache):
+            shipment.generate_shipping_labels(
+                ups_cache=ups_cache, ups_labels=labels
+            )
+
+        results = cls._ups_batch(
+            shipments, generate, lambda shipment, _: {}
+        )
+        cls._save_ups_labels(labels)
+        tracking_numbers = dict(
+            (label['shipment'].id, label['identification_number'])
+            for label in labels
+        )
+        for result in results:
+            if 'error' not in result:
+                result['tracking_number'] = tracking_numbers[result['id']]
+        return results
+
+    @classmethod
+    def get_ups_shipping_cost(cls, shipments):
+        """
+        Rate several shipments with their carrier and service in one call.
+
+        :return: A list with, for each shipment, a dict with its `id` and
+            either its `cost` and `currency` code or the `error` raised
+        """
+        def rate(shipment, ups_cache):
+            if shipment.carrier_cost_method != 'ups':
+                shipment.raise_user_error('ups_wrong_carrier')
+            if not shipment.carrier_service:
+                shipment.raise_user_error('carrier_service_missing')
+            rates = shipment.get_shipping_rate(
+                shipment.carrier, shipment.carrier_service,
+                ups_cache=ups_cache
+            )
+            if not rates:
+                shipment.raise_user_error('ups_no_rate', (shipment.id,))
+            return rates[0]
+
+        return cls._ups_batch(
+            shipments, rate, lambda shipment, rate: {
+                'cost': rate['cost'],
+                'currency': rate['cost_currency'].code,
+            }
+        )
+
+    @classmethod
+    def get_worldship_xmls(cls, shipments):
+        """
+        Return the WorldShip XML of several shipments in one call.
+
+        :return: A list with, for each shipment, the dict returned by
+            :meth:`get_worldship_xml` or a dict with its `id` and the `error`
+            raised
+        """
+        return cls._ups_batch(
+            shipments,
+            lambda shipment, ups_cache: shipment.get_worldship_xml(ups_cache),
+            lambda shipment, value: value,
+        )
+
+    @classmethod
+    def import_worldship_tracking_numbers(cls, records):
+        """
+        Create the tracking numbers of packages shipped through WorldShip.
+
+        The records are consumed in batches, each batch is matched against
+        the packages with a single search and the tracking numbers are
+        created in bulk. Packages which already have the same tracking
+        number are skipped, so importing a file twice is harmless.
+
+        :param records: iterable of (package id, tracking number) as returned
+            by :func:`worldship.iter_worldship_records`
+        :return: Number of tracking numbers created
+        """
+        Package = Pool().get('stock.package')
+        Tracking = Pool().get('shipment.tracking')
+
+        records = iter(records)
+        created = 0
+        while True:
+            batch = dict(
+                islice(records, Transaction().database.IN_MAX)
+            )
+            if not batch:
+                break
+
+            packages_by_id = dict(
+                (package.id, package) for package in Package.search([
+                    ('id', 'in', batch.keys()),
+                    ('shipment', 'like', 'stock.shipment.out,%'),
+                ])
+                if package.shipment.carrier_cost_method == 'ups_worldship'
+            )
+            unmatched = set(batch) - set(packages_by_id)
+            if unmatched:
+                logger.warning(
+                    'WorldShip packages not found: {0}'.format(
+                        ', '.join(map(str, sorted(unmatched)))
+                    )
+                )
+
+            existing = set(
+                (tracking.origin.id, tracking.tracking_number)
+                for tracking in Tracking.search([
+                    ('origin', 'in', [
+                        'stock.package,%d' % package_id
+                        for package_id in packages_by_id
+                    ]),
+                ])
+            )
+            tracking_values = []
+            for package_id, package in packages_by_id.iteritems():
+                tracking_number = batch[package_id]
+                if (package_id, tracking_number) in existing:
+                    continue
+                tracking_values.append({
+                    'carrier': package.shipment.carrier,
+                    'tracking_number': tracking_number,
+                    'origin': '%s,%d' % (package.__name__, package.id),
+                })
+            if not tracking_values:
+                continue
+
+            to_write = []
+            shipments = set()
+            for tracking in Tracking.create(tracking_values):
+                shipment = tracking.origin.shipment
+                if shipment.tracking_number or shipment in shipments:
+                    continue
+                shipments.add(shipment)
+                to_write.extend([[shipment], {
+                    'tracking_number': tracking.id,
+                }])
+            if to_write:
+                cls.write(*to_write)
+            created += len(tracking_values)
+        return created
+
+    @classmethod
+    def export_worldship_shipments_cron(cls):
+        """
+        Drop the XML of packed WorldShip shipments in the shipments folder
+        of their carrier, where the XML auto import of WorldShip picks them.
+        Each shipment is exported only once: the files are written once the
+        shipments are committed as exported.
+        """
+        Carrier = Pool().get('carrier')
+
+        carriers = Carrier.search([
+            ('carrier_cost_method', '=', 'ups_worldship'),
+            ('ups_worldship_shipments_dir', '!=', None),
+        ])
+        for carrier in carriers:
+            shipments = cls.search([
+                ('carrier', '=', carrier.id),
+                ('state', '=', 'packed'),
+                ('tracking_number', '=', None),
+                ('ups_worldship_exported', '=', False),
+            ])
+            for sub_shipments in grouped_slice(shipments):
+                sub_shipments = cls.browse(sub_shipments)
+                exported = []
+                for data in cls.get_worldship_xmls(sub_shipments):
+                    if 'error' in data:
+                        logger.warning(
+                            'Shipment {0} not exported to WorldShip: {1}'
+                            .format(data['id'], data['error'])
+                        )
+                        continue
+                    exported.append(data)
+                if not exported:
+                    continue
+                with own_transaction():
+                    cls.write(cls.browse([d['id'] for d in exported]), {
+                        'ups_worldship_exported': True,
+                    })
+                for index, data in enumerate(exported):
+                    try:
+                        write_atomic(
+                            carrier.ups_worldship_shipments_dir,
+                            'shipment-%d.xml' % data['id'],
+                            data['worldship_xml'],
+                        )
+                    except EnvironmentError:
+                        # Exported again by the next run
+                        with own_transaction():
+                            cls.write(cls.browse([
+                                        d['id'] for d in exported[index:]
+                                        ]), {
+                                    'ups_worldship_exported': False,
+                                    })
+                        raise
+
+    @classmethod
+    def import_worldship_results_cron(cls):
+        """
+        Import the tracking numbers from the files WorldShip exported in the
+        results folder of the carriers. Each file is imported in its own
+        transaction and moved to the `archive` subfolder once committed,
+        or to the `error` subfolder when it can not be read.
+        """
+        Carrier = Pool().get('carrier')
+
+        carriers = Carrier.search([
+            ('carrier_cost_method', '=', 'ups_worldship'),
+            ('ups_worldship_results_dir', '!=', None),
+        ])
+        for carrier in carriers:
+            process_new_files(
+                carrier.ups_worldship_results_dir,
+                lambda path: cls.import_worldship_tracking_numbers(
+                    iter_worldship_files([path])
+                ),
+                (etree.XMLSyntaxError, csv.Error, UserError)
+            )
+
 
 class StockMove:
     "Stock move"
     __name__ = "stock.move"
 
+    @classmethod
+    def _expire_ups_confirm(cls, moves):
+        "Expire the digests confirmed for the shipments of packed moves"
+        Pool().get('shipping.ups.label.journal').expire_shipments(set(
+            move.package.shipment.id for move in moves
+            if move.package and move.package.shipment
+            and move.package.shipment.__name__ == 'stock.shipment.out'
+        ))
+
+    @classmethod
+    def write(cls, *args):
+        LabelJournal = Pool().get('shipping.ups.label.journal')
+
+        actions = iter(args)
+        changed = []
+        for moves, values in zip(actions, actions):
+            if not UPS_MOVE_FIELDS & set(values):
+                continue
+            # The moves may be added to a package
+            package_ids = [values['package']] if values.get('package') else []
+            if not LabelJournal.has_expirable(
+                    package_ids=package_ids, move_ids=[m.id for m in moves]):
+                continue
+            changed.extend(ups_changed(moves, values, UPS_MOVE_FIELDS))
+        # Before and after as the moves may change of package
+        cls._expire_ups_confirm(changed)
+        super(StockMove, cls).write(*args)
+        cls._expire_ups_confirm(cls.browse(changed))
+
+    @classmethod
+    def delete(cls, moves):
+        cls._expire_ups_confirm(moves)
+        super(StockMove, cls).delete(moves)
+
     def get_monetary_value_for_ups(self):
         """
         Returns monetary_value as required for ups
@@ -593,42 +1611,99 @@ class GenerateShippingLabel(Wizard):
 class Package:
     __name__ = 'stock.package'
 
-    def get_ups_package_container(self):
+    @classmethod
+    def _expire_ups_confirm(cls, packages):
+        "Expire the digests confirmed for the shipments of the packages"
+        Pool().get('shipping.ups.label.journal').expire_shipments(set(
+            package.shipment.id for package in packages
+            if package.shipment
+            and package.shipment.__name__ == 'stock.shipment.out'
+        ))
+
+    @classmethod
+    def create(cls, vlist):
+        packages = super(Package, cls).create(vlist)
+        cls._expire_ups_confirm(packages)
+        return packages
+
+    @classmethod
+    def write(cls, *args):
+        LabelJournal = Pool().get('shipping.ups.label.journal')
+
+        actions = iter(args)
+        changed = []
+        for packages, values in zip(actions, actions):
+            if not UPS_PACKAGE_FIELDS & set(values):
+                continue
+            # The packages may be added to a shipment
+            shipment_ids = []
+            shipment = values.get('shipment')
+            if (isinstance(shipment, basestring)
+                    and shipment.startswith('stock.shipment.out,')):
+                shipment_ids.append(int(shipment.split(',')[1]))
+            if not LabelJournal.has_expirable(
+                    shipment_ids=shipment_ids,
+                    package_ids=[p.id for p in packages]):
+                continue
+            changed.extend(
+                ups_changed(packages, values, UPS_PACKAGE_FIELDS)
+            )
+        # Before and after as the packages may change of shipment
+        cls._expire_ups_confirm(changed)
+        super(Package, cls).write(*args)
+        cls._expire_ups_confirm(cls.browse(changed))
+
+    @classmethod
+    def delete(cls, packages):
+        cls._expire_ups_confirm(packages)
+        super(Package, cls).delete(packages)
+
+    def _get_ups_package_dimensions(self):
         """
-        Return UPS package container for a single package
+        Return the packaging code, length, width, height and dimensions
+        symbol of the package
         """
-        shipment = self.shipment
-        carrier = shipment.carrier
-
         if self.box_type:
-            code = self.box_type.code
-            length = self.box_type.length
-            height = self.box_type.height
-            width = self.box_type.width
-            dimensions_symbol = self.box_type.distance_unit and \
-                self.box_type.distance_unit.symbol.upper()
-        else:
-            code = '02'
-            length = self.length
-            height = self.height
-            width = self.width
-            dimensions_symbol = self.distance_unit and \
-                self.distance_unit.symbol.upper()
-
-        package_type = ShipmentConfirm.packaging_type(Code=code)
-        package_weight = ShipmentConfirm.package_weight_type(
-            Weight="%.2f" % self.weight,
-            Code=carrier.ups_weight_uom_code,
+            return (
+                self.box_type.code,
+                self.box_type.length,
+                self.box_type.width,
+                self.box_type.height,
+                self.box_type.distance_unit and
+                self.box_type.distance_unit.symbol.upper(),
+            )
+        return (
+            '02',
+            self.length,
+            self.width,
+            self.height,
+            self.distance_unit and self.distance_unit.symbol.upper(),
         )
-        package_service_options = ShipmentConfirm.package_service_options_type(
-            ShipmentConfirm.insured_value_type(MonetaryValue='0')
+
+    @staticmethod
+    def _get_ups_package_template(api, weight_code, dimensions):
+        """
+        Return the package container of api for the dimensions with an
+        empty weight. Containers only depend on these values, so they are
+        built once per process and must be copied before use.
+        """
+        key = (api.__name__, weight_code) + tuple(dimensions)
+        template = PACKAGE_TEMPLATES.get(key)
+        if template is not None:
+            return template
+
+        code, length, width, height, dimensions_symbol = dimensions
+        package_type = api.packaging_type(Code=code)
+        package_weight = api.package_weight_type(Weight='', Code=weight_code)
+        package_service_options = api.package_service_options_type(
+            api.insured_value_type(MonetaryValue='0')
         )
 
         args = [package_type, package_weight, package_service_options]
 
         # Only send dimensions if the box type is 'Customer Supplied Package'
         if code == '02' and length and width and height and dimensions_symbol:
-            package_dimensions = ShipmentConfirm.dimensions_type(
+            package_dimensions = api.dimensions_type(
                 Code=dimensions_symbol,
                 Length=str(length),
                 Width=str(width),
@@ -636,55 +1711,81 @@ class Package:
             )
             args.append(package_dimensions)
 
-        package_container = ShipmentConfirm.package_type(*args)
-        return package_container
+        template = api.package_type(*args)
+        if len(PACKAGE_TEMPLATES) >= PACKAGE_TEMPLATES_SIZE:
+            PACKAGE_TEMPLATES.clear()
+        PACKAGE_TEMPLATES[key] = template
+        return template
 
-    def get_ups_package_container_rate(self):
+    def _get_ups_package_container(self, api, weight, carrier=None):
         """
-        Return UPS package container for a single package
+        Return the package container of api for a package of that weight
+        in the weight UOM of carrier (default to the shipment one)
         """
-        Uom = Pool().get('product.uom')
+        carrier = carrier or self.shipment.carrier
 
-        shipment = self.shipment
-        carrier = shipment.carrier
+        container = copy.deepcopy(self._get_ups_package_template(
+            api, carrier.ups_weight_uom_code,
+            self._get_ups_package_dimensions()
+        ))
+        container.find('PackageWeight/Weight').text = "%.2f" % weight
+        return container
 
-        if self.box_type:
-            code = self.box_type.code
-            length = self.box_type.length
-            height = self.box_type.height
-            width = self.box_type.width
-            dimensions_symbol = self.box_type.distance_unit and \
-                self.box_type.distance_unit.symbol.upper()
-        else:
-            code = '02'
-            length = self.length
-            height = self.height
-            width = self.width
-            dimensions_symbol = self.distance_unit and \
-                self.distance_unit.symbol.upper()
-
-        package_type = RatingService.packaging_type(Code=code)
-        package_weight = RatingService.package_weight_type(
-            Weight="%.2f" % Uom.compute_qty(
-                self.weight_uom, self.weight, carrier.ups_weight_uom
-            ),
-            Code=carrier.ups_weight_uom_code,
-        )
-        package_service_options = RatingService.package_service_options_type(
-            RatingService.insured_value_type(MonetaryValue='0')
-        )
+    def _get_ups_label_data(self, carrier, image):
+        """
+        Return the label to store from the base64 encoded GraphicImage sent
+        by UPS. Thermal labels are printer commands, they are stored as is.
+        """
+        if not carrier.ups_thermal_label:
+            image = self._process_raw_label(image)
+        return buffer(base64.decodestring(image))
 
-        args = [package_type, package_weight, package_service_options]
+    @classmethod
+    def _get_ups_label_processor(cls, carrier):
+        """
+        Return the function run in the label processes on the image labels
+        of carrier, or None to process them in the request thread. It is
+        called with the database name, the package id and the base64
+        encoded GraphicImage, stores the label with :func:`filestore.store`
+        and returns its digest and collision, so it must be defined at the
+        top level of a module.
+
+        Default to :func:`process_raw_label` when the label processes are
+        enabled.
+        """
+        if get_processes() > 0:
+            return process_raw_label
+        return None
 
-        # Only send dimensions if the box type is 'Customer Supplied Package'
-        if code == '02' and length and width and height and dimensions_symbol:
-            package_dimensions = RatingService.dimensions_type(
-                Code=dimensions_symbol,
-                Length=str(length),
-                Width=str(width),
-                Height=str(height)
+    def _submit_ups_label(self, carrier, image):
+        """
+        Write the label of the base64 encoded GraphicImage to the filestore
+        and return its digest and collision, or their pending result when
+        the package has a label processor.
+        """
+        database_name = Transaction().database.name
+        processor = None
+        if not carrier.ups_thermal_label:
+            processor = self._get_ups_label_processor(carrier)
+        if processor is None:
+            return store(
+                database_name, self._get_ups_label_data(carrier, image)
             )
-            args.append(package_dimensions)
+        return submit(processor, database_name, self.id, image)
 
-        package_container = RatingService.package_type(*args)
-        return package_container
+    def get_ups_package_container(self):
+        """
+        Return UPS package container for a single package
+        """
+        return self._get_ups_package_container(ups.ShipmentConfirm, self.weight)
+
+    def get_ups_package_container_rate(self, carrier=None):
+        """
+        Return UPS package container for a single package
+        """
+        carrier = carrier or self.shipment.carrier
+
+        return self._get_ups_package_container(
+            ups.RatingService,
+            carrier.ups_convert_weight(self.weight, self.weight_uom), carrier
+        )
@@ -6,9 +6,14 @@
 
 """
 import os
+import base64
+import shutil
+import hashlib
+import tempfile
 
+from io import BytesIO
 from decimal import Decimal
-from time import time
+from time import time, sleep
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
 from lxml import objectify
@@ -24,6 +29,33 @@ from trytond.config import config
 config.set('database', 'path', '.')
 
 
+class QueryCounter(object):
+    """
+    Count the queries executed on the database of the transaction
+    """
+
+    def __init__(self, testcase):
+        self.testcase = testcase
+        self.count = 0
+
+    def __enter__(self):
+        self.cursor_class = type(Transaction().connection.cursor())
+        self.execute = self.cursor_class.execute
+        counter = self
+
+        def execute(cursor, *args, **kwargs):
+            counter.count += 1
+            return counter.execute(cursor, *args, **kwargs)
+        try:
+            self.cursor_class.execute = execute
+        except TypeError:
+            self.testcase.skipTest('Cursor of the backend can not be patched')
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.cursor_class.execute = self.execute
+
+
 class TestUPS(ModuleTestCase):
     """Test UPS Integration
     """
@@ -838,6 +870,1966 @@ class TestUPS(ModuleTestCase):
             self.assertTrue('worldship_xml' in rv)
             assert objectify.fromstring(rv['worldship_xml'])
 
+    def create_worldship_shipment(self):
+        """
+        Create a worldship shipment with two packages
+        """
+        Date = POOL.get('ir.date')
+        StockPackage = POOL.get('stock.package')
+        StockPackageType = POOL.get('stock.package.type')
+
+        uom_kg, = self.Uom.search([('symbol', '=', 'kg')])
+
+        with Transaction().set_context({'company': self.company.id}):
+            shipment, = self.StockShipmentOut.create([{
+                'planned_date': Date.today(),
+                'effective_date': Date.today(),
+                'customer': self.sale_party.id,
+                'carrier': self.ups_worldship_carrier.id,
+                'cost_currency': self.ups_worldship_carrier.currency.id,
+                'warehouse': self.warehouse.id,
+                'delivery_address': self.sale_party.addresses[0],
+            }])
+            moves = self.StockMove.create([{
+                'shipment': ('stock.shipment.out', shipment.id),
+                'product': self.product.id,
+                'uom': uom_kg.id,
+                'quantity': quantity,
+                'from_location': shipment.warehouse.output_location.id,
+                'to_location': shipment.customer_location.id,
+                'unit_price': Decimal('1'),
+                'currency': self.currency.id,
+            } for quantity in (6, 4)])
+            stock_package_type, = StockPackageType.search([])
+            packages = StockPackage.create([{
+                'type': stock_package_type.id,
+                'shipment': "%s,%s" % (shipment.__name__, shipment.id),
+                'moves': [('add', [move.id])],
+            } for move in moves])
+        return shipment, packages
+
+    @with_transaction()
+    def test_0044_worldship_shipments_folder(self):
+        """
+        Export the packed shipments to the worldship shipments folder
+        """
+        ShipmentOut = self.StockShipmentOut
+
+        self.setup_defaults()
+        shipment, _ = self.create_worldship_shipment()
+        failing, _ = self.create_worldship_shipment()
+        ShipmentOut.write([shipment, failing], {'state': 'packed'})
+
+        shipments_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, shipments_dir)
+        self.ups_worldship_carrier.ups_worldship_shipments_dir = \
+            shipments_dir
+        self.ups_worldship_carrier.save()
+
+        exported = []
+
+        def get_worldship_xmls(shipments):
+            exported.extend(s.id for s in shipments)
+            return [
+                {'id': s.id, 'error': 'Invalid address'} if s == failing
+                else {'id': s.id, 'worldship_xml': '<Shipment%d/>' % s.id}
+                for s in shipments
+            ]
+        original = ShipmentOut.get_worldship_xmls
+        ShipmentOut.get_worldship_xmls = staticmethod(get_worldship_xmls)
+        try:
+            ShipmentOut.export_worldship_shipments_cron()
+            self.assertEqual(
+                sorted(os.listdir(shipments_dir)),
+                ['shipment-%d.xml' % shipment.id]
+            )
+            with open(os.path.join(
+                    shipments_dir, 'shipment-%d.xml' % shipment.id)) as f:
+                self.assertEqual(f.read(), '<Shipment%d/>' % shipment.id)
+            self.assertTrue(ShipmentOut(shipment.id).ups_worldship_exported)
+            self.assertFalse(ShipmentOut(failing.id).ups_worldship_exported)
+
+            # Only the shipments not exported yet are sent again
+            del exported[:]
+            ShipmentOut.export_worldship_shipments_cron()
+            self.assertEqual(exported, [failing.id])
+            self.assertEqual(len(os.listdir(shipments_dir)), 1)
+
+            # Shipments whose file is not written are exported again
+            other, _ = self.create_worldship_shipment()
+            ShipmentOut.write([other], {'state': 'packed'})
+            self.ups_worldship_carrier.ups_worldship_shipments_dir = \
+                os.path.join(shipments_dir, 'missing')
+            self.ups_worldship_carrier.save()
+            with self.assertRaises(EnvironmentError):
+                ShipmentOut.export_worldship_shipments_cron()
+            self.assertFalse(ShipmentOut(other.id).ups_worldship_exported)
+        finally:
+            ShipmentOut.get_worldship_xmls = original
+
+    @with_transaction()
+    def test_0045_worldship_tracking_import(self):
+        """
+        Import tracking numbers from worldship export files
+        """
+        from trytond.modules.shipping_ups.worldship import \
+            iter_worldship_records
+        Tracking = POOL.get('shipment.tracking')
+
+        self.setup_defaults()
+        shipment, (package1, package2) = self.create_worldship_shipment()
+
+        xml_export = '''<?xml version="1.0" encoding="UTF-8" ?>
+        <OpenShipments xmlns="x-schema:OpenShipments.xdr">
+          <OpenShipment ProcessStatus="Processed">
+            <Package>
+              <PackageID>%d</PackageID>
+              <TrackingNumber>1Z0000000000000001</TrackingNumber>
+            </Package>
+            <Package>
+              <PackageID>999999</PackageID>
+              <TrackingNumber>1Z0000000000000009</TrackingNumber>
+            </Package>
+          </OpenShipment>
+        </OpenShipments>''' % package1.id
+        csv_export = (
+            'PackageID,TrackingNumber\r\n'
+            '%d,1Z0000000000000002\r\n'
+            ',1Z0000000000000003\r\n' % package2.id
+        )
+
+        self.assertEqual(
+            list(iter_worldship_records(BytesIO(xml_export))), [
+                (package1.id, u'1Z0000000000000001'),
+                (999999, u'1Z0000000000000009'),
+            ]
+        )
+        self.assertEqual(
+            list(iter_worldship_records(BytesIO(csv_export))),
+            [(package2.id, u'1Z0000000000000002')]
+        )
+
+        for export, count in [(xml_export, 1), (csv_export, 1)]:
+            self.assertEqual(
+                self.StockShipmentOut.import_worldship_tracking_numbers(
+                    iter_worldship_records(BytesIO(export))
+                ), count
+            )
+
+        self.assertEqual(
+            package1.tracking_number.tracking_number, '1Z0000000000000001'
+        )
+        self.assertEqual(
+            package2.tracking_number.tracking_number, '1Z0000000000000002'
+        )
+        self.assertEqual(
+            shipment.tracking_number, package1.tracking_number
+        )
+
+        # Importing the same file again does not duplicate anything
+        self.assertEqual(
+            self.StockShipmentOut.import_worldship_tracking_numbers(
+                iter_worldship_records(BytesIO(csv_export))
+            ), 0
+        )
+        self.assertEqual(Tracking.search([], count=True), 2)
+
+    @with_transaction()
+    def test_0046_worldship_results_folder(self):
+        """
+        Import tracking numbers from the worldship results folder
+        """
+        from trytond.modules.shipping_ups.worldship import write_atomic
+
+        self.setup_defaults()
+        shipment, (package1, package2) = self.create_worldship_shipment()
+
+        results_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, results_dir)
+        self.ups_worldship_carrier.ups_worldship_results_dir = results_dir
+        self.ups_worldship_carrier.save()
+
+        def export(filename, package, tracking_number, mtime):
+            write_atomic(
+                results_dir, filename,
+                'PackageID,TrackingNumber\n%d,%s\n' % (
+                    package.id, tracking_number
+                )
+            )
+            os.utime(os.path.join(results_dir, filename), (mtime, mtime))
+
+        now = time()
+        export('1.csv', package1, '1Z0000000000000001', now - 60)
+        # Nothing but the exported file is left in the folder
+        self.assertEqual(os.listdir(results_dir), ['1.csv'])
+
+        self.StockShipmentOut.import_worldship_results_cron()
+        self.assertEqual(
+            package1.tracking_number.tracking_number, '1Z0000000000000001'
+        )
+        self.assertFalse(package2.tracking_number)
+        # Imported files are archived
+        self.assertEqual(os.listdir(results_dir), ['archive'])
+        self.assertEqual(
+            os.listdir(os.path.join(results_dir, 'archive')), ['1.csv']
+        )
+
+        # Files still being written are left for the next run
+        export('2.csv', package2, '1Z0000000000000002', now + 60)
+        self.StockShipmentOut.import_worldship_results_cron()
+        self.assertFalse(package2.tracking_number)
+
+        # Files copied with a time older than the imported ones too
+        export('2.csv', package2, '1Z0000000000000002', now - 3600)
+        self.StockShipmentOut.import_worldship_results_cron()
+        self.assertEqual(
+            package2.tracking_number.tracking_number, '1Z0000000000000002'
+        )
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(results_dir, 'archive'))),
+            ['1.csv', '2.csv']
+        )
+
+        # Malformed files are moved aside and do not block the others
+        with open(os.path.join(results_dir, '3.xml'), 'wb') as file_obj:
+            file_obj.write('<OpenShipments><Package><PackageID>1')
+        export('4.csv', package1, '1Z0000000000000004', now - 60)
+        os.utime(os.path.join(results_dir, '3.xml'), (now - 90, now - 90))
+        self.StockShipmentOut.import_worldship_results_cron()
+        self.assertEqual(
+            os.listdir(os.path.join(results_dir, 'error')), ['3.xml']
+        )
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(results_dir, 'archive'))),
+            ['1.csv', '2.csv', '4.csv']
+        )
+        self.assertTrue(POOL.get('shipment.tracking').search([
+            ('tracking_number', '=', '1Z0000000000000004'),
+        ]))
+
+    @with_transaction()
+    def test_0047_prefetch_query_count(self):
+        """
+        Check that XML builders do not query once per move after prefetch
+        """
+        self.setup_defaults()
+
+        shipment1, _ = self.create_worldship_shipment()
+        shipment2, _ = self.create_worldship_shipment()
+        with Transaction().set_context(company=self.company.id):
+            self.StockMove.copy(
+                shipment2.outgoing_moves * 4,
+                default={'shipment': str(shipment2)}
+            )
+
+        counts = []
+        for shipment in (shipment1, shipment2):
+            Transaction().cache.clear()
+            shipment = self.StockShipmentOut(shipment.id)
+            with QueryCounter(self) as counter:
+                self.StockShipmentOut.ups_prefetch([shipment])
+            counts.append(counter.count)
+
+            with QueryCounter(self) as counter:
+                shipment.get_worldship_goods()
+            self.assertEqual(counter.count, 0)
+
+        self.assertEqual(len(shipment1.outgoing_moves), 2)
+        self.assertEqual(len(shipment2.outgoing_moves), 10)
+        self.assertTrue(counts[0] > 0)
+        self.assertEqual(counts[0], counts[1])
+
+    @with_transaction()
+    def test_0048_batch_rpc_errors(self):
+        """
+        Check that batch methods return one result or error per shipment
+        """
+        self.setup_defaults()
+
+        shipment1, _ = self.create_worldship_shipment()
+        shipment2, _ = self.create_worldship_shipment()
+        self.StockShipmentOut.write([shipment2], {
+            'carrier': self.carrier.id,
+        })
+        shipments = self.StockShipmentOut.browse([shipment1, shipment2])
+
+        with Transaction().set_context(company=self.company.id):
+            results = self.StockShipmentOut.make_ups_labels(shipments)
+            self.assertEqual(
+                [r['id'] for r in results], [shipment1.id, shipment2.id]
+            )
+            self.assertTrue(all('error' in r for r in results))
+
+            results = self.StockShipmentOut.get_ups_shipping_cost(shipments)
+            self.assertEqual(results[0]['id'], shipment1.id)
+            self.assertTrue('not UPS' in results[0]['error'])
+            self.assertTrue('missing' in results[1]['error'])
+
+            results = self.StockShipmentOut.get_worldship_xmls(
+                shipments[1:]
+            )
+            self.assertEqual(results[0]['id'], shipment2.id)
+            self.assertTrue('not Worldship' in results[0]['error'])
+
+        # UPS and network errors do not discard the labels of the others
+        import urllib2
+        from trytond.modules.shipping_ups.metrics import PhaseTimer
+        from trytond.modules.shipping_ups.ups_api import ups
+        from trytond.modules.shipping_ups.filestore import store
+        ShipmentOut = self.StockShipmentOut
+        shipment3, packages3 = self.create_worldship_shipment()
+        label_file = store(Transaction().database.name, 'label')
+
+        def generate(shipment, **kwargs):
+            if shipment.id == shipment1.id:
+                raise ups.PyUPSException('Hard-120100:Missing field')
+            elif shipment.id == shipment2.id:
+                raise urllib2.URLError('timed out')
+            kwargs['ups_labels'].append({
+                'shipment': shipment,
+                'timer': PhaseTimer(False),
+                'cost': Decimal('10'),
+                'cost_currency': self.currency,
+                'identification_number': u'1ZBATCH0',
+                'packages': [
+                    (package, u'1ZBATCH%d' % index, label_file)
+                    for index, package in enumerate(packages3)
+                ],
+            })
+        original = ShipmentOut.generate_shipping_labels
+        ShipmentOut.generate_shipping_labels = generate
+        try:
+            with Transaction().set_context(company=self.company.id):
+                results = ShipmentOut.make_ups_labels(
+                    ShipmentOut.browse([shipment1, shipment2, shipment3])
+                )
+        finally:
+            ShipmentOut.generate_shipping_labels = original
+        self.assertEqual(results, [
+            {'id': shipment1.id, 'error': 'Hard-120100:Missing field'},
+            {'id': shipment2.id, 'error': u'<urlopen error timed out>'},
+            {'id': shipment3.id, 'tracking_number': u'1ZBATCH0'},
+        ])
+        self.assertEqual(
+            ShipmentOut(shipment3.id).tracking_number.tracking_number,
+            '1ZBATCH0'
+        )
+
+    @with_transaction()
+    def test_0049_ups_metrics(self):
+        """
+        Check that the requests sent to UPS are measured when enabled
+        """
+        import urllib2
+        from lxml.builder import E
+        from ups.base import PyUPSException, BaseAPIClient
+        from ups.rating_package import RatingService
+        from trytond.modules.shipping_ups.metrics import registry
+
+        self.setup_defaults()
+        Carrier = POOL.get('carrier')
+
+        error_response = (
+            '<RatingServiceSelectionResponse><Response>'
+            '<ResponseStatusCode>0</ResponseStatusCode>'
+            '<Error><ErrorSeverity>Hard</ErrorSeverity>'
+            '<ErrorCode>111285</ErrorCode>'
+            '<ErrorDescription>Invalid postal code</ErrorDescription>'
+            '</Error></Response></RatingServiceSelectionResponse>'
+        )
+        responses = []
+
+        def send_request(client, url, data):
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        if not config.has_section('ups'):
+            config.add_section('ups')
+        original_send_request = BaseAPIClient.send_request
+        BaseAPIClient.send_request = send_request
+        registry.reset()
+        try:
+            # Disabled: the client is returned untouched
+            rate_api = self.carrier.ups_api_instance(call='rate')
+            self.assertTrue(isinstance(rate_api, RatingService))
+
+            config.set('ups', 'metrics', 'True')
+            config.set('ups', 'retries', '1')
+            rate_api = self.carrier.ups_api_instance(call='rate')
+            self.assertFalse(isinstance(rate_api, RatingService))
+            self.assertTrue(rate_api.url)
+
+            responses[:] = [urllib2.URLError('timeout'), error_response]
+            with self.assertRaises(PyUPSException):
+                rate_api.request(E.RatingServiceSelectionRequest())
+            accept_api = self.carrier.ups_api_instance(call='accept')
+            responses[:] = [urllib2.URLError('timeout')]
+            with self.assertRaises(urllib2.URLError):
+                accept_api.request(E.ShipmentAcceptRequest())
+        finally:
+            BaseAPIClient.send_request = original_send_request
+            config.remove_option('ups', 'metrics')
+            config.remove_option('ups', 'retries')
+
+        metrics = dict(
+            (values['call'], values) for values in Carrier.get_ups_metrics()
+        )
+        self.assertEqual(metrics['rate']['carrier'], self.carrier.id)
+        self.assertEqual(metrics['rate']['count'], 2)
+        self.assertEqual(metrics['rate']['retries'], 1)
+        self.assertEqual(
+            metrics['rate']['errors'], {'network': 1, 'Hard-111285': 1}
+        )
+        self.assertTrue(metrics['rate']['request_bytes'] > 0)
+        self.assertEqual(
+            metrics['rate']['response_bytes'], len(error_response)
+        )
+        self.assertEqual(metrics['rate']['latency_buckets'][-1][1], 2)
+        # Accept is never sent twice
+        self.assertEqual(metrics['accept']['count'], 1)
+        self.assertEqual(metrics['accept']['retries'], 0)
+
+        text = Carrier.get_ups_metrics_prometheus()
+        self.assertTrue(
+            'ups_request_duration_seconds_count{carrier="%d",call="rate"} 2'
+            % self.carrier.id in text
+        )
+        self.assertTrue(
+            'ups_request_errors_total{carrier="%d",call="rate",'
+            'code="Hard-111285"} 1' % self.carrier.id in text
+        )
+        registry.reset()
+
+    @with_transaction()
+    def test_0050_label_timing(self):
+        """
+        Check that label timings are stored and aggregated
+        """
+        from trytond.modules.shipping_ups.metrics import PhaseTimer
+
+        self.setup_defaults()
+        LabelTiming = POOL.get('shipping.ups.label.timing')
+
+        timer = PhaseTimer(False)
+        with timer.phase('confirm'):
+            pass
+        self.assertEqual(timer.phases, {})
+
+        shipment, _ = self.create_worldship_shipment()
+        for confirm in range(1, 101):
+            timer = PhaseTimer()
+            timer.phases.update({'confirm': confirm / 1000.0, 'accept': 0.5})
+            LabelTiming.record(shipment, timer)
+
+        timing = LabelTiming.search([])[0]
+        self.assertEqual(timing.packages, 2)
+        self.assertEqual(timing.accept, 500)
+        self.assertEqual(timing.build_xml, 0)
+
+        percentiles = LabelTiming.get_percentiles(
+            [('shipment', '=', shipment.id)]
+        )
+        self.assertEqual(
+            percentiles['confirm'], {'p50': 50, 'p95': 95, 'p99': 99}
+        )
+        self.assertEqual(percentiles['accept']['p99'], 500)
+        self.assertEqual(
+            LabelTiming.get_percentiles([('id', '=', -1)])['total']['p50'],
+            None
+        )
+
+    @with_transaction()
+    def test_0051_carrier_uom_table(self):
+        """
+        Check the UPS UOMs of the carrier and the cached weight conversion
+        """
+        self.setup_defaults()
+
+        uom_kg, = self.Uom.search([('symbol', '=', 'kg')])
+        uom_lb, = self.Uom.search([('symbol', '=', 'lb')])
+        uom_in, = self.Uom.search([('symbol', '=', 'in')])
+        uom_g, = self.Uom.search([('symbol', '=', 'g')])
+
+        carrier = self.Carrier(self.carrier.id)
+        self.assertEqual(carrier.ups_weight_uom, uom_lb)
+        self.assertEqual(carrier.ups_length_uom, uom_in)
+        self.assertEqual(carrier.ups_weight_uom_code, 'LBS')
+
+        for weight, from_uom in [
+                (1.0, uom_kg), (0.333, uom_kg), (2.5, uom_lb),
+                (1234.0, uom_g), (0, uom_kg)]:
+            self.assertEqual(
+                carrier.ups_convert_weight(weight, from_uom),
+                self.Uom.compute_qty(
+                    from_uom, weight, carrier.ups_weight_uom
+                )
+            )
+
+        with QueryCounter(self) as counter:
+            carrier.ups_convert_weight(3.0, uom_g)
+        self.assertEqual(counter.count, 0)
+
+        self.Carrier.write([self.carrier], {'ups_uom_system': '00'})
+        carrier = self.Carrier(self.carrier.id)
+        self.assertEqual(carrier.ups_weight_uom, uom_kg)
+        self.assertEqual(carrier.ups_weight_uom_code, 'KGS')
+        self.assertEqual(carrier.ups_convert_weight(2.0, uom_lb), 0.91)
+
+    @with_transaction()
+    def test_0052_package_container_templates(self):
+        """
+        Check that package containers are cloned from shared templates
+        """
+        from lxml import etree
+        from ups.shipping_package import ShipmentConfirm
+        from trytond.modules.shipping_ups.stock import PACKAGE_TEMPLATES
+
+        self.setup_defaults()
+        shipment, packages = self.create_worldship_shipment()
+        box_type, = self.BoxType.search([
+            ('code', '=', '02'),
+            ('carrier_cost_method', '=', 'ups_worldship'),
+        ], limit=1)
+        self.BoxType.write([box_type], {
+            'length': 10, 'width': 8, 'height': 6,
+            'distance_unit': self.Uom.search([('symbol', '=', 'in')])[0].id,
+        })
+        POOL.get('stock.package').write(packages, {'box_type': box_type.id})
+
+        PACKAGE_TEMPLATES.clear()
+        containers = [p.get_ups_package_container() for p in packages]
+        self.assertEqual(len(PACKAGE_TEMPLATES), 1)
+        self.assertFalse(containers[0] is containers[1])
+
+        for package, container in zip(packages, containers):
+            expected = ShipmentConfirm.package_type(
+                ShipmentConfirm.packaging_type(Code='02'),
+                ShipmentConfirm.package_weight_type(
+                    Weight="%.2f" % package.weight, Code='LBS'
+                ),
+                ShipmentConfirm.package_service_options_type(
+                    ShipmentConfirm.insured_value_type(MonetaryValue='0')
+                ),
+                ShipmentConfirm.dimensions_type(
+                    Code='IN', Length='10.0', Width='8.0', Height='6.0'
+                ),
+            )
+            self.assertEqual(
+                etree.tostring(container), etree.tostring(expected)
+            )
+
+        rate_containers = [
+            p.get_ups_package_container_rate() for p in packages
+        ]
+        self.assertEqual(len(PACKAGE_TEMPLATES), 2)
+        self.assertNotEqual(
+            rate_containers[0].findtext('PackageWeight/Weight'),
+            rate_containers[1].findtext('PackageWeight/Weight'),
+        )
+
+    @with_transaction()
+    def test_0053_label_attachment_storage(self):
+        """
+        Check that labels are stored once in the filestore, not in the table
+        """
+        import base64
+        from trytond import backend
+        Tracking = POOL.get('shipment.tracking')
+
+        self.setup_defaults()
+        shipment, packages = self.create_worldship_shipment()
+        data = base64.encodestring('GIF89a' + '\0' * 1024)
+
+        trackings = Tracking.create([{
+            'carrier': self.carrier.id,
+            'tracking_number': '1Z%d' % package.id,
+            'origin': str(package),
+        } for package in packages])
+        attachments = self.IrAttachment.create([{
+            'name': '%s.png' % tracking.tracking_number,
+            'data': buffer(base64.decodestring(data)),
+            'resource': str(tracking),
+        } for tracking in trackings])
+
+        TableHandler = backend.get('TableHandler')
+        self.assertFalse(
+            TableHandler(self.IrAttachment).column_exist('data')
+        )
+        self.assertTrue(all(a.digest for a in attachments))
+        self.assertEqual(len(set(
+            (a.digest, a.collision) for a in attachments
+        )), 1)
+
+        attachment = self.IrAttachment(attachments[0].id)
+        self.assertEqual(
+            self.IrAttachment.read(
+                [attachment.id], ['data_size']
+            )[0]['data_size'], 1030
+        )
+        self.assertEqual(bytes(attachment.data), base64.decodestring(data))
+
+    @with_transaction()
+    def test_0054_label_formats(self):
+        """
+        Check the label specification of each label format
+        """
+        self.setup_defaults()
+
+        # PNG by default, the labels can be printed in PDF batches
+        spec = self.carrier.get_ups_label_specification()
+        self.assertEqual(spec.findtext('LabelPrintMethod/Code'), 'GIF')
+        self.assertEqual(spec.findtext('LabelImageFormat/Code'), 'PNG')
+        self.assertFalse(self.carrier.ups_thermal_label)
+        self.assertEqual(self.carrier.ups_label_extension, 'png')
+
+        self.Carrier.write([self.carrier], {'ups_label_format': 'GIF'})
+        spec = self.carrier.get_ups_label_specification()
+        self.assertEqual(spec.findtext('LabelPrintMethod/Code'), 'GIF')
+        self.assertEqual(spec.findtext('LabelImageFormat/Code'), 'GIF')
+        self.assertEqual(self.carrier.ups_label_extension, 'png')
+
+        for code in ('ZPL', 'EPL'):
+            self.Carrier.write([self.carrier], {'ups_label_format': code})
+            spec = self.carrier.get_ups_label_specification()
+            self.assertEqual(spec.findtext('LabelPrintMethod/Code'), code)
+            self.assertIsNone(spec.find('LabelImageFormat'))
+            self.assertEqual(spec.findtext('LabelStockSize/Height'), '4')
+            self.assertEqual(spec.findtext('LabelStockSize/Width'), '6')
+            self.assertTrue(self.carrier.ups_thermal_label)
+            self.assertEqual(
+                self.carrier.ups_label_extension, code.lower()
+            )
+
+        # Thermal labels are stored without image processing
+        shipment, packages = self.create_worldship_shipment()
+        Package = POOL.get('stock.package')
+        process_raw_label = Package._process_raw_label
+        Package._process_raw_label = lambda *a, **k: self.fail(
+            'Thermal labels must not be processed'
+        )
+        try:
+            data = packages[0]._get_ups_label_data(
+                self.carrier, base64.encodestring('^XA^FDUPS^FS^XZ')
+            )
+        finally:
+            Package._process_raw_label = process_raw_label
+        self.assertEqual(str(data), '^XA^FDUPS^FS^XZ')
+
+    @with_transaction()
+    def test_0055_label_batch(self):
+        """
+        Check the print documents assembled from the labels of shipments
+        """
+        import re
+        import zlib
+        import struct
+        from trytond.exceptions import UserError
+        Tracking = POOL.get('shipment.tracking')
+
+        def png(width, height):
+            def chunk(chunk_type, data):
+                crc = zlib.crc32(chunk_type + data) & 0xffffffff
+                return struct.pack('>I', len(data)) + chunk_type + data + \
+                    struct.pack('>I', crc)
+            rows = ''.join('\0' + '\xff' * width for _ in xrange(height))
+            return '\x89PNG\r\n\x1a\n' + chunk(
+                'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)
+            ) + chunk('IDAT', zlib.compress(rows)) + chunk('IEND', '')
+
+        def add_labels(shipment, packages, extension, data):
+            trackings = Tracking.create([{
+                'carrier': self.carrier.id,
+                'tracking_number': '1Z%s%d' % (extension, package.id),
+                'origin': str(package),
+            } for package in packages])
+            return self.IrAttachment.create([{
+                'name': '%s.%s' % (tracking.tracking_number, extension),
+                'data': buffer(data),
+                'resource': str(tracking),
+            } for tracking in trackings])
+
+        self.setup_defaults()
+        first, first_packages = self.create_worldship_shipment()
+        second, second_packages = self.create_worldship_shipment()
+        first_labels = add_labels(first, first_packages, 'png', png(20, 10))
+        second_labels = add_labels(
+            second, second_packages, 'png', png(30, 10)
+        )
+
+        format_, attachment_ids = self.StockShipmentOut.get_ups_label_batch(
+            [second, first]
+        )
+        self.assertEqual(format_, 'pdf')
+        self.assertEqual(
+            attachment_ids, map(int, first_labels + second_labels)
+        )
+
+        chunks = list(self.StockShipmentOut.iter_ups_label_batch(
+            format_, attachment_ids
+        ))
+        self.assertEqual(len(chunks), 5)
+        document = ''.join(chunks)
+        self.assertTrue(document.startswith('%PDF-1.4'))
+        self.assertTrue(document.endswith('%%EOF\n'))
+        self.assertEqual(len(re.findall(r'/Type /Page\b', document)), 4)
+        xref = int(document.rsplit('startxref\n', 1)[1].split()[0])
+        offsets = re.findall(r'(\d{10}) 00000 n', document[xref:])
+        for number, offset in enumerate(offsets, 1):
+            self.assertTrue(
+                document[int(offset):].startswith('%d 0 obj' % number)
+            )
+
+        # The labels which can not be printed are rejected before streaming
+        self.IrAttachment.write(second_labels[:1], {
+            'data': buffer('GIF89a' + '\0' * 64),
+        })
+        with self.assertRaises(UserError):
+            self.StockShipmentOut.get_ups_label_batch([first, second])
+        self.IrAttachment.write(second_labels[:1], {
+            'data': buffer(png(30, 10)),
+        })
+        self.StockShipmentOut.write([first], {'carrier': self.carrier.id})
+        self.Carrier.write([self.carrier], {'ups_label_format': 'GIF'})
+        with self.assertRaises(UserError):
+            self.StockShipmentOut.get_ups_label_batch([first, second])
+        self.Carrier.write([self.carrier], {'ups_label_format': 'PNG'})
+
+        self.IrAttachment.write(second_labels, {'name': 'label.zpl'})
+        with self.assertRaises(UserError):
+            self.StockShipmentOut.get_ups_label_batch([first, second])
+
+        self.IrAttachment.write(first_labels, {'name': 'label.zpl'})
+        self.IrAttachment.write(first_labels + second_labels, {
+            'data': buffer('^XA^XZ'),
+        })
+        format_, attachment_ids = self.StockShipmentOut.get_ups_label_batch(
+            [first, second]
+        )
+        self.assertEqual(format_, 'zpl')
+        self.assertEqual(''.join(self.StockShipmentOut.iter_ups_label_batch(
+            format_, attachment_ids
+        )), '^XA^XZ' * 4)
+
+    @with_transaction()
+    def test_0056_save_ups_labels(self):
+        """
+        Check that the labels of a batch of shipments are saved in bulk
+        """
+        from trytond.modules.shipping_ups.metrics import PhaseTimer
+        from trytond.modules.shipping_ups.filestore import store
+        Tracking = POOL.get('shipment.tracking')
+
+        self.setup_defaults()
+        first, first_packages = self.create_worldship_shipment()
+        second, second_packages = self.create_worldship_shipment()
+        label_file = store(Transaction().database.name, 'label')
+        labels = [{
+            'shipment': first,
+            'timer': PhaseTimer(False),
+            'cost': Decimal('10'),
+            'cost_currency': self.currency,
+            'identification_number': u'1ZFIRST0',
+            'packages': [
+                (package, u'1ZFIRST%d' % index, label_file)
+                for index, package in enumerate(first_packages)
+            ],
+        }, {
+            # Not identified by the tracking number of a package
+            'shipment': second,
+            'timer': PhaseTimer(False),
+            'cost': Decimal('20'),
+            'cost_currency': self.currency,
+            'identification_number': u'1ZSECOND',
+            'packages': [
+                (package, u'1ZSECOND%d' % index, label_file)
+                for index, package in enumerate(second_packages)
+            ],
+        }]
+
+        self.StockShipmentOut._save_ups_labels(labels)
+
+        first = self.StockShipmentOut(first.id)
+        second = self.StockShipmentOut(second.id)
+        self.assertEqual(first.cost, Decimal('10'))
+        self.assertEqual(second.cost, Decimal('20'))
+        self.assertEqual(first.tracking_number.tracking_number, '1ZFIRST0')
+        self.assertEqual(first.tracking_number.origin, first_packages[0])
+        self.assertEqual(second.tracking_number.tracking_number, '1ZSECOND')
+        self.assertEqual(second.tracking_number.origin, second)
+        trackings = Tracking.search([
+            'OR',
+            ('tracking_number', 'like', '1ZFIRST%'),
+            ('tracking_number', 'like', '1ZSECOND%'),
+        ])
+        self.assertEqual(len(trackings), 5)
+        attachments = self.IrAttachment.search([
+            ('resource', 'in', map(str, trackings)),
+        ])
+        self.assertEqual(set(str(a.data) for a in attachments), {'label'})
+        self.assertEqual(
+            sorted(a.name for a in attachments), sorted(
+                '%s_%s_%s.png' % (tracking_number, label[
+                    'identification_number'], package.code)
+                for label in labels
+                for package, tracking_number, _ in label['packages']
+            )
+        )
+
+    @with_transaction()
+    def test_0057_label_journal(self):
+        """
+        Check that labels bought but not saved are resumed from the journal
+        """
+        from trytond.exceptions import UserError
+        ShipmentOut = self.StockShipmentOut
+        Journal = POOL.get('shipping.ups.label.journal')
+        Tracking = POOL.get('shipment.tracking')
+
+        self.setup_defaults()
+        # Other tests may leave USD currencies behind
+        self.Currency.create([{
+            'name': 'Testing Currency',
+            'code': 'XTS',
+            'symbol': 'XTS',
+        }])
+        shipment, packages = self.create_worldship_shipment()
+        ShipmentOut.write([shipment], {
+            'carrier': self.carrier.id,
+            'carrier_service': self.ups_next_day_air,
+            'state': 'packed',
+        })
+        shipment = ShipmentOut(shipment.id)
+        self.assertIsNone(Journal.get_pending(shipment))
+
+        entry_id = Journal.log_confirm(shipment, 'DIGEST')
+        self.assertEqual(Journal.get_pending(shipment).digest, 'DIGEST')
+        Journal.expire(entry_id)
+        self.assertIsNone(Journal.get_pending(shipment))
+
+        entry_id = Journal.log_confirm(shipment, 'DIGEST')
+        response = (
+            '<ShipmentAcceptResponse><ShipmentResults>'
+            '<ShipmentCharges><TotalCharges><CurrencyCode>XTS</CurrencyCode>'
+            '<MonetaryValue>12.50</MonetaryValue></TotalCharges>'
+            '</ShipmentCharges>'
+            '<ShipmentIdentificationNumber>1ZJOURNAL0'
+            '</ShipmentIdentificationNumber>%s'
+            '</ShipmentResults></ShipmentAcceptResponse>' % ''.join(
+                '<PackageResults><TrackingNumber>1ZJOURNAL%d</TrackingNumber>'
+                '<LabelImage><GraphicImage>%s</GraphicImage></LabelImage>'
+                '</PackageResults>' % (index, base64.encodestring('GIF89a'))
+                for index in range(len(packages))
+            )
+        )
+        Journal.log_accept(entry_id, response)
+        entry = Journal.get_pending(shipment)
+        self.assertEqual(entry.state, 'accepted')
+        self.assertEqual(entry.identification_number, '1ZJOURNAL0')
+
+        def fail(*args, **kwargs):
+            self.fail('UPS must not be called again')
+        confirm = ShipmentOut._ups_shipment_confirm
+        accept = ShipmentOut._ups_shipment_accept
+        ShipmentOut._ups_shipment_confirm = fail
+        ShipmentOut._ups_shipment_accept = fail
+        try:
+            with Transaction().set_context(company=self.company.id):
+                shipment.generate_shipping_labels()
+        finally:
+            ShipmentOut._ups_shipment_confirm = confirm
+            ShipmentOut._ups_shipment_accept = accept
+
+        shipment = ShipmentOut(shipment.id)
+        self.assertEqual(shipment.cost, Decimal('12.50'))
+        self.assertEqual(shipment.cost_currency.code, 'XTS')
+        self.assertEqual(
+            shipment.tracking_number.tracking_number, '1ZJOURNAL0'
+        )
+        self.assertIsNone(Journal.get_pending(shipment))
+        # The labels are saved, the response is removed by the purge
+        entry = Journal(entry_id)
+        self.assertEqual(entry.state, 'saved')
+        path = os.path.join(
+            config.get('database', 'path'), Transaction().database.name,
+            entry.accept_response_file
+        )
+        self.assertEqual(open(path, 'rb').read(), response)
+        Journal.purge()
+        self.assertIsNone(Journal(entry_id).accept_response_file)
+        self.assertFalse(os.path.exists(path))
+
+        # A label bought for other packages is not resumed
+        Tracking.write(Tracking.search([
+            ('tracking_number', 'like', '1ZJOURNAL%'),
+        ]), {'tracking_number': 'VOIDED'})
+        entry_id = Journal.log_confirm(shipment, 'DIGEST')
+        Journal.log_accept(
+            entry_id, response.replace('1ZJOURNAL', '1ZOTHER')
+        )
+        POOL.get('stock.package').delete([packages[1]])
+        with self.assertRaises(UserError):
+            Journal.get_pending(ShipmentOut(shipment.id))
+
+        # Only the entries which are not pending are purged
+        Journal.log_failure(shipment, 'Failure')
+        table = Journal.__table__()
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*table.update(
+                [table.create_date],
+                [datetime.now() - relativedelta(days=31)]))
+        Journal.log_failure(shipment, 'Recent failure')
+        Journal.purge()
+        self.assertEqual(
+            sorted((e.state, e.error) for e in Journal.search([
+                ('shipment', '=', shipment.id),
+            ])), [('accepted', None), ('failed', 'Recent failure')]
+        )
+
+    @with_transaction()
+    def test_0058_confirm_at_pack(self):
+        """
+        Check that packed shipments are confirmed ahead of their labels and
+        confirmed again when their packages change
+        """
+        ShipmentOut = self.StockShipmentOut
+        Package = POOL.get('stock.package')
+        Journal = POOL.get('shipping.ups.label.journal')
+
+        self.setup_defaults()
+        self.Currency.create([{
+            'name': 'Testing Currency',
+            'code': 'XTS',
+            'symbol': 'XTS',
+        }])
+        self.Carrier.write([self.carrier], {'ups_confirm_at_pack': True})
+        shipment, packages = self.create_worldship_shipment()
+        ShipmentOut.write([shipment], {
+            'carrier': self.carrier.id,
+            'carrier_service': self.ups_next_day_air,
+            'state': 'packed',
+        })
+
+        calls = []
+
+        def confirm(shipment, timer, ups_cache=None):
+            calls.append(shipment.id)
+            if len(calls) == 4:
+                shipment.raise_user_error('Invalid address')
+            return objectify.fromstring(
+                '<ShipmentConfirmResponse><ShipmentCharges><TotalCharges>'
+                '<CurrencyCode>XTS</CurrencyCode>'
+                '<MonetaryValue>%d.00</MonetaryValue></TotalCharges>'
+                '</ShipmentCharges><ShipmentDigest>DIGEST-%d</ShipmentDigest>'
+                '</ShipmentConfirmResponse>' % (len(calls), len(calls))
+            )
+
+        def entries():
+            return [
+                (e.state, e.digest) for e in Journal.search(
+                    [('shipment', '=', shipment.id)], order=[('id', 'ASC')]
+                )
+            ]
+
+        # Records without digest to expire do not compare their values
+        from trytond.modules.shipping_ups import stock
+        other, other_packages = self.create_worldship_shipment()
+        ups_changed = stock.ups_changed
+
+        def fail(*args):
+            self.fail('No digest to expire')
+        stock.ups_changed = fail
+        try:
+            ShipmentOut.write([other], {'ups_saturday_delivery': True})
+            Package.write(other_packages, {'override_weight': 12})
+            self.StockMove.write(
+                list(other_packages[0].moves), {'quantity': 2}
+            )
+        finally:
+            stock.ups_changed = ups_changed
+
+        original = ShipmentOut._ups_shipment_confirm
+        ShipmentOut._ups_shipment_confirm = confirm
+        try:
+            ShipmentOut.confirm_ups_shipments_cron()
+            ShipmentOut.confirm_ups_shipments_cron()
+            self.assertEqual(calls, [shipment.id])
+            self.assertEqual(entries(), [('confirmed', 'DIGEST-1')])
+            self.assertEqual(ShipmentOut(shipment.id).cost, Decimal('1'))
+
+            # Writing the same values does not change the packages
+            ShipmentOut.write([shipment], {'carrier': self.carrier.id})
+            Package.write(packages, {'length': packages[0].length})
+            self.assertEqual(entries(), [('confirmed', 'DIGEST-1')])
+
+            Package.write([packages[0]], {'override_weight': 12})
+            self.assertEqual(entries(), [('expired', 'DIGEST-1')])
+            ShipmentOut.confirm_ups_shipments_cron()
+            self.assertEqual(entries()[-1], ('confirmed', 'DIGEST-2'))
+
+            self.StockMove.write(
+                list(packages[1].moves), {'quantity': 2}
+            )
+            self.assertEqual(entries()[-1], ('expired', 'DIGEST-2'))
+            ShipmentOut.confirm_ups_shipments_cron()
+            self.assertEqual(entries()[-1], ('confirmed', 'DIGEST-3'))
+
+            # Failures are not retried until the shipment changes
+            ShipmentOut.write([shipment], {'ups_saturday_delivery': True})
+            ShipmentOut.confirm_ups_shipments_cron()
+            ShipmentOut.confirm_ups_shipments_cron()
+            self.assertEqual(len(calls), 4)
+            self.assertEqual(entries()[-1][0], 'failed')
+            ShipmentOut(shipment.id).ups_confirm()
+            self.assertEqual(entries()[-1], ('confirmed', 'DIGEST-5'))
+        finally:
+            ShipmentOut._ups_shipment_confirm = original
+
+    @with_transaction()
+    def test_0059_rate_coalescing(self):
+        """
+        Check that identical rate requests in flight share one response
+        """
+        import threading
+        from lxml import etree
+        from lxml.builder import E
+        from trytond.modules.shipping_ups.rate_flight import flights
+        from trytond.modules.shipping_ups.metrics import registry
+        RateFlight = POOL.get('shipping.ups.rate.flight')
+
+        self.setup_defaults()
+
+        class RateAPI(object):
+            "Rate client answering once released"
+
+            def __init__(self):
+                self.sent = 0
+                self.started = threading.Event()
+                self.release = threading.Event()
+
+            def request(self, rate_request):
+                self.sent += 1
+                self.started.set()
+                self.release.wait()
+                if self.sent > 1:
+                    raise ValueError('Sent twice')
+                return rate_request
+
+        def run_concurrently(rate_api, count):
+            "Send count identical requests, the first one being in flight"
+            results, waiting = [], []
+
+            def run():
+                try:
+                    results.append(RateFlight.request(
+                        self.carrier, rate_api,
+                        E.RatingServiceSelectionRequest(E.Shipment('1')),
+                        on_response=received.append
+                    ))
+                except ValueError, e:
+                    results.append(e)
+
+            leader = threading.Thread(target=run)
+            leader.start()
+            rate_api.started.wait()
+            call, = flights._calls.values()
+            event_wait = call.event.wait
+
+            def wait():
+                waiting.append(1)
+                event_wait()
+            call.event.wait = wait
+
+            followers = [
+                threading.Thread(target=run) for _ in range(count - 1)
+            ]
+            for thread in followers:
+                thread.start()
+            while len(waiting) < count - 1:
+                sleep(0.01)
+            rate_api.release.set()
+            for thread in [leader] + followers:
+                thread.join()
+            return results
+
+        if not config.has_section('ups'):
+            config.add_section('ups')
+        config.set('ups', 'metrics', 'True')
+        registry.reset()
+        try:
+            rate_api = RateAPI()
+            received = []
+            results = run_concurrently(rate_api, 4)
+            self.assertEqual(rate_api.sent, 1)
+            # The shared response is received once
+            self.assertEqual(len(received), 1)
+            self.assertEqual(len(results), 4)
+            # Each caller gets its own tree of the response
+            self.assertEqual(len(set(id(r) for r in results)), 4)
+            self.assertEqual(
+                set(etree.tostring(r) for r in results),
+                set([etree.tostring(results[0])])
+            )
+            self.assertEqual(flights._calls, {})
+            metrics, = registry.snapshot()
+            self.assertEqual(metrics['coalesced'], 3)
+
+            # The error of the request in flight is raised to every caller
+            rate_api = RateAPI()
+            rate_api.sent = 1
+            results = run_concurrently(rate_api, 3)
+            self.assertEqual(rate_api.sent, 2)
+            self.assertTrue(all(isinstance(r, ValueError) for r in results))
+
+            # Requests which are not in flight are sent
+            rate_api = RateAPI()
+            rate_api.release.set()
+            request = E.RatingServiceSelectionRequest(E.Shipment('1'))
+            RateFlight.request(self.carrier, rate_api, request)
+            with self.assertRaises(ValueError):
+                RateFlight.request(self.carrier, rate_api, request)
+
+            config.set('ups', 'coalesce_rates', 'False')
+            rate_api = RateAPI()
+            rate_api.release.set()
+            RateFlight.request(self.carrier, rate_api, request)
+            self.assertEqual(rate_api.sent, 1)
+        finally:
+            config.remove_option('ups', 'metrics')
+            config.remove_option('ups', 'coalesce_rates')
+
+    @with_transaction()
+    def test_0060_cartonization(self):
+        """
+        Check that sales are rated as the lines packed into the box types of
+        the carrier
+        """
+        from trytond.modules.shipping_ups.cartonization import Item, Box, \
+            pack
+        ModelData = POOL.get('ir.model.data')
+
+        # Items are packed largest first, a carton is shrunk to the
+        # smallest box holding its contents
+        boxes = [Box('small', (2, 2, 2), None), Box('large', (4, 4, 4), 6)]
+        cartons = pack([
+            Item('a', 5, (2, 2, 2), 1),
+            Item('b', 2, (1, 1, 1), 1),
+            Item('c', 1, (5, 1, 1), 1),
+            Item('d', 1, None, 20),
+        ], boxes, 50)
+        self.assertEqual(
+            sorted(
+                (c.box and c.box.key, sorted(c.contents.items()))
+                for c in cartons
+            ), [
+                (None, [('c', 1)]),
+                ('large', [('a', 5), ('b', 1)]),
+                ('small', [('b', 1)]),
+                ('small', [('d', 1)]),
+            ]
+        )
+        self.assertEqual(pack([], boxes, 50), [])
+
+        self.setup_defaults()
+        uom_inch = ModelData.get_id('product', 'uom_inch')
+        uom_pound = ModelData.get_id('product', 'uom_pound')
+        small_box = self.BoxType(ModelData.get_id('shipping_ups', 'ups_2a'))
+        large_box = self.BoxType(ModelData.get_id('shipping_ups', 'ups_2c'))
+        self.Template.write([self.product.template], {
+            'length': 10, 'length_uom': uom_inch,
+            'width': 10, 'width_uom': uom_inch,
+            'height': 10, 'height_uom': uom_inch,
+        })
+
+        with Transaction().set_context(company=self.company.id):
+            sale, = self.Sale.create([{
+                'payment_term': self.payment_term,
+                'party': self.sale_party.id,
+                'invoice_address': self.sale_party.addresses[0].id,
+                'shipment_address': self.sale_party.addresses[0].id,
+                'carrier': self.carrier.id,
+                'carrier_service': self.ups_next_day_air,
+                'lines': [('create', [{
+                    'type': 'line',
+                    'quantity': 21,
+                    'product': self.product,
+                    'unit_price': Decimal('10.00'),
+                    'description': 'Test Description1',
+                    'unit': self.product.template.default_uom,
+                }])],
+            }])
+
+        def packages():
+            return [(
+                package.findtext('PackagingType/Code'),
+                package.findtext('PackageWeight/Weight'),
+                package.findtext('Dimensions/Length'),
+            ) for package in sale._get_ups_rate_packages(self.carrier)]
+
+        # Without box dimensions the whole sale is one package
+        self.assertEqual(len(packages()), 1)
+        self.assertEqual(packages()[0][1], '10.50')
+
+        self.BoxType.write([small_box], {
+            'length': 12, 'width': 12, 'height': 12,
+            'distance_unit': uom_inch,
+        })
+        self.BoxType.write([large_box], {
+            'length': 24, 'width': 24, 'height': 24,
+            'distance_unit': uom_inch,
+            'max_weight': 5, 'weight_uom': uom_pound,
+        })
+        # 8 units of 0.5 lb (2 by 2 by 2) in a large box, under its weight
+        # limit, the 5 units left do not fit in a small one. The dimensions
+        # of the UPS boxes are not sent
+        self.assertEqual(packages(), [
+            ('2c', '4.00', None),
+            ('2c', '4.00', None),
+            ('2c', '2.50', None),
+        ])
+
+        # Only the customer supplied packages have dimensions
+        self.BoxType.write([large_box], {'code': '02'})
+        self.assertEqual(packages(), [
+            ('02', '4.00', '24.00'),
+            ('02', '4.00', '24.00'),
+            ('02', '2.50', '24.00'),
+        ])
+
+    @with_transaction()
+    def test_0061_auto_pack(self):
+        """
+        Check that shipments are packed in the UPS boxes of the lowest
+        billable weight
+        """
+        from trytond.exceptions import UserError
+        from trytond.modules.shipping_ups.cartonization import Item, Box, \
+            search, pack
+        ModelData = POOL.get('ir.model.data')
+        Package = POOL.get('stock.package')
+
+        # Dimensional weight favours the small box over the heavy one
+        items = [Item('a', 2, (10, 10, 10), 1)]
+        boxes = [
+            Box('small', (12, 12, 12), None),
+            Box('large', (30, 30, 30), None),
+        ]
+        (score, cartons), other = search(items, boxes, 150, 139, 1)
+        self.assertEqual(score, (26, 2))
+        self.assertEqual(set(c.box.key for c in cartons), set(['small']))
+        self.assertEqual(other[0], (195, 1))
+
+        # Only whole units fit: one 10 in cube per 18 in box, not four as
+        # their volume would allow
+        cubes = [Item('a', 4, (10, 10, 10), 1)]
+        cartons = pack(cubes, [Box('medium', (18, 18, 18), None)], 150)
+        self.assertEqual([c.contents for c in cartons], [{'a': 1}] * 4)
+        cartons = pack(cubes, [Box('large', (20, 20, 20), None)], 150)
+        self.assertEqual([c.contents for c in cartons], [{'a': 4}])
+        # Long items only fit lengthwise, 2 by 1 across
+        cartons = pack(
+            [Item('b', 3, (16, 5, 5), 1)],
+            [Box('long', (17, 12, 7), None)], 150
+        )
+        self.assertEqual(
+            sorted(c.contents['b'] for c in cartons), [1, 2]
+        )
+
+        self.setup_defaults()
+        uom_inch = ModelData.get_id('product', 'uom_inch')
+        uom_pound = ModelData.get_id('product', 'uom_pound')
+        self.Template.write([self.product.template], {
+            'length': 10, 'length_uom': uom_inch,
+            'width': 10, 'width_uom': uom_inch,
+            'height': 10, 'height_uom': uom_inch,
+        })
+        for xml_id, side, max_weight in [
+                ('ups_2a', 12, None), ('ups_2b', 20, None),
+                ('ups_2c', 24, 2)]:
+            self.BoxType.write([
+                self.BoxType(ModelData.get_id('shipping_ups', xml_id))
+            ], {
+                'length': side, 'width': side, 'height': side,
+                'distance_unit': uom_inch,
+                'max_weight': max_weight,
+                'weight_uom': max_weight and uom_pound,
+            })
+        medium_box = ModelData.get_id('shipping_ups', 'ups_2b')
+
+        shipment, packages = self.create_worldship_shipment()
+        self.StockShipmentOut.write([shipment], {'carrier': self.carrier.id})
+        shipment = self.StockShipmentOut(shipment.id)
+
+        # Moves of 6 and 4 units of 0.5 lb: 2 medium boxes of at most 6
+        # units (by volume, 8 by grid) billed 58 lb each are cheaper than
+        # 10 small boxes billed 13 lb or 3 large boxes of 4 units (by
+        # weight)
+        self.StockShipmentOut.ups_auto_pack([shipment])
+        shipment = self.StockShipmentOut(shipment.id)
+        self.assertEqual(
+            set(p.box_type.id for p in shipment.packages), set([medium_box])
+        )
+        self.assertEqual(sorted(
+            sum(m.quantity for m in p.moves) for p in shipment.packages
+        ), [4, 6])
+        self.assertEqual(sorted(
+            m.quantity for m in shipment.outgoing_moves
+        ), [4, 6])
+        self.assertFalse(Package.search([
+            ('id', 'in', map(int, packages)),
+        ]))
+
+        # Packing again gives the same layout
+        self.StockShipmentOut.ups_auto_pack([shipment])
+        shipment = self.StockShipmentOut(shipment.id)
+        self.assertEqual(sorted(
+            sum(m.quantity for m in p.moves) for p in shipment.packages
+        ), [4, 6])
+        self.assertEqual(len(shipment.outgoing_moves), 2)
+
+        # Moves packed in several boxes are split
+        self.BoxType.write([self.BoxType(medium_box)], {
+            'length': 12, 'width': 12, 'height': 24,
+        })
+        self.StockShipmentOut.ups_auto_pack([shipment])
+        shipment = self.StockShipmentOut(shipment.id)
+        self.assertEqual(sorted(
+            sum(m.quantity for m in p.moves) for p in shipment.packages
+        ), [2, 2, 2, 2, 2])
+        self.assertEqual(sorted(
+            m.quantity for m in shipment.outgoing_moves
+        ), [2, 2, 2, 2, 2])
+
+        # Split assigned moves are assigned again if their units are still
+        # available
+        with Transaction().set_context(company=self.company.id):
+            stock, = self.StockMove.create([{
+                'product': self.product.id,
+                'uom': shipment.outgoing_moves[0].uom.id,
+                'quantity': 10,
+                'from_location': ModelData.get_id(
+                    'stock', 'location_supplier'),
+                'to_location': shipment.warehouse.output_location.id,
+                'unit_price': Decimal('1'),
+                'currency': self.currency.id,
+            }])
+            self.StockMove.do([stock])
+        self.StockMove.write(
+            list(shipment.outgoing_moves), {'state': 'assigned'}
+        )
+        self.BoxType.write([self.BoxType(medium_box)], {
+            'length': 12, 'width': 12, 'height': 36,
+        })
+        # The test moves have no origin
+        check_origin_types = self.StockMove.check_origin_types
+        self.StockMove.check_origin_types = staticmethod(lambda: set())
+        try:
+            self.StockShipmentOut.ups_auto_pack([shipment])
+            shipment = self.StockShipmentOut(shipment.id)
+            self.assertEqual(sorted(
+                sum(m.quantity for m in p.moves) for p in shipment.packages
+            ), [1, 3, 3, 3])
+            self.assertEqual(
+                set(m.state for m in shipment.outgoing_moves),
+                set(['assigned'])
+            )
+            self.assertEqual(
+                sum(m.quantity for m in shipment.outgoing_moves), 10
+            )
+
+            with Transaction().set_context(company=self.company.id):
+                stock, = self.StockMove.copy([stock], default={
+                    'from_location': shipment.warehouse.output_location.id,
+                    'to_location': shipment.customer_location.id,
+                })
+                self.StockMove.do([stock])
+            self.BoxType.write([self.BoxType(medium_box)], {
+                'length': 12, 'width': 12, 'height': 48,
+            })
+            # The units were shipped since, the split moves of 4 unit boxes
+            # can not be assigned
+            with self.assertRaises(UserError):
+                self.StockShipmentOut.ups_auto_pack([shipment])
+        finally:
+            self.StockMove.check_origin_types = check_origin_types
+
+    @with_transaction()
+    def test_0062_rate_shopping(self):
+        """
+        Check that sales are rated with several UPS carriers at once
+        """
+        import threading
+        from lxml import etree
+        from lxml.builder import E
+        Address = POOL.get('party.address')
+
+        self.setup_defaults()
+        # Other tests may leave USD currencies behind
+        currency, = self.Currency.create([{
+            'name': 'Testing Currency',
+            'code': 'XTS',
+            'symbol': 'XTS',
+            'rates': [('create', [{'rate': Decimal('2')}])],
+        }])
+        self.Currency.write([self.company.currency], {
+            'rates': [('create', [{'rate': Decimal('1')}])],
+        })
+        with Transaction().set_context(company=self.company.id):
+            sale, = self.Sale.create([{
+                'payment_term': self.payment_term,
+                'party': self.sale_party.id,
+                'invoice_address': self.sale_party.addresses[0].id,
+                'shipment_address': self.sale_party.addresses[0].id,
+                'carrier': self.carrier.id,
+                'lines': [('create', [{
+                    'type': 'line',
+                    'quantity': 2,
+                    'product': self.product,
+                    'unit_price': Decimal('10.00'),
+                    'description': 'Test Description1',
+                    'unit': self.product.template.default_uom,
+                }])],
+            }])
+        contract, slow, failing = self.Carrier.copy([self.carrier] * 3)
+        self.Carrier.write([contract], {'ups_negotiated_rates': True})
+        release = threading.Event()
+
+        class RateAPI(object):
+            "Rate client answering with costs by service code"
+
+            def __init__(self, carrier, costs):
+                self.carrier = carrier
+                self.costs = costs
+
+            def request(self, rate_request):
+                if self.carrier == slow:
+                    release.wait()
+                elif self.carrier == failing:
+                    raise ValueError('Failed')
+                return objectify.fromstring(etree.tostring(
+                    E.RatingServiceSelectionResponse(*[
+                        E.RatedShipment(
+                            E.Service(E.Code(code)),
+                            E.TotalCharges(
+                                E.CurrencyCode('XTS'),
+                                E.MonetaryValue(cost),
+                            ),
+                        ) for code, cost in self.costs
+                    ])
+                ))
+
+        costs = {
+            self.carrier: [('01', '30.00'), ('02', '20.00')],
+            contract: [('01', '25.00')],
+            slow: [('02', '5.00')],
+            failing: [('02', '1.00')],
+        }
+        built = []
+
+        def to_ups_to_address(address):
+            built.append(address.id)
+            return E.ShipTo(str(address.id))
+
+        patches = {
+            'to_ups_shipper': lambda a, carrier: E.Shipper(str(carrier.id)),
+            'to_ups_to_address': to_ups_to_address,
+            'to_ups_from_address': lambda a: E.ShipFrom(str(a.id)),
+        }
+        originals = dict((n, getattr(Address, n)) for n in patches)
+        ups_api_instance = self.Carrier.ups_api_instance
+        for name, method in patches.iteritems():
+            setattr(Address, name, method)
+        self.Carrier.ups_api_instance = \
+            lambda c, call: RateAPI(c, costs[c])
+        try:
+            start = time()
+            with Transaction().set_context(company=self.company.id):
+                rates = self.Carrier.shop_ups_rates(
+                    [self.carrier, contract, slow, failing], sale,
+                    timeout=0.5
+                )
+            self.assertLess(time() - start, 5)
+        finally:
+            release.set()
+            for name, method in originals.iteritems():
+                setattr(Address, name, method)
+            self.Carrier.ups_api_instance = ups_api_instance
+
+        # The slow and failing carriers are left out
+        self.assertEqual([
+            (r['carrier'], r['carrier_service'].code, r['cost'])
+            for r in rates
+        ], [
+            (self.carrier, '02', Decimal('20.00')),
+            (contract, '01', Decimal('25.00')),
+            (self.carrier, '01', Decimal('30.00')),
+        ])
+        # The ship to address is built once for all the carriers
+        self.assertEqual(built, [sale.shipment_address.id])
+
+    @with_transaction()
+    def test_0063_rate_history(self):
+        """
+        Check that the quotes of the rate responses are recorded by lane
+        """
+        from trytond.exceptions import UserError
+        RateHistory = POOL.get('shipping.ups.rate.history')
+
+        self.setup_defaults()
+        # Other tests may leave USD currencies behind
+        self.Currency.create([{
+            'name': 'Testing Currency',
+            'code': 'XTS',
+            'symbol': 'XTS',
+        }])
+        from_address = self.company.party.addresses[0]
+        to_address = self.sale_party.addresses[0]
+
+        def response(*quotes):
+            return objectify.fromstring(
+                '<RatingServiceSelectionResponse>%s'
+                '</RatingServiceSelectionResponse>' % ''.join(
+                    '<RatedShipment><Service><Code>%s</Code></Service>'
+                    '<BillingWeight><UnitOfMeasurement><Code>LBS</Code>'
+                    '</UnitOfMeasurement><Weight>%s</Weight></BillingWeight>'
+                    '<TotalCharges><CurrencyCode>XTS</CurrencyCode>'
+                    '<MonetaryValue>%s</MonetaryValue></TotalCharges>'
+                    '<NegotiatedRates><NetSummaryCharges><GrandTotal>'
+                    '<CurrencyCode>XTS</CurrencyCode>'
+                    '<MonetaryValue>%s</MonetaryValue></GrandTotal>'
+                    '</NetSummaryCharges></NegotiatedRates></RatedShipment>'
+                    % quote for quote in quotes))
+
+        RateHistory.record(
+            self.carrier, from_address, to_address,
+            response(
+                ('01', '2.5', '30.00', '27.00'), ('03', '2.5', '9.50', '8.00')
+            )
+        )
+        RateHistory.record(
+            self.carrier, from_address, to_address,
+            response(('03', '3.0', '10.50', '9.00'))
+        )
+        quotes = RateHistory.search([('carrier', '=', self.carrier.id)])
+        self.assertEqual(len(quotes), 3)
+        self.assertEqual(
+            set((q.origin_zip3, q.destination_zip3) for q in quotes),
+            set([('943', '331')])
+        )
+
+        statistics, = RateHistory.get_lane_statistics('943', '331', '03')
+        self.assertEqual(statistics['weight_bracket'], 3)
+        self.assertEqual(statistics['count'], 2)
+        self.assertEqual(statistics['min_cost'], Decimal('9.50'))
+        self.assertEqual(statistics['avg_cost'], Decimal('10.00'))
+        self.assertEqual(statistics['max_cost'], Decimal('10.50'))
+        self.assertEqual(statistics['avg_negotiated_cost'], Decimal('8.50'))
+        self.assertTrue(isinstance(statistics['last_date'], datetime))
+        self.assertEqual(
+            len(RateHistory.get_lane_statistics('943', '331')), 2
+        )
+        self.assertFalse(RateHistory.get_lane_statistics('331', '943'))
+
+        # Quotes are append only and purged past the retention
+        with self.assertRaises(UserError):
+            RateHistory.write(quotes, {'published_cost': Decimal('1')})
+        old_quote, = RateHistory.create([{
+            'date': datetime.now() - relativedelta(days=100),
+            'carrier': self.carrier.id,
+            'service_code': '03',
+            'currency': quotes[0].currency.id,
+            'published_cost': Decimal('5'),
+        }])
+        RateHistory.purge()
+        self.assertEqual(RateHistory.search([
+            ('carrier', '=', self.carrier.id),
+        ]), quotes)
+
+        # Quotes of a read-only transaction wait for a writable one
+        transaction = Transaction()
+        transaction.readonly = True
+        try:
+            RateHistory.record(
+                self.carrier, from_address, to_address,
+                response(('02', '1.0', '20.00', '18.00'))
+            )
+        finally:
+            transaction.readonly = False
+        self.assertEqual(RateHistory.search([
+            ('carrier', '=', self.carrier.id),
+        ], count=True), 3)
+        RateHistory.purge_rate_history_cron()
+        self.assertEqual(RateHistory.search([
+            ('carrier', '=', self.carrier.id),
+        ], count=True), 4)
+
+        if not config.has_section('ups'):
+            config.add_section('ups')
+        config.set('ups', 'rate_history', 'False')
+        try:
+            RateHistory.record(
+                self.carrier, from_address, to_address,
+                response(('03', '3.0', '10.50', '9.00'))
+            )
+        finally:
+            config.remove_option('ups', 'rate_history')
+        self.assertEqual(RateHistory.search([
+            ('carrier', '=', self.carrier.id),
+        ], count=True), 4)
+
+    @with_transaction()
+    def test_0064_invoice_reconciliation(self):
+        """
+        Check that UPS billing files are reconciled with the shipment costs
+        """
+        from trytond.modules.shipping_ups.invoice_reconciliation import \
+            iter_billing_records
+        Reconciliation = POOL.get('shipping.ups.invoice.reconciliation')
+        Line = POOL.get('shipping.ups.invoice.reconciliation.line')
+        Tracking = POOL.get('shipment.tracking')
+
+        self.setup_defaults()
+        currency, = self.Currency.create([{
+            'name': 'Testing Currency',
+            'code': 'XTS',
+            'symbol': 'XTS',
+        }])
+        shipment, packages = self.create_worldship_shipment()
+        other, other_packages = self.create_worldship_shipment()
+        Tracking.create([{
+            'carrier': self.carrier.id,
+            'tracking_number': '1ZRECON%d' % i,
+            'origin': str(package),
+        } for i, package in enumerate(packages + other_packages)])
+        self.StockShipmentOut.write([shipment, other], {
+            'cost': Decimal('16.00'),
+            'cost_currency': currency.id,
+        })
+
+        billing_file = BytesIO(
+            '\xef\xbb\xbfInvoice Number,Invoice Currency Code,'
+            'Tracking Number,Charge Category Code,Charge Description,'
+            'Entered Weight,Billed Weight,Net Amount\n'
+            'INV1,XTS,1ZRECON0,SHP,Ground,2,2,10.00\n'
+            'INV1,XTS,1ZRECON0,SHP,Fuel Surcharge,2,2,1.00\n'
+            'INV1,XTS,1ZRECON1,SHP,Ground,3,3,5.00\n'
+            'INV1,XTS,1ZRECON2,SHP,Ground,2,2,16.00\n'
+            'INV1,XTS,1ZRECON9,SHP,Ground,1,1,7.00\n'
+            'INV1,XTS,,SHP,Ground,1,1,7.00\n'
+            'INV2,XTS,1ZRECON1,ADJ,Shipping Charge Correction,3,5,3.00\n'
+            'INV2,XTS,1ZRECON2,ADJ,Address Correction,2,2,-2.00\n'
+        )
+        records = list(iter_billing_records(billing_file))
+        self.assertEqual(len(records), 7)
+
+        # Charges of a shipment are merged across batches
+        reconciliation, = Reconciliation.create([{'name': 'Test'}])
+        Line.add_charges(reconciliation, records[:3])
+        Line.add_charges(reconciliation, records[3:])
+        lines = dict(
+            (line.shipment or line.tracking_number, line)
+            for line in reconciliation.lines
+        )
+        self.assertEqual(len(lines), 3)
+        line = lines[shipment]
+        self.assertEqual(line.billed_cost, Decimal('19.00'))
+        self.assertEqual(line.difference, Decimal('3.00'))
+        self.assertEqual(line.charges, 4)
+        self.assertEqual(line.state, 'overbilled')
+        self.assertTrue(line.dim_correction)
+        self.assertFalse(line.surcharge)
+        line = lines[other]
+        self.assertEqual(line.state, 'underbilled')
+        self.assertFalse(line.dim_correction)
+        self.assertTrue(line.surcharge)
+        self.assertEqual(lines['1ZRECON9'].state, 'unmatched')
+
+        reconciliation = Reconciliation.reconcile('Test', records)
+        self.assertEqual(reconciliation.charges, 7)
+        self.assertEqual(sorted(
+            (l.state, l.billed_cost) for l in reconciliation.lines
+        ), [
+            ('overbilled', Decimal('19.00')),
+            ('underbilled', Decimal('14.00')),
+            ('unmatched', Decimal('7.00')),
+        ])
+
+        with self.assertRaises(ValueError):
+            list(iter_billing_records(BytesIO('Invoice Number\nINV1\n')))
+
+        # A charge in an unknown currency is not matched
+        values = Line._get_values({
+            'tracking_number': '1ZRECON0',
+            'currency_code': 'ZZZ',
+            'billed_cost': Decimal('10.00'),
+        }, Decimal('10.00'), currency)
+        self.assertEqual(values['state'], 'unmatched')
+        self.assertIsNone(values['difference'])
+
+        # Files of the billing folder are streamed from disk and archived
+        directory = tempfile.mkdtemp()
+        try:
+            for name, data in [
+                    ('billing.csv', billing_file.getvalue()),
+                    ('invalid.csv', 'Invoice Number\nINV1\n'),
+                    ('null.csv', billing_file.getvalue() + 'INV3,\0\n'),
+                    ]:
+                path = os.path.join(directory, name)
+                with open(path, 'wb') as file_obj:
+                    file_obj.write(data)
+                os.utime(path, (time() - 60, time() - 60))
+            if not config.has_section('ups'):
+                config.add_section('ups')
+            config.set('ups', 'billing_dir', directory)
+            try:
+                Reconciliation.import_billing_files_cron()
+            finally:
+                config.remove_option('ups', 'billing_dir')
+            reconciliation, = Reconciliation.search([
+                ('name', '=', 'billing.csv'),
+            ])
+            self.assertEqual(reconciliation.charges, 7)
+            self.assertFalse(Reconciliation.search([
+                ('name', '=', 'invalid.csv'),
+            ]))
+            self.assertEqual(sorted(os.listdir(directory)), [
+                'archive', 'error',
+            ])
+            self.assertEqual(
+                os.listdir(os.path.join(directory, 'archive')),
+                ['billing.csv']
+            )
+            self.assertEqual(
+                sorted(os.listdir(os.path.join(directory, 'error'))),
+                ['invalid.csv', 'null.csv']
+            )
+        finally:
+            shutil.rmtree(directory)
+
+    def test_0065_ups_api_lazy(self):
+        """
+        Check that the PyUPS APIs are loaded on first access
+        """
+        from ups.shipping_package import ShipmentConfirm
+        from ups.base import PyUPSException
+        from trytond.modules.shipping_ups.ups_api import UPSAPI, ups
+
+        api = UPSAPI()
+        self.assertEqual(api.loaded(), [])
+        self.assertIs(api.ShipmentConfirm, ShipmentConfirm)
+        self.assertIs(api.PyUPSException, PyUPSException)
+        self.assertEqual(
+            api.loaded(), ['PyUPSException', 'ShipmentConfirm']
+        )
+        with self.assertRaises(AttributeError):
+            api.Unknown
+
+        # Exceptions of PyUPS are caught through the facade
+        try:
+            raise PyUPSException('Hard-111285', 'Invalid', None)
+        except ups.PyUPSException, e:
+            self.assertEqual(e[0], 'Hard-111285')
+
+    def test_0066_accept_response_stream(self):
+        """
+        Check that the accept responses are parsed one package at a time
+        """
+        from ups.base import PyUPSException
+        from trytond.modules.shipping_ups import accept_response
+        from trytond.modules.shipping_ups.accept_response import \
+            parse_header, iter_package_results
+
+        data = (
+            '<?xml version="1.0"?>\n<ShipmentAcceptResponse>'
+            '<Response><ResponseStatusCode>1</ResponseStatusCode></Response>'
+            '<ShipmentResults>'
+            '<ShipmentIdentificationNumber>1ZSTREAM0'
+            '</ShipmentIdentificationNumber>%s'
+            '</ShipmentResults></ShipmentAcceptResponse>' % ''.join(
+                '<PackageResults><TrackingNumber>1ZSTREAM%d</TrackingNumber>'
+                '<LabelImage><GraphicImage>%s</GraphicImage></LabelImage>'
+                '</PackageResults>' % (
+                    index, base64.encodestring('GIF89a' + '\0' * 5000))
+                for index in range(5)
+            )
+        )
+        chunk_size = accept_response.CHUNK_SIZE
+        # Labels span several chunks
+        accept_response.CHUNK_SIZE = 1024
+        try:
+            header = parse_header(data)
+            self.assertEqual(
+                header.ShipmentResults.ShipmentIdentificationNumber.text,
+                '1ZSTREAM0'
+            )
+            self.assertFalse(hasattr(header.ShipmentResults, 'PackageResults'))
+
+            tracking_numbers = []
+            for package in iter_package_results(data):
+                previous = package.getprevious()
+                # Only the current label is kept
+                self.assertFalse(
+                    previous is not None and previous.countchildren()
+                )
+                self.assertEqual(
+                    base64.decodestring(package.LabelImage.GraphicImage.text),
+                    'GIF89a' + '\0' * 5000
+                )
+                tracking_numbers.append(package.TrackingNumber.text)
+        finally:
+            accept_response.CHUNK_SIZE = chunk_size
+        self.assertEqual(
+            tracking_numbers, ['1ZSTREAM%d' % i for i in range(5)]
+        )
+
+        # The responses of send_raw are temporary files
+        data_file = tempfile.TemporaryFile()
+        data_file.write(data)
+        self.assertEqual(
+            parse_header(data_file)
+            .ShipmentResults.ShipmentIdentificationNumber.text,
+            '1ZSTREAM0'
+        )
+        self.assertEqual([
+                package.TrackingNumber.text
+                for package in iter_package_results(data_file)
+            ], tracking_numbers)
+
+        with self.assertRaises(PyUPSException):
+            parse_header(
+                '<ShipmentAcceptResponse><Response><Error>'
+                '<ErrorSeverity>Hard</ErrorSeverity>'
+                '<ErrorCode>120100</ErrorCode>'
+                '<ErrorDescription>Invalid digest</ErrorDescription>'
+                '</Error></Response></ShipmentAcceptResponse>'
+            )
+
+    @with_transaction()
+    def test_0067_label_processes(self):
+        """
+        Check that the labels are processed in the label processes
+        """
+        from trytond.modules.shipping_ups import label_processing
+        ShipmentOut = self.StockShipmentOut
+        Journal = POOL.get('shipping.ups.label.journal')
+        Attachment = POOL.get('ir.attachment')
+        Package = POOL.get('stock.package')
+
+        self.setup_defaults()
+        self.Currency.create([{
+            'name': 'Testing Currency',
+            'code': 'XTS',
+            'symbol': 'XTS',
+        }])
+        shipment, packages = self.create_worldship_shipment()
+        ShipmentOut.write([shipment], {
+            'carrier': self.carrier.id,
+            'carrier_service': self.ups_next_day_air,
+            'state': 'packed',
+        })
+        shipment = ShipmentOut(shipment.id)
+        image = base64.encodestring('GIF89a')
+
+        # Disabled, the labels are processed in the request thread
+        self.assertIsNone(Package._get_ups_label_processor(self.carrier))
+        digest, collision = packages[0]._submit_ups_label(
+            self.carrier, image
+        )
+        self.assertEqual(
+            (digest, collision), (hashlib.md5('GIF89a').hexdigest(), 0)
+        )
+        self.assertEqual(open(os.path.join(
+                    config.get('database', 'path'),
+                    Transaction().database.name, digest[0:2], digest[2:4],
+                    digest), 'rb').read(), 'GIF89a')
+
+        entry_id = Journal.log_confirm(shipment, 'DIGEST')
+        Journal.log_accept(entry_id, (
+            '<ShipmentAcceptResponse><ShipmentResults>'
+            '<ShipmentCharges><TotalCharges><CurrencyCode>XTS</CurrencyCode>'
+            '<MonetaryValue>12.50</MonetaryValue></TotalCharges>'
+            '</ShipmentCharges>'
+            '<ShipmentIdentificationNumber>1ZPOOL0'
+            '</ShipmentIdentificationNumber>%s'
+            '</ShipmentResults></ShipmentAcceptResponse>' % ''.join(
+                '<PackageResults><TrackingNumber>1ZPOOL%d</TrackingNumber>'
+                '<LabelImage><GraphicImage>%s</GraphicImage></LabelImage>'
+                '</PackageResults>' % (index, image)
+                for index in range(len(packages))
+            )
+        ))
+
+        if not config.has_section('ups'):
+            config.add_section('ups')
+        config.set('ups', 'label_processes', '1')
+        try:
+            self.assertIs(
+                Package._get_ups_label_processor(self.carrier),
+                label_processing.process_raw_label
+            )
+            with Transaction().set_context(company=self.company.id):
+                shipment.generate_shipping_labels()
+            pool = label_processing._pool
+            self.assertIsNotNone(pool)
+            self.assertEqual(len(pool._pool), 1)
+            self.assertNotIn(os.getpid(), [p.pid for p in pool._pool])
+        finally:
+            config.remove_option('ups', 'label_processes')
+            label_processing.shutdown()
+
+        shipment = ShipmentOut(shipment.id)
+        self.assertEqual(
+            shipment.tracking_number.tracking_number, '1ZPOOL0'
+        )
+        attachments = Attachment.search([
+            ('name', 'like', '1ZPOOL%'),
+        ])
+        self.assertEqual(len(attachments), len(packages))
+        for attachment in attachments:
+            self.assertEqual(str(attachment.data), 'GIF89a')
+
+    @with_transaction()
+    def test_0068_label_journal_transaction(self):
+        """
+        Check that the journal entries are kept when the transaction buying
+        the labels is rolled back. The shipment is committed, the test must
+        stay the last one.
+        """
+        from trytond import backend
+        ShipmentOut = self.StockShipmentOut
+        Journal = POOL.get('shipping.ups.label.journal')
+
+        if backend.name() == 'sqlite':
+            self.skipTest('The journal is written in the current transaction')
+
+        self.setup_defaults()
+        shipment, packages = self.create_worldship_shipment()
+        ShipmentOut.write([shipment], {
+            'carrier': self.carrier.id,
+            'carrier_service': self.ups_next_day_air,
+            'state': 'packed',
+        })
+        Transaction().commit()
+
+        shipment = ShipmentOut(shipment.id)
+        Journal.lock_shipment(shipment)
+        entry_id = Journal.log_confirm(shipment, 'DIGEST')
+        Journal.log_accept(entry_id, (
+            '<ShipmentAcceptResponse><ShipmentResults>'
+            '<ShipmentIdentificationNumber>1ZROLLBACK'
+            '</ShipmentIdentificationNumber>'
+            '</ShipmentResults></ShipmentAcceptResponse>'
+        ))
+        Transaction().rollback()
+
+        entry = Journal.get_pending(ShipmentOut(shipment.id))
+        self.assertEqual(entry.id, entry_id)
+        self.assertEqual(entry.state, 'accepted')
+        self.assertEqual(entry.identification_number, '1ZROLLBACK')
+        Journal.delete([entry])
+        Transaction().commit()
+
 
 def suite():
     suite = trytond.tests.test_tryton.suite()
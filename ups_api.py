@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+    ups_api.py
+
+    Access to the API classes of PyUPS, whose modules are imported on first
+    use instead of when the module is loaded: workers and trytond commands
+    which never talk to UPS do not pay for them::
+
+        from ups_api import ups
+
+        ups.ShipmentConfirm.address_type(...)   # imports ups.shipping_package
+
+"""
+import importlib
+
+__all__ = ['ups', 'UPSAPI', 'MODULES']
+
+#: Module of the ups package defining each class of the facade
+MODULES = {
+    'ShipmentConfirm': 'ups.shipping_package',
+    'ShipmentAccept': 'ups.shipping_package',
+    'ShipmentVoid': 'ups.shipping_package',
+    'RatingService': 'ups.rating_package',
+    'AddressValidation': 'ups.address_validation',
+    'WorldShip': 'ups.worldship_api',
+    'PyUPSException': 'ups.base',
+}
+
+
+class UPSAPI(object):
+    "Facade loading the classes of PyUPS on first access"
+
+    def __getattr__(self, name):
+        # Only called for the classes not loaded yet
+        try:
+            module = MODULES[name]
+        except KeyError:
+            raise AttributeError(name)
+        value = getattr(importlib.import_module(module), name)
+        setattr(self, name, value)
+        return value
+
+    def loaded(self):
+        "Return the names of the classes already loaded"
+        return sorted(n for n in MODULES if n in self.__dict__)
+
+
+ups = UPSAPI()
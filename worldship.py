@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+    worldship.py
+
+    Read back the files exported by UPS WorldShip.
+
+"""
+import os
+import csv
+import stat
+import time
+import codecs
+import tempfile
+from io import BytesIO
+from contextlib import contextmanager
+
+from lxml import etree
+from logbook import Logger
+
+from trytond import backend
+from trytond.model import fields, ModelView
+from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction
+from trytond.wizard import Wizard, StateView, Button, StateTransition
+
+__all__ = ['WorldShipImportStart', 'WorldShipImport']
+__metaclass__ = PoolMeta
+
+logger = Logger('trytond_ups')
+
+#: Files modified less than these many seconds ago are left for the next
+#: run, WorldShip may still be writing them.
+SETTLE_DELAY = 5
+
+
+def _iter_xml_records(file_obj):
+    """
+    Yield (package id, tracking number) for every `Package` element of a
+    WorldShip XML export. Elements are dropped as soon as they are read so
+    that memory does not grow with the size of the file.
+    """
+    for _, element in etree.iterparse(
+            file_obj, events=('end',), tag='{*}Package'):
+        yield (
+            element.findtext('{*}PackageID'),
+            element.findtext('{*}TrackingNumber'),
+        )
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+
+def _iter_csv_records(file_obj):
+    """
+    Yield (package id, tracking number) for every row of a WorldShip CSV
+    export. The export map must name the columns `PackageID` and
+    `TrackingNumber`.
+    """
+    reader = csv.DictReader(file_obj)
+    if reader.fieldnames:
+        reader.fieldnames = [
+            name.lstrip(codecs.BOM_UTF8).strip() for name in reader.fieldnames
+        ]
+    for row in reader:
+        yield row.get('PackageID'), row.get('TrackingNumber')
+
+
+def iter_worldship_records(file_obj):
+    """
+    Stream (package id, tracking number) tuples from a WorldShip export.
+
+    The `PackageID` is the id of the `stock.package` as sent in
+    :meth:`ShipmentOut.get_worldship_xml`. Both XML and CSV exports are
+    supported, the format is guessed from the first character of the file.
+    Rows without a valid package id or tracking number are skipped.
+
+    :param file_obj: A seekable file like object
+    """
+    start = file_obj.tell()
+    head = file_obj.read(64).lstrip(codecs.BOM_UTF8).lstrip()
+    file_obj.seek(start)
+
+    if head.startswith('<'):
+        records = _iter_xml_records(file_obj)
+    else:
+        records = _iter_csv_records(file_obj)
+
+    for package_id, tracking_number in records:
+        package_id = (package_id or '').strip()
+        tracking_number = (tracking_number or '').strip()
+        if not package_id.isdigit() or not tracking_number:
+            logger.debug(
+                'Skipping WorldShip record {0!r}, {1!r}'.format(
+                    package_id, tracking_number
+                )
+            )
+            continue
+        yield int(package_id), unicode(tracking_number)
+
+
+def iter_worldship_files(paths):
+    """
+    Stream the records of several WorldShip export files one after the
+    other. Each file is only opened when the previous one is exhausted.
+    """
+    for path in paths:
+        with open(path, 'rb') as file_obj:
+            for record in iter_worldship_records(file_obj):
+                yield record
+
+
+def write_atomic(directory, filename, data):
+    """
+    Write data to directory/filename so that a reader watching the
+    directory never sees a partial file: the data is written to a hidden
+    temporary file of the same directory which is then renamed.
+    """
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file_obj:
+            file_obj.write(data)
+            file_obj.flush()
+            os.fsync(file_obj.fileno())
+        os.rename(temp_path, os.path.join(directory, filename))
+    except Exception:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+
+
+def archive_file(path, name='archive'):
+    """
+    Move the file at path to the name subdirectory of its directory,
+    created if missing, and return its new path.
+    """
+    directory = os.path.join(os.path.dirname(path), name)
+    if not os.path.isdir(directory):
+        os.mkdir(directory)
+    new_path = os.path.join(directory, os.path.basename(path))
+    os.rename(path, new_path)
+    return new_path
+
+
+@contextmanager
+def own_transaction():
+    """
+    Run the block in a new transaction committed at its end, so the files
+    are moved only once what was read from them is committed. SQLite allows
+    only one writer, the block is then run in the current transaction.
+    """
+    if backend.name() == 'sqlite':
+        yield
+        return
+    with Transaction().new_transaction():
+        yield
+
+
+def process_new_files(directory, process, errors=()):
+    """
+    Call process with the path of each new file of directory, each one in
+    its own transaction, and move the file to the `archive` subfolder once
+    committed. Files for which process raises one of errors are moved to
+    the `error` subfolder, other exceptions leave the file for the next
+    run.
+    """
+    for path in iter_new_files(directory):
+        try:
+            with own_transaction():
+                process(path)
+        except errors, e:
+            logger.warning(
+                'File {0} moved to error: {1}'.format(path, e)
+            )
+            archive_file(path, 'error')
+            continue
+        archive_file(path)
+
+
+def iter_new_files(directory):
+    """
+    Yield the path of the files of directory, oldest first. The processed
+    files must be moved out of it, see :func:`archive_file`: the time of
+    the files copied with their own (like by `cp -p` or rsync) says nothing
+    of their arrival. Hidden files and files which are still being written
+    are ignored.
+    """
+    settled = time.time() - SETTLE_DELAY
+
+    entries = []
+    for name in os.listdir(directory):
+        if name.startswith('.'):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            # Removed since the listing
+            continue
+        if not stat.S_ISREG(st.st_mode) or st.st_mtime > settled:
+            continue
+        entries.append((st.st_mtime, name, path))
+
+    for _, _, path in sorted(entries):
+        yield path
+
+
+class WorldShipImportStart(ModelView):
+    'WorldShip Import Start'
+    __name__ = 'shipping.ups.worldship.import.start'
+
+    file = fields.Binary('WorldShip Export File', required=True)
+
+
+class WorldShipImport(Wizard):
+    'Import WorldShip Tracking Numbers'
+    __name__ = 'shipping.ups.worldship.import'
+
+    start = StateView(
+        'shipping.ups.worldship.import.start',
+        'shipping_ups.worldship_import_start_view_form',
+        [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Import', 'import_', 'tryton-ok', default=True),
+        ]
+    )
+    import_ = StateTransition()
+
+    def transition_import_(self):
+        Shipment = Pool().get('stock.shipment.out')
+
+        Shipment.import_worldship_tracking_numbers(
+            iter_worldship_records(BytesIO(bytes(self.start.file)))
+        )
+        return 'end'